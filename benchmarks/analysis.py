@@ -0,0 +1,94 @@
+"""
+Сравнение отчетов analysis.py на общем PanelIndex с прежней реализацией (lambda в agg, отдельный проход по панели
+в каждом отчете). Отчеты должны совпадать.
+
+Запуск: python -m benchmarks.analysis
+"""
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table, timeit
+from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, profit_by_ticker, PanelIndex
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices, compact_frame
+
+
+def investment_type_ration_old(df):
+    last_day = df[df['date'] == df['date'].max()]
+    price_briefcase = last_day['buy_price'].sum()
+    today_by_type = last_day.groupby('investemnt_object_type', observed=True)['buy_price']\
+        .sum()\
+        .sort_index()\
+        .div(price_briefcase)\
+        .mul(100)\
+        .round(2)
+    today_by_type.index = today_by_type.index.rename('Type')
+    return today_by_type.rename('percent')
+
+
+def investment_type_profit_old(df):
+    group_by_type_and_date = df.groupby(['date', 'investemnt_object_type'], observed=True)
+    sum_profit_by_date = group_by_type_and_date['profit_money'].sum().sort_index()
+    sum_spent_by_date = group_by_type_and_date['buy_price'].sum().sort_index()
+    mask = (sum_spent_by_date > 0) & sum_spent_by_date.notna()
+    profit_by_type_date = (sum_profit_by_date[mask] / sum_spent_by_date[mask])\
+        .mul(100)\
+        .rename('profit')\
+        .reset_index()
+    agg_types = profit_by_type_date.groupby('investemnt_object_type', observed=True).agg(
+        min_profit=('profit', 'min'),
+        max_profit=('profit', 'max'),
+        last_profit=('profit', 'last'),
+        days_period=('date', lambda x: x.max() - x.min())
+    ).sort_index().round(2)
+    agg_types.index = agg_types.index.rename('Type')
+    return profit_by_type_date, agg_types
+
+
+def profit_by_ticker_old(df):
+    df = df.sort_values(by='date')
+    last_day = df['date'].max()
+    active_tickers = df.loc[df['date'] == last_day, 'ticker'].unique()
+    return df[df['ticker'].isin(active_tickers)].groupby('ticker', observed=True).agg(
+        cnt=('quantity', 'last'),
+        buy_price=('buy_price', 'last'),
+        avg_price=('avg_price', 'last'),
+        min_profit=('profit_percent', 'min'),
+        max_profit=('profit_percent', 'max'),
+        last_profit=('profit_percent', 'last'),
+        days=('date', lambda x: x.max() - x.min())
+    ).sort_index().sort_values(by='buy_price', ascending=False)
+
+
+def _reports_old(panel):
+    profit_by_type_date, type_profit_agg = investment_type_profit_old(panel)
+    return [investment_type_ration_old(panel), profit_by_type_date, type_profit_agg, profit_by_ticker_old(panel)]
+
+
+def _reports_new(panel):
+    panel = PanelIndex(panel)
+    profit_by_type_date, type_profit_agg = investment_type_profit(panel)
+    return [investment_type_ration(panel), profit_by_type_date, type_profit_agg, profit_by_ticker(panel)]
+
+
+def _assert_equal(actual, expected):
+    for actual_report, expected_report in zip(actual, expected):
+        if isinstance(expected_report, pd.Series):
+            pd.testing.assert_series_equal(actual_report, expected_report)
+        else:
+            pd.testing.assert_frame_equal(actual_report, expected_report)
+
+
+def main(n_instruments=500, years=5):
+    operations = synthetic_operations(n_instruments, years=years)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+    panel = enrichment_ticker_prices(ts_briefcase_ticker_prices(operations), quotes)
+    print(f'{n_instruments} tickers x {years} years, {len(panel)} panel rows')
+    print(f'{"panel":>10} {"old, s":>8} {"new, s":>8} {"speedup":>8}')
+    for name, variant in (('plain', panel), ('compact', compact_frame(panel))):
+        _assert_equal(_reports_new(variant), _reports_old(variant))
+        old_time = timeit(_reports_old, variant)
+        new_time = timeit(_reports_new, variant)
+        print(f'{name:>10} {old_time:>8.3f} {new_time:>8.3f} {old_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
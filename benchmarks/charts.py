@@ -0,0 +1,74 @@
+"""
+Отрисовка графиков: прежний способ (pyplot, группировка панели и весь ряд по дням для каждого графика) против
+tinvest_analysis.charts (общий PanelIndex, прореживание, Figure без pyplot, пул процессов).
+
+Запуск: python -m benchmarks.charts
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import matplotlib
+import numpy as np
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table
+from tinvest_analysis.analysis import PanelIndex
+from tinvest_analysis.charts import lttb, minmax, portfolio_chart_job, type_chart_jobs, ticker_chart_jobs, \
+    render_charts
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices
+
+
+def render_pyplot(df, path, figure_size=(20, 10)):
+    import matplotlib.pyplot as plt
+    profit = df.groupby('date')[['profit_money', 'buy_price']].sum()
+    fig = plt.figure(figsize=figure_size)
+    plt.plot(profit.index, profit['profit_money'] / profit['buy_price'] * 100, label='Доходность')
+    plt.axhline(y=0, color='black', linestyle='--', alpha=0.7)
+    plt.grid(linestyle='--', alpha=0.3)
+    plt.legend()
+    plt.tight_layout()
+    fig.autofmt_xdate()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def _check_downsampling():
+    rng = np.random.default_rng(0)
+    y = np.cumsum(rng.normal(size=100_000))
+    x = np.arange(len(y), dtype='float64')
+    for indices in (lttb(x, y, 1000), minmax(y, 1000)):
+        assert indices[0] == 0 and indices[-1] == len(y) - 1 and np.all(np.diff(indices) > 0)
+    # minmax сохраняет глобальные экстремумы
+    assert {int(np.argmin(y)), int(np.argmax(y))} <= set(minmax(y, 1000))
+
+
+def main(n_instruments=100, years=10, workers=(1, os.cpu_count())):
+    matplotlib.use('Agg')
+    _check_downsampling()
+    operations = synthetic_operations(n_instruments, years=years)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+    panel = enrichment_ticker_prices(ts_briefcase_ticker_prices(operations), quotes)
+    print(f'{n_instruments} tickers x {years} years, {len(panel)} panel rows')
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        render_pyplot(panel, Path(root) / 'pyplot.png')
+        print(f'portfolio, pyplot, full series: {time.perf_counter() - start:.3f} s')
+
+        start = time.perf_counter()
+        index = PanelIndex(panel)
+        jobs = [portfolio_chart_job(index, operations, Path(root) / 'portfolio.png')]
+        jobs += type_chart_jobs(index, root)
+        jobs += ticker_chart_jobs(index, operations, root)
+        prepare_time = time.perf_counter() - start
+        print(f'{len(jobs)} chart series prepared in {prepare_time:.3f} s')
+        for max_workers in workers:
+            start = time.perf_counter()
+            times = render_charts(jobs, max_workers)
+            print(f'{len(jobs)} charts, {max_workers} workers: {time.perf_counter() - start:.3f} s wall, '
+                  f'{times["seconds"].mean():.3f} s per chart, portfolio {times["seconds"].iloc[0]:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Память по шагам и совпадение отчетов в обычном и компактном (compact_frame) режимах.
+
+Запуск: python -m benchmarks.compact
+"""
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table
+from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, correlation_type_profit, \
+    profit_by_ticker
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices, compact_frame, \
+    memory_usage_mb
+
+
+def _pipeline(operations, quotes, compact):
+    memory = {}
+    panel = ts_briefcase_ticker_prices(operations)
+    if compact:
+        panel, quotes = compact_frame(panel), compact_frame(quotes)
+    memory['ts_briefcase_ticker_prices'] = memory_usage_mb(panel)
+    memory['load_financial_quotes'] = memory_usage_mb(quotes)
+    panel = enrichment_ticker_prices(panel, quotes)
+    if compact:
+        panel = compact_frame(panel)
+    memory['enrichment_ticker_prices'] = memory_usage_mb(panel)
+    profit_by_type_date, type_profit_agg = investment_type_profit(panel)
+    reports = [
+        investment_type_ration(panel).to_frame(),
+        profit_by_type_date,
+        type_profit_agg,
+        correlation_type_profit(profit_by_type_date),
+        profit_by_ticker(panel),
+    ]
+    return memory, reports
+
+
+def main(n_instruments=500, years=5):
+    operations = synthetic_operations(n_instruments, years=years)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+
+    plain_memory, plain_reports = _pipeline(operations, quotes, compact=False)
+    compact_memory, compact_reports = _pipeline(operations, quotes, compact=True)
+    for expected, actual in zip(plain_reports, compact_reports):
+        actual = actual.reset_index().astype({
+            column: object for column in actual.reset_index().select_dtypes('category').columns})
+        pd.testing.assert_frame_equal(actual, expected.reset_index(), check_dtype=False)
+
+    report = pd.DataFrame({'plain, MB': plain_memory, 'compact, MB': compact_memory})
+    report['ratio'] = report['plain, MB'] / report['compact, MB']
+    print(f'{n_instruments} instruments x {years} years')
+    print(report.round(2).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Память и время основных шагов анализа при датах в виде datetime64[ns] и в виде объектов datetime.date.
+
+Запуск: python -m benchmarks.dates
+"""
+import time
+
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table
+from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, profit_by_ticker
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices
+
+
+def _as_object_dates(df: pd.DataFrame) -> pd.DataFrame:
+    return df.assign(date=df['date'].dt.date)
+
+
+def _run(briefcase_ticker_price, quotes):
+    timings = {}
+    start = time.perf_counter()
+    panel = enrichment_ticker_prices(briefcase_ticker_price.copy(), quotes)
+    timings['enrichment_ticker_prices'] = time.perf_counter() - start
+    for func in (investment_type_ration, investment_type_profit, profit_by_ticker):
+        start = time.perf_counter()
+        func(panel)
+        timings[func.__name__] = time.perf_counter() - start
+    return panel, timings
+
+
+def main(n_instruments=500, years=5):
+    operations = synthetic_operations(n_instruments, years=years)
+    briefcase_ticker_price = ts_briefcase_ticker_prices(operations)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+
+    variants = {
+        'object': (_as_object_dates(briefcase_ticker_price), _as_object_dates(quotes)),
+        'datetime64': (briefcase_ticker_price, quotes),
+    }
+    print(f'{n_instruments} instruments x {years} years, {len(briefcase_ticker_price)} panel rows')
+    results = {}
+    for name, (panel, variant_quotes) in variants.items():
+        enriched, timings = _run(panel, variant_quotes)
+        memory = enriched.memory_usage(deep=True)
+        results[name] = dict(timings, panel_memory_mb=memory.sum() / 2 ** 20, date_memory_mb=memory['date'] / 2 ** 20)
+
+    report = pd.DataFrame(results)
+    report['ratio'] = report['object'] / report['datetime64']
+    print(report.round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
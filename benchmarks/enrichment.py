@@ -0,0 +1,58 @@
+"""
+Сравнение enrichment_ticker_prices (asof-поиск цены через searchsorted + справочник атрибутов по ISIN)
+с прежней реализацией (merge всей таблицы котировок + groupby.ffill).
+
+Запуск: python -m benchmarks.enrichment
+"""
+
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table, timeit
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices, calculate_profit
+
+
+def enrichment_ticker_prices_merge(briefcase_ticker_price, quotes):
+    """
+    Прежняя реализация.
+    """
+    briefcase_ticker_price = pd.merge(
+        briefcase_ticker_price, quotes,
+        left_on=['date', 'isin'],
+        right_on=['date', 'isin'],
+        how='left'
+    ).sort_values(by='date')
+    ffill_columns = ['close_price', 'investemnt_object_type', 'geography', 'currency']
+    briefcase_ticker_price[ffill_columns] = briefcase_ticker_price.groupby('isin').ffill()[ffill_columns]
+    briefcase_ticker_price = calculate_profit(briefcase_ticker_price)
+    return briefcase_ticker_price
+
+
+def _normalize(df):
+    return df.sort_values(by=['isin', 'date']).reset_index(drop=True)
+
+
+def main(sizes=(100, 500), years=5):
+    print(f'{"instruments":>12} {"rows":>9} {"merge, s":>9} {"asof, s":>8} {"speedup":>8}')
+    for n_instruments in sizes:
+        operations = synthetic_operations(n_instruments, years=years)
+        briefcase_ticker_price = ts_briefcase_ticker_prices(operations)
+        quotes = synthetic_quote_table(n_instruments, years + 1)
+
+        # котировки есть на каждый день, поэтому результаты обеих реализаций должны совпадать
+        expected = _normalize(enrichment_ticker_prices_merge(briefcase_ticker_price.copy(), quotes))
+        actual = _normalize(enrichment_ticker_prices(briefcase_ticker_price.copy(), quotes))
+        pd.testing.assert_frame_equal(actual, expected[actual.columns], check_dtype=False)
+
+        merge_time = timeit(enrichment_ticker_prices_merge, briefcase_ticker_price.copy(), quotes)
+        asof_time = timeit(enrichment_ticker_prices, briefcase_ticker_price.copy(), quotes)
+        print(f'{n_instruments:>12} {len(briefcase_ticker_price):>9} {merge_time:>9.3f} {asof_time:>8.3f} '
+              f'{merge_time / asof_time:>7.1f}x')
+
+    # новый счет до загрузки котировок: котировок нет совсем или у них нет цен - цены NaN, как у merge
+    for empty_quotes in (quotes.iloc[:0], quotes.assign(close_price=float('nan'))):
+        actual = enrichment_ticker_prices(briefcase_ticker_price.copy(), empty_quotes)
+        assert len(actual) == len(briefcase_ticker_price) and actual['close_price'].isna().all()
+
+
+if __name__ == '__main__':
+    main()
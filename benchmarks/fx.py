@@ -0,0 +1,68 @@
+"""
+Пересчет в валюту отчета (tinvest_analysis.fx): searchsorted по ключу (валюта, день) против построчного
+поиска курса через .apply и против pd.merge_asof. Результаты должны совпадать.
+
+Запуск: python -m benchmarks.fx
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_fx_rates, synthetic_quote_table, timeit
+from tinvest_analysis.fx import FxRates, convert_operations, convert_quotes, instrument_currencies
+from tinvest_analysis.pipeline import build_panel
+
+
+def rate_apply(rates: pd.DataFrame, currency: pd.Series, dates: pd.Series) -> pd.Series:
+    """
+    Построчный поиск курса: последний курс валюты не позже даты строки.
+    """
+    by_currency = {name: x.set_index('date')['rate'].sort_index() for name, x in rates.groupby('currency')}
+    frame = pd.DataFrame({'currency': currency.to_numpy(), 'date': dates.dt.normalize().to_numpy()})
+    return frame.apply(
+        lambda row: 1.0 if row['currency'] == 'RUB' else by_currency[row['currency']].asof(row['date']), axis=1)
+
+
+def rate_merge_asof(rates: pd.DataFrame, currency: pd.Series, dates: pd.Series) -> np.ndarray:
+    frame = pd.DataFrame({'currency': currency.to_numpy(), 'date': dates.dt.normalize().to_numpy(),
+                          'row': np.arange(len(currency))})
+    merged = pd.merge_asof(frame.sort_values('date'), rates.sort_values('date'), on='date', by='currency')
+    merged.loc[merged['currency'] == 'RUB', 'rate'] = 1.0
+    return merged.sort_values('row')['rate'].to_numpy()
+
+
+def main(n_instruments=500, years=5, sample=20_000):
+    rates = synthetic_fx_rates(years + 1)
+    fx_rates = FxRates(rates)
+    rng = np.random.default_rng(0)
+    operations = synthetic_operations(n_instruments, years=years)
+    isins = operations['isin'].unique()
+    # треть бумаг торгуется в рублях, остальные - в валюте
+    currency = dict(zip(isins, rng.choice(['RUB', 'USD', 'EUR', 'CNY'], size=len(isins))))
+    operations['currency'] = operations['isin'].map(currency)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+    quote_currency = quotes['isin'].map(currency)
+    print(f'{len(quotes)} quotes, {len(operations)} operations, {len(rates)} rates')
+
+    start = time.perf_counter()
+    expected = rate_apply(rates, quote_currency.iloc[:sample], quotes['date'].iloc[:sample])
+    apply_time = (time.perf_counter() - start) * len(quotes) / sample
+    actual = fx_rates.rate(quote_currency, quotes['date'])
+    np.testing.assert_allclose(actual[:sample], expected.to_numpy(dtype='float64'))
+    np.testing.assert_allclose(actual, rate_merge_asof(rates, quote_currency, quotes['date']))
+
+    numpy_time = timeit(convert_quotes, quotes, fx_rates, instrument_currencies(operations))
+    merge_time = timeit(rate_merge_asof, rates, quote_currency, quotes['date'])
+    print(f'quotes: numpy {numpy_time:.3f} s, merge_asof {merge_time:.3f} s, '
+          f'apply ~{apply_time:.1f} s (оценка по {sample} строкам)')
+    print(f'operations: numpy {timeit(convert_operations, operations, fx_rates):.3f} s')
+
+    start = time.perf_counter()
+    panel = build_panel(operations, quotes, fx_rates=fx_rates)
+    print(f'build_panel with fx: {len(panel)} rows in {time.perf_counter() - start:.3f} s')
+    assert panel['trade_currency'].notna().all()
+
+
+if __name__ == '__main__':
+    main()
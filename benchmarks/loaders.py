@@ -0,0 +1,110 @@
+"""
+Загрузка котировок InvestFounds без сети. Синтетический сайт (StubServer с функцией-ответчиком) записывается
+в архив (режим record), затем загрузка воспроизводится из архива (режим replay) с разной задержкой ответа
+и числом потоков, с ошибками 503 и со справочником бумаг (MetadataStore) - кэшем поиска и страниц.
+Котировки в каждом режиме должны совпадать с записанными.
+
+Запуск: python -m benchmarks.loaders
+"""
+import datetime as dt
+import json
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.loaders.investfound import InvestFounds
+from tinvest_analysis.loaders.transport import StubServer, http_session
+from tinvest_analysis.utils.metadata import MetadataStore
+
+
+PAGE_TEMPLATE = """<html><body><ul class="param_list">
+<li><span>Объект инвестирования</span><div class="value">{asset_type}</div></li>
+<li><span>География инвестирования</span><div class="value">{geography}</div></li>
+<li><span>Валюта фонда</span><div class="value">{currency}</div></li>
+</ul></body></html>"""
+
+
+def synthetic_site(method, url, body):
+    """
+    Ответы investfunds.ru для фондов (ETF): поиск по ISIN, страница фонда и история цен с date_from.
+    """
+    # к синтетическому сайту обращаются напрямую: url - путь и параметры без хоста
+    parts = urlsplit(f'http://localhost/{url}')
+    path = parts.path.strip('/').split('/')
+    params = {name: values[0] for name, values in parse_qs(parts.query).items()}
+    if path[0] != 'etf':
+        return None
+    if len(path) == 1:
+        isin = params['searchString']
+        number = int(isin[2:])
+        body = {'id': isin, 'id.numeric': number, 'fund_id': isin, 'fund_id.numeric': number, 'name': f'Fund {isin}',
+                'class_link': f'/etf/{isin.lower()}/', 'trading_grounds': [
+                    {'name': 'Московская биржа', 'id': isin, 'id.numeric': number}]}
+        return 200, 'application/json', json.dumps({'total': 1, 'currentResults': [body]}).encode()
+    if len(path) == 2:
+        number = int(path[1][2:])
+        page = PAGE_TEMPLATE.format(asset_type=('Акции', 'Облигации', 'Золото')[number % 3],
+                                    geography=('Россия', 'США')[number % 2], currency=('RUB', 'USD')[number % 2])
+        return 200, 'text/html; charset=utf-8', page.encode()
+    date_from = dt.datetime.strptime(params['date_from'], '%d.%m.%Y')
+    dates = pd.date_range(date_from, dt.datetime.combine(dt.date.today(), dt.time()), freq='1D')
+    rng = np.random.default_rng(int(path[1][2:]))
+    prices = (100 * np.exp(np.cumsum(rng.normal(0, 0.02, size=len(dates))))).round(4)
+    data = [[int(x.timestamp()) * 1000, price] for x, price in zip(dates, prices)]
+    return 200, 'application/json', json.dumps([{'tooltip': {'xDateFormat': '%d.%m.%Y'}, 'data': data}]).encode()
+
+
+def load_quotes(isins, base_url, session, max_workers, metadata=None, retries=3):
+    client = InvestFounds(isins, base_url=base_url, session=session, max_workers=max_workers, rate_limit=0,
+                          retries=retries, backoff=0.01, metadata=metadata)
+    return {isin: asset.chartData for isin, asset in client.assets.items()}
+
+
+def _assert_same(actual, expected):
+    assert list(actual) == list(expected)
+    for isin, quotes in expected.items():
+        pd.testing.assert_frame_equal(actual[isin], quotes)
+
+
+def main(n_instruments=100, latencies_ms=(0, 20), workers=(1, 4, 16), error_rate=0.2):
+    isins = [f'XX{i:010d}' for i in range(n_instruments)]
+    with tempfile.TemporaryDirectory() as root:
+        archive = Path(root) / 'archive.zip'
+        with StubServer(synthetic_site) as origin, http_session('record', archive) as session:
+            base_url = origin.url
+            expected = load_quotes(isins, base_url, session, max_workers=8)
+        print(f'{n_instruments} ETF, {origin.stats["requests"]} requests, archive {archive.stat().st_size / 2 ** 20:.1f} MB')
+
+        print(f'{"latency, ms":>12} {"workers":>8} {"seconds":>8}')
+        for latency_ms in latencies_ms:
+            for max_workers in workers:
+                with http_session('replay', archive, latency_ms=latency_ms) as session:
+                    start = time.perf_counter()
+                    actual = load_quotes(isins, base_url, session, max_workers)
+                    seconds = time.perf_counter() - start
+                _assert_same(actual, expected)
+                print(f'{latency_ms:>12} {max_workers:>8} {seconds:>8.2f}')
+
+        # ошибки 503 повторяются HttpClient с backoff
+        with http_session('replay', archive, latency_ms=latencies_ms[-1], error_rate=error_rate) as session:
+            start = time.perf_counter()
+            actual = load_quotes(isins, base_url, session, max(workers), retries=10)
+            print(f'error rate {error_rate}: {time.perf_counter() - start:.2f} s')
+        _assert_same(actual, expected)
+
+        # справочник бумаг: при повторной загрузке поиск и страница не запрашиваются
+        metadata = MetadataStore(Path(root) / 'metadata.json')
+        for run in ('first', 'cached'):
+            with http_session('replay', archive, latency_ms=latencies_ms[-1]) as session:
+                start = time.perf_counter()
+                actual = load_quotes(isins, base_url, session, max(workers), metadata)
+                print(f'metadata, {run} run: {time.perf_counter() - start:.2f} s')
+            _assert_same(actual, expected)
+
+
+if __name__ == '__main__':
+    main()
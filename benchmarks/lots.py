@@ -0,0 +1,89 @@
+"""
+Учет лотов (tinvest_analysis.lots) против эталона - цикла по сделкам с очередью лотов.
+Результаты должны совпадать, в том числе когда продажи превышают позицию (часть покупок отброшена);
+время замеряется на десятках тысяч сделок.
+
+Запуск: python -m benchmarks.lots
+"""
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, timeit
+from tinvest_analysis.lots import match_lots, lot_positions
+from tinvest_analysis.processing import ts_briefcase_ticker_prices
+
+
+def match_lots_loop(operations, method):
+    trades = operations.sort_values(by=['isin', 'dt'], kind='stable').reset_index(drop=True)
+    result = {'quantity': [], 'cost_basis': [], 'realized_pnl': [], 'open_lots': []}
+    lots, quantity, cost, isin = deque(), 0.0, 0.0, None
+    for row in trades[['isin', 'count', 'total_price']].itertuples(index=False):
+        if row.isin != isin:
+            lots, quantity, cost, isin = deque(), 0.0, 0.0, row.isin
+        realized = 0.0
+        if row.count > 0:
+            lots.append([row.count, -row.total_price / row.count])
+            cost += -row.total_price
+        else:
+            # сверх позиции - бумаги без покупок в истории, они учитываются по цене продажи
+            matched = min(-row.count, quantity)
+            to_sell = matched
+            if method == 'fifo':
+                sold_cost = 0.0
+                while to_sell > 1e-9 and lots:
+                    lot = lots[0]
+                    take = min(lot[0], to_sell)
+                    sold_cost += take * lot[1]
+                    lot[0] -= take
+                    to_sell -= take
+                    if lot[0] <= 1e-9:
+                        lots.popleft()
+            else:
+                sold_cost = cost * to_sell / quantity if quantity > 0 else 0.0
+            cost -= sold_cost
+            realized = row.total_price * matched / -row.count - sold_cost
+        quantity += row.count if row.count > 0 else -matched
+        if quantity <= 1e-9:
+            quantity, cost, lots = 0.0, 0.0, deque()
+        result['quantity'].append(quantity)
+        result['cost_basis'].append(cost)
+        result['realized_pnl'].append(realized)
+        result['open_lots'].append(len(lots) if method == 'fifo' else int(quantity > 0))
+    return trades.assign(**result)
+
+
+def main(n_instruments=500, trades_per_instrument=100, years=5, missing_buys=0.05):
+    operations = synthetic_operations(n_instruments, years=years, trades_per_instrument=trades_per_instrument)
+    print(f'{len(operations)} trades, {n_instruments} instruments x {years} years')
+    # без части покупок (перевод бумаг от другого брокера) продажи превышают позицию
+    rng = np.random.default_rng(0)
+    oversold = operations[(operations['count'] <= 0) | (rng.random(len(operations)) >= missing_buys)]
+    for method in ('fifo', 'average'):
+        expected = match_lots_loop(oversold, method)
+        actual = match_lots(oversold, method)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False, atol=1e-6)
+        assert (actual['quantity'] >= 0).all() and (actual['open_lots'] >= 0).all()
+
+        start = time.perf_counter()
+        expected = match_lots_loop(operations, method)
+        loop_time = time.perf_counter() - start
+        actual = match_lots(operations, method)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False, atol=1e-6)
+        vectorized_time = timeit(match_lots, operations, method)
+        print(f'{method:>8} trades: loop {loop_time:.3f} s, numpy {vectorized_time:.3f} s')
+
+        panel_time = timeit(lot_positions, operations, method)
+        panel = lot_positions(operations, method)
+        # количество совпадает с панелью по денежным потокам (там закрытые позиции отброшены)
+        cash_panel = ts_briefcase_ticker_prices(operations)
+        merged = cash_panel.merge(panel, on=['date', 'isin'], suffixes=('_cash', ''))
+        assert len(merged) == len(cash_panel) == (panel['quantity'] > 0).sum()
+        np.testing.assert_allclose(merged['quantity'], merged['quantity_cash'])
+        print(f'{method:>8} daily panel: {len(panel)} rows in {panel_time:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Риск-метрики tinvest_analysis.metrics против эталона на pandas (groupby по бумагам, rolling по колонкам и парам).
+Значения должны совпадать; время эталонных корреляций замеряется на части пар и пересчитывается на все пары.
+
+Запуск: python -m benchmarks.metrics
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_quote_table
+from tinvest_analysis.metrics import daily_returns, rolling_metrics, drawdown, risk_summary, rolling_correlations
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices
+
+
+def daily_returns_pandas(df, by):
+    df = df.sort_values(by=['isin', 'date']).copy()
+    df['value'] = df['quantity'] * df['close_price']
+    previous = df.groupby('isin')[['date', 'profit_money', 'value', 'buy_price']].shift()
+    valid = (previous['date'] == df['date'] - pd.Timedelta(days=1)) & previous['value'].notna() \
+        & df['profit_money'].notna() & df['quantity'].mul(df['close_price']).notna()
+    df['pnl'] = (df['profit_money'] - previous['profit_money']).where(valid, 0.0)
+    df['base'] = (previous['value'] + (df['buy_price'] - previous['buy_price']).clip(lower=0)).where(valid, 0.0)
+    sums = df.groupby(['date', by])[['pnl', 'base']].sum().unstack(by)
+    returns = (sums['pnl'] / sums['base'].where(sums['base'] > 0)).iloc[1:]
+    return returns.asfreq('1D')
+
+
+def rolling_correlations_pandas(returns, window, pairs):
+    return pd.DataFrame({
+        (first, second): returns[first].rolling(window).corr(returns[second])
+        for first, second in pairs
+    })
+
+
+def main(n_instruments=200, years=5, window=30, corr_window=90, reference_pairs=200):
+    operations = synthetic_operations(n_instruments, years=years)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+    panel = enrichment_ticker_prices(ts_briefcase_ticker_prices(operations), quotes)
+    print(f'{n_instruments} tickers x {years} years, {len(panel)} panel rows')
+
+    start = time.perf_counter()
+    returns = daily_returns(panel, 'ticker')
+    returns_time = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = daily_returns_pandas(panel, 'ticker')
+    returns_pandas_time = time.perf_counter() - start
+    pd.testing.assert_frame_equal(returns, expected.reindex(returns.index), check_names=False,
+                                  check_freq=False, check_column_type=False)
+    print(f'daily_returns: numpy {returns_time:.3f} s, pandas {returns_pandas_time:.3f} s')
+
+    start = time.perf_counter()
+    rolling = rolling_metrics(returns, window)
+    summary = risk_summary(returns)
+    drawdowns = drawdown(returns)
+    metrics_time = time.perf_counter() - start
+    volatility = returns.rolling(window).std() * np.sqrt(365)
+    pd.testing.assert_frame_equal(rolling['volatility'], volatility, check_freq=False, atol=1e-8)
+    np.testing.assert_allclose(summary['volatility'], (returns.std() * np.sqrt(365) * 100).round(2))
+    wealth = (1 + returns.fillna(0)).cumprod()
+    pd.testing.assert_frame_equal(drawdowns, wealth / wealth.cummax().clip(lower=1) - 1, check_freq=False)
+    print(f'rolling_metrics + risk_summary + drawdown: {metrics_time:.3f} s')
+
+    start = time.perf_counter()
+    correlations = rolling_correlations(returns, corr_window)
+    correlations_time = time.perf_counter() - start
+    pairs = list(correlations.columns[:reference_pairs])
+    start = time.perf_counter()
+    expected = rolling_correlations_pandas(returns, corr_window, pairs)
+    reference_time = (time.perf_counter() - start) * correlations.shape[1] / len(pairs)
+    pd.testing.assert_frame_equal(correlations[pairs], expected, check_names=False, check_freq=False, atol=1e-6)
+    print(f'rolling_correlations, {correlations.shape[1]} pairs: numpy {correlations_time:.3f} s, '
+          f'pandas ~{reference_time:.1f} s (оценка по {len(pairs)} парам)')
+
+    # тип актива не известен ни для одной бумаги: только фонды (Fund) или бумаги еще без котировок
+    for unknown in (panel.assign(investemnt_object_type=None),
+                    panel.assign(investemnt_object_type=None, close_price=np.nan, profit_money=np.nan)):
+        by_type = daily_returns(unknown, 'investemnt_object_type')
+        assert by_type.shape == (len(returns), 0), by_type.shape
+        summary = risk_summary(pd.concat([daily_returns(unknown), by_type], axis=1))
+        assert list(summary.index) == ['portfolio'], summary
+        assert risk_summary(by_type).empty
+
+
+if __name__ == '__main__':
+    main()
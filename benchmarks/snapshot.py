@@ -0,0 +1,56 @@
+"""
+Полный расчет дневной панели против инкрементального пересчета от снимка (update_panel): панель снимка
+читается из файлов по годам или из кэша шагов. При смене курсов валют снимок строится заново.
+
+Запуск: python -m benchmarks.snapshot
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_fx_rates, synthetic_quote_table
+from tinvest_analysis.fx import FxRates
+from tinvest_analysis.processing import ts_briefcase_ticker_prices, enrichment_ticker_prices
+from tinvest_analysis.snapshot import PanelSnapshot, update_panel
+from tinvest_analysis.utils.cache import StageCache
+
+
+def _sorted(df):
+    return df.sort_values(by=['isin', 'date']).reset_index(drop=True)
+
+
+def main(n_instruments=200, years=5, new_days=1):
+    operations = synthetic_operations(n_instruments, years=years)
+    quotes = synthetic_quote_table(n_instruments, years + 1)
+    cut = operations['dt'].max().normalize() - pd.Timedelta(days=new_days - 1)
+
+    start = time.perf_counter()
+    full = enrichment_ticker_prices(ts_briefcase_ticker_prices(operations), quotes)
+    full_time = time.perf_counter() - start
+    print(f'{n_instruments} instruments x {years} years, {len(full)} panel rows, {new_days} new days')
+    print(f'full: {full_time:.3f} s')
+
+    with tempfile.TemporaryDirectory() as root:
+        # панель снимка из файлов по годам (кэш выключен) и из кэша шагов
+        for name, cache in (('snapshot files', None), ('stage cache', StageCache(Path(root) / 'cache'))):
+            snapshot = PanelSnapshot(name.replace(' ', '_'), root=root)
+            # снимок предыдущего запуска: операции до cut
+            update_panel(operations[operations['dt'] < cut], quotes, snapshot, cache=cache)
+            start = time.perf_counter()
+            incremental = update_panel(operations, quotes, snapshot, cache=cache)
+            incremental_time = time.perf_counter() - start
+            pd.testing.assert_frame_equal(_sorted(incremental), _sorted(full)[incremental.columns], check_dtype=False)
+            print(f'incremental, {name}: {incremental_time:.3f} s')
+
+        # другие курсы валют: снимок строится заново
+        fx_rates = FxRates(synthetic_fx_rates(years + 1))
+        start = time.perf_counter()
+        rebuilt = update_panel(operations, quotes, snapshot, cache=cache, fx_rates=fx_rates)
+        print(f'fx rates changed, rebuild: {time.perf_counter() - start:.3f} s')
+        pd.testing.assert_frame_equal(_sorted(rebuilt), _sorted(full)[rebuilt.columns], check_dtype=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Сравнение учета дроблений через таблицу коэффициентов (apply_split_factors) с прежним циклом по дроблениям.
+
+Запуск: python -m benchmarks.splits
+"""
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, synthetic_splits, timeit
+from tinvest_analysis.processing import split_factors, apply_split_factors
+
+
+def apply_splits_loop(operations, splits) -> pd.DataFrame:
+    """
+    Прежняя реализация из load_operations: две маски и две записи .loc на каждое дробление.
+    """
+    operations = operations.copy()
+    for split_event in splits:
+        mask = \
+            (operations['isin'] == split_event['isin']) \
+            & (operations['dt'].dt.normalize() <= pd.Timestamp(split_event['date']))
+        operations.loc[mask, 'count'] = operations.loc[mask, 'count'].mul(split_event['ratio'])
+        operations.loc[mask, 'unit_price'] = operations.loc[mask, 'unit_price'].div(split_event['ratio'])
+    return operations
+
+
+def _vectorized(operations, splits):
+    return apply_split_factors(operations, split_factors(splits), 'dt', multiply=['count'], divide=['unit_price'])
+
+
+def main(n_instruments=500, sizes=(10, 100, 1000)):
+    operations = synthetic_operations(n_instruments, years=5)
+    print(f'{len(operations)} operations')
+    print(f'{"splits":>8} {"loop, s":>10} {"vectorized, s":>14} {"speedup":>8}')
+    for n_splits in sizes:
+        splits = synthetic_splits(operations, n_splits)
+        # произведение коэффициентов вместо последовательного умножения - отличие только в округлении float
+        pd.testing.assert_frame_equal(_vectorized(operations, splits), apply_splits_loop(operations, splits))
+        loop_time = timeit(apply_splits_loop, operations, splits)
+        vectorized_time = timeit(_vectorized, operations, splits)
+        print(f'{n_splits:>8} {loop_time:>10.3f} {vectorized_time:>14.3f} {loop_time / vectorized_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Время импорта точки входа (python -X importtime) по командам main.py. Для команды report проверяется бюджет:
+суммарное время импорта не больше --budget-ms и без загрузчиков и графических библиотек.
+При нарушении команда завершается с кодом 1.
+
+Запуск: python -m benchmarks.startup --budget-ms 1000
+"""
+import argparse
+import subprocess
+import sys
+
+from tinvest_analysis.utils.fs import ROOT_DIR
+
+# что импортирует каждая команда сверх main (зависимости, которые подгружаются при выполнении)
+COMMAND_IMPORTS = {
+    'report': [],
+    'chart': ['tinvest_analysis.charts'],
+    'sync': ['tinvest_analysis.loaders.tinkoff'],
+    'quotes': ['tinvest_analysis.loaders.investfound'],
+}
+# модули, которых не должно быть при запуске отчета по локальным данным
+REPORT_FORBIDDEN = ('matplotlib', 'seaborn', 'tinvest', 'requests', 'lxml', 'tqdm')
+
+
+def import_time(modules) -> dict:
+    """
+    Импортирует модули в отдельном процессе.
+    :return: суммарное время импорта (мс) и список всех загруженных модулей
+    """
+    code = '\n'.join([f'import {module}' for module in modules] + ['import sys', 'print("\\n".join(sys.modules))'])
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT_DIR,
+                             capture_output=True, text=True, check=True)
+    total_us = 0
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | имя; вложенные импорты - с отступом
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+    return {'ms': total_us / 1000, 'modules': set(process.stdout.split())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время импорта main.py по командам')
+    parser.add_argument('--budget-ms', type=float, default=1000, help='бюджет времени импорта для report')
+    parser.add_argument('--repeat', type=int, default=3, help='берется лучшее время из N запусков')
+    args = parser.parse_args()
+
+    failures = []
+    for command, extra in COMMAND_IMPORTS.items():
+        runs = [import_time(['main', *extra]) for _ in range(args.repeat)]
+        best = min(run['ms'] for run in runs)
+        print(f'{command:>8}: {best:7.0f} ms')
+        if command != 'report':
+            continue
+        loaded = sorted(x for x in REPORT_FORBIDDEN if x in runs[0]['modules'])
+        if loaded:
+            failures.append(f'report импортирует {", ".join(loaded)}')
+        if best > args.budget_ms:
+            failures.append(f'report: {best:.0f} ms > бюджета {args.budget_ms:.0f} ms')
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
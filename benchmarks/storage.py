@@ -0,0 +1,74 @@
+"""
+Время загрузки котировок из CSV и Parquet хранилищ и чтения операций, дописанных месячными окнами
+(как при синхронизации), до и после слияния частей.
+
+Запуск: python -m benchmarks.storage
+"""
+import datetime as dt
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.synthetic import SYNTHETIC_ACCOUNT, broker_operations, synthetic_quotes, timeit
+from tinvest_analysis.utils.storage import CsvStorage, ParquetStorage, migrate
+
+
+def main(n_instruments=300, years=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        csv_storage = CsvStorage(quotes_dir=tmp / 'investfunds', operations_dir=tmp / 'tinkoff')
+        parquet_storage = ParquetStorage(root=tmp / 'parquet')
+        for isin, quotes in synthetic_quotes(n_instruments, years):
+            csv_storage.write_quotes(isin, quotes)
+        migrate(csv_storage, parquet_storage, accounts=[])
+
+        date_from = dt.date.today() - dt.timedelta(days=90)
+        cases = {
+            'all columns': dict(),
+            'dt, close_price': dict(columns=['dt', 'close_price']),
+            'last 90 days': dict(date_from=date_from),
+        }
+        print(f'{n_instruments} instruments x {years} years')
+        print(f'{"case":>16} {"csv, s":>8} {"parquet, s":>11} {"speedup":>8}')
+        for name, kwargs in cases.items():
+            expected = csv_storage.read_quotes(**kwargs).sort_values(by=['isin', 'dt']).reset_index(drop=True)
+            actual = parquet_storage.read_quotes(**kwargs).sort_values(by=['isin', 'dt']).reset_index(drop=True)
+            pd.testing.assert_frame_equal(actual[expected.columns], expected, check_dtype=False)
+
+            csv_time = timeit(lambda: csv_storage.read_quotes(**kwargs))
+            parquet_time = timeit(lambda: parquet_storage.read_quotes(**kwargs))
+            print(f'{name:>16} {csv_time:>8.3f} {parquet_time:>11.3f} {csv_time / parquet_time:>7.1f}x')
+
+        # полная синхронизация за years лет: по части на каждое месячное окно
+        operations = broker_operations(n_instruments, years).sort_values(by='dt')
+        parquet_storage.write_operations(SYNTHETIC_ACCOUNT, operations.iloc[:0])
+        for _, window in operations.groupby(operations['dt'].dt.to_period('M')):
+            parquet_storage.append_operations(SYNTHETIC_ACCOUNT, window)
+        partition = parquet_storage._operations_partition(SYNTHETIC_ACCOUNT)
+        parts = len(list(partition.glob('*.parquet')))
+        expected = parquet_storage.read_operations(SYNTHETIC_ACCOUNT).sort_values(by='id').reset_index(drop=True)
+        windows_time = timeit(lambda: parquet_storage.read_operations(SYNTHETIC_ACCOUNT))
+        parquet_storage.compact_operations(SYNTHETIC_ACCOUNT)
+        actual = parquet_storage.read_operations(SYNTHETIC_ACCOUNT).sort_values(by='id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(actual, expected)
+        compact_time = timeit(lambda: parquet_storage.read_operations(SYNTHETIC_ACCOUNT))
+        print(f'{len(operations)} operations: {parts} parts {windows_time:.3f} s, '
+              f'{len(list(partition.glob("*.parquet")))} part after compaction {compact_time:.3f} s')
+
+        # перенос в обе стороны между хранилищами в своих папках: счета берутся из папки исходного хранилища
+        other_csv = CsvStorage(quotes_dir=tmp / 'csv' / 'investfunds', operations_dir=tmp / 'csv' / 'tinkoff')
+        assert other_csv.accounts() == [] and csv_storage.accounts() == []
+        migrate(parquet_storage, other_csv)
+        assert other_csv.accounts() == parquet_storage.accounts() == [SYNTHETIC_ACCOUNT]
+        other_parquet = ParquetStorage(root=tmp / 'parquet_copy')
+        migrate(other_csv, other_parquet)
+        assert other_parquet.accounts() == [SYNTHETIC_ACCOUNT]
+        assert other_parquet.quote_isins() == csv_storage.quote_isins()
+        pd.testing.assert_frame_equal(
+            other_parquet.read_operations(SYNTHETIC_ACCOUNT).sort_values(by='id').reset_index(drop=True),
+            expected, check_dtype=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Время и пиковая память каждого шага расчета на синтетическом портфеле (benchmarks.synthetic), без сети.
+Результат сохраняется в JSON; с --compare сравнивается с прошлым запуском и завершается с кодом 1,
+если какой-то шаг стал медленнее порога.
+
+Запуск: python -m benchmarks.suite --instruments 300 --years 5 --compare artifacts/benchmarks/baseline.json
+"""
+import argparse
+import datetime as dt
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import SYNTHETIC_ACCOUNT, write_dataset
+from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, correlation_type_profit, \
+    profit_by_ticker
+from tinvest_analysis.lots import match_lots, lot_positions
+from tinvest_analysis.metrics import daily_returns, rolling_metrics
+from tinvest_analysis.processing import load_operations, load_financial_quotes, ts_briefcase_ticker_prices, \
+    enrichment_ticker_prices
+from tinvest_analysis.utils.fs import ARTIFACTS_DIR
+
+
+def measure(func, *args, repeat=3):
+    """
+    Лучшее время из repeat запусков и пиковая память одного запуска (tracemalloc, включая массивы NumPy).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = result[0] if isinstance(result, tuple) else result
+    return result, {'seconds': best, 'peak_mb': peak / 2 ** 20, 'rows': len(rows)}
+
+
+def run(n_instruments=300, years=5, trades_per_instrument=20, n_splits=10, seed=0, repeat=3) -> dict:
+    stages = {}
+    with tempfile.TemporaryDirectory() as root:
+        storage, splits = write_dataset(root, n_instruments, years, trades_per_instrument, n_splits, seed)
+        operations, stages['load_operations'] = measure(
+            load_operations, SYNTHETIC_ACCOUNT, splits, storage, repeat=repeat)
+        quotes, stages['load_financial_quotes'] = measure(load_financial_quotes, storage, repeat=repeat)
+    panel, stages['ts_briefcase_ticker_prices'] = measure(ts_briefcase_ticker_prices, operations, repeat=repeat)
+    _, stages['match_lots'] = measure(match_lots, operations, 'fifo', repeat=repeat)
+    _, stages['lot_positions'] = measure(lot_positions, operations, 'fifo', repeat=repeat)
+    panel, stages['enrichment_ticker_prices'] = measure(enrichment_ticker_prices, panel, quotes, repeat=repeat)
+    _, stages['investment_type_ration'] = measure(investment_type_ration, panel, repeat=repeat)
+    (profit_by_type_date, _), stages['investment_type_profit'] = measure(investment_type_profit, panel, repeat=repeat)
+    _, stages['correlation_type_profit'] = measure(correlation_type_profit, profit_by_type_date, repeat=repeat)
+    _, stages['profit_by_ticker'] = measure(profit_by_ticker, panel, repeat=repeat)
+    returns, stages['daily_returns'] = measure(daily_returns, panel, 'ticker', repeat=repeat)
+    _, stages['rolling_metrics'] = measure(rolling_metrics, returns, repeat=repeat)
+    return {
+        'created': dt.datetime.now().isoformat(timespec='seconds'),
+        'params': {'instruments': n_instruments, 'years': years, 'trades': trades_per_instrument,
+                   'splits': n_splits, 'seed': seed, 'repeat': repeat},
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                        'machine': platform.machine()},
+        'stages': stages,
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float = 1.25, min_delta: float = 0.01) -> list:
+    """
+    Печатает сравнение с прошлым запуском и возвращает шаги, ставшие медленнее в threshold раз и более.
+    :param min_delta: разница во времени меньше min_delta секунд считается шумом
+    """
+    if result['params'] != baseline['params']:
+        print(f'Внимание: параметры запусков отличаются: {baseline["params"]} -> {result["params"]}')
+    report = pd.DataFrame({
+        'baseline, s': {stage: value['seconds'] for stage, value in baseline['stages'].items()},
+        'current, s': {stage: value['seconds'] for stage, value in result['stages'].items()},
+        'baseline, MB': {stage: value['peak_mb'] for stage, value in baseline['stages'].items()},
+        'current, MB': {stage: value['peak_mb'] for stage, value in result['stages'].items()},
+    })
+    report['time ratio'] = report['current, s'] / report['baseline, s']
+    print(report.round(3).to_string())
+    slower = (report['time ratio'] >= threshold) & (report['current, s'] - report['baseline, s'] >= min_delta)
+    return list(report.index[slower])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время и память шагов расчета на синтетическом портфеле')
+    parser.add_argument('--instruments', type=int, default=300)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--trades', type=int, default=20, help='сделок по каждой бумаге')
+    parser.add_argument('--splits', type=int, default=10, help='число дроблений')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=Path, help='куда сохранить JSON (по умолчанию artifacts/benchmarks)')
+    parser.add_argument('--compare', type=Path, help='JSON прошлого запуска для сравнения')
+    parser.add_argument('--threshold', type=float, default=1.25, help='во сколько раз медленнее - регрессия')
+    parser.add_argument('--min-delta', type=float, default=0.01, help='меньшая разница в секундах - шум')
+    args = parser.parse_args()
+
+    result = run(args.instruments, args.years, args.trades, args.splits, args.seed, args.repeat)
+    output = args.output or ARTIFACTS_DIR / 'benchmarks' / f'{dt.datetime.now():%Y%m%d-%H%M%S}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(pd.DataFrame(result['stages']).T.round(3).to_string())
+    print(f'Результат сохранен в {output}')
+
+    if args.compare is not None:
+        regressions = compare(result, json.loads(args.compare.read_text()), args.threshold, args.min_delta)
+        if regressions:
+            print(f'Регрессия (>= {args.threshold}x): {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Детерминированный генератор синтетического портфеля: операции, дробления и котировки, а также общий для всех
+бенчмарков замер времени.
+Даты отсчитываются от текущего дня, чтобы панель портфеля (до T-1) имела один и тот же размер в любой день.
+"""
+import datetime as dt
+import time
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.utils.storage import CsvStorage
+
+
+# имя счета, под которым write_dataset сохраняет операции
+SYNTHETIC_ACCOUNT = 'synthetic'
+
+
+def synthetic_operations(n_instruments, years=3, trades_per_instrument=20, seed=0) -> pd.DataFrame:
+    """
+    Случайный портфель в формате load_operations: покупки и частичные продажи.
+    """
+    rng = np.random.default_rng(seed)
+    end = dt.datetime.combine(dt.date.today(), dt.time()) - dt.timedelta(days=1)
+    start = end - dt.timedelta(days=365 * years)
+    n = n_instruments * trades_per_instrument
+    instrument = np.repeat(np.arange(n_instruments), trades_per_instrument)
+    offsets = rng.integers(0, (end - start).days * 24 * 3600, size=n)
+    count = rng.integers(1, 50, size=n).astype(float)
+    # каждая третья сделка - продажа, но не больше, чем было куплено
+    is_sell = rng.random(n) < 0.3
+    operations = pd.DataFrame({
+        'dt': pd.Timestamp(start) + pd.to_timedelta(offsets, unit='s'),
+        'isin': [f'XX{i:010d}' for i in instrument],
+        'figi': [f'BBG{i:09d}' for i in instrument],
+        'ticker': [f'T{i}' for i in instrument],
+        'instrument_type': np.array(['Stock', 'Bond', 'Etf'])[instrument % 3],
+        'operation_type': np.where(is_sell, 'sell', 'buy'),
+        'count': count,
+        'unit_price': rng.uniform(10, 1000, size=n).round(2),
+    }).sort_values(by=['isin', 'dt'], kind='stable')
+    sell = operations['operation_type'] == 'sell'
+    # продано с начала истории не больше, чем куплено к моменту продажи: накопленные продажи ограничиваются
+    # накопленными покупками, а накопленный максимум сохраняет их неубывающими
+    bought = operations['count'].where(~sell, 0.0).groupby(operations['isin']).cumsum()
+    wanted = operations['count'].where(sell, 0.0).groupby(operations['isin']).cumsum()
+    sold = np.minimum(wanted, bought).groupby(operations['isin']).cummax()
+    operations.loc[sell, 'count'] = sold.groupby(operations['isin']).diff().fillna(sold)[sell]
+    operations = operations[operations['count'] > 0].copy()
+    operations.loc[operations['operation_type'] == 'sell', 'count'] *= -1
+    operations['total_price'] = -operations['count'] * operations['unit_price']
+    return operations.sort_values(by='dt').reset_index(drop=True)
+
+
+
+def dual_listed_operations(n_instruments, years=3, trades_per_instrument=20, seed=0) -> pd.DataFrame:
+    """
+    Портфель, в котором каждая вторая бумага торгуется под двумя листингами (как на СПБ и Мосбирже):
+    часть сделок идет под вторым figi/тикером, в том числе в один день со сделками под первым.
+    """
+    rng = np.random.default_rng(seed + 2)
+    operations = synthetic_operations(n_instruments, years, trades_per_instrument, seed)
+    dual = operations['isin'].str[-1].astype(int) % 2 == 0
+    # сделка под вторым листингом в тот же день, что и сделка под первым
+    same_day = operations[dual & (rng.random(len(operations)) < 0.2)]\
+        .assign(dt=lambda df: df['dt'].dt.normalize() + pd.Timedelta(hours=23))
+    operations = pd.concat([operations, same_day], axis=0, ignore_index=True)
+    second = dual.reindex(operations.index, fill_value=True) & (rng.random(len(operations)) < 0.4)
+    second.iloc[-len(same_day):] = True
+    operations.loc[second, 'figi'] += 'S'
+    operations.loc[second, 'ticker'] += '@US'
+    return operations.sort_values(by='dt', kind='stable').reset_index(drop=True)
+
+def broker_operations(n_instruments, years=3, trades_per_instrument=20, card_share=0.1, seed=0) -> pd.DataFrame:
+    """
+    Те же сделки в формате хранилища (Tinkoff.get_operations): индекс id, положительные count,
+    часть покупок - buy_card, комиссия брокера 0.05%.
+    """
+    rng = np.random.default_rng(seed + 1)
+    operations = synthetic_operations(n_instruments, years, trades_per_instrument, seed)
+    buy = operations['operation_type'] == 'buy'
+    operations.loc[buy & (rng.random(len(operations)) < card_share), 'operation_type'] = 'buy_card'
+    operations['count'] = operations['count'].abs()
+    operations['commission'] = (-0.0005 * operations['total_price'].abs()).round(2)
+    operations['id'] = [str(100000000 + i) for i in range(len(operations))]
+    return operations.set_index('id')[[
+        'commission', 'total_price', 'unit_price', 'count', 'figi', 'instrument_type', 'dt', 'operation_type',
+        'ticker', 'isin']]
+
+
+def synthetic_splits(operations, n_splits, seed=0) -> List[dict]:
+    """
+    Дробления и обратные дробления случайных бумаг портфеля, в том числе несколько дроблений одной бумаги.
+    """
+    rng = np.random.default_rng(seed)
+    isins = operations['isin'].unique()
+    dates = pd.to_datetime(rng.integers(operations['dt'].min().value, operations['dt'].max().value, size=n_splits))
+    return [
+        {'isin': isin, 'date': date.date(), 'ratio': ratio}
+        for isin, date, ratio in zip(
+            rng.choice(isins, size=n_splits),
+            dates,
+            rng.choice([2, 3, 10, 100, 0.1, 0.5], size=n_splits))
+    ]
+
+
+def synthetic_quotes(n_instruments, years=5, seed=0) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """
+    Дневные котировки в формате InvestTypeBase.chartData для каждой бумаги.
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(dt.date.today()) + pd.Timedelta(hours=3)
+    dates = pd.date_range(end=end, periods=365 * years, freq='1D')
+    for i in range(n_instruments):
+        returns = rng.normal(0, 0.02, size=len(dates))
+        yield f'XX{i:010d}', pd.DataFrame({
+            'dt': dates,
+            'close_price': (100 * np.exp(np.cumsum(returns))).round(4),
+            'investemnt_object_type': rng.choice(['Акции', 'Облигации', 'Золото']),
+            'geography': rng.choice(['Россия', 'США', None]),
+            'currency': rng.choice(['RUB', 'USD']),
+        })
+
+
+def synthetic_quote_table(n_instruments, years=5, seed=0) -> pd.DataFrame:
+    """
+    Котировки synthetic_quotes одной таблицей в формате load_financial_quotes (колонки date и isin).
+    """
+    return pd.concat([
+        df.rename(columns={'dt': 'date'}).assign(isin=isin, date=lambda x: x['date'].dt.normalize())
+        for isin, df in synthetic_quotes(n_instruments, years, seed)
+    ], ignore_index=True)
+
+
+def synthetic_fx_rates(years=5, currencies=('USD', 'EUR', 'CNY'), seed=0) -> pd.DataFrame:
+    """
+    Дневные курсы валют к рублю в формате tinvest_analysis.fx (date, currency, rate), без выходных.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=pd.Timestamp(dt.date.today()), periods=260 * years)
+    start_rate = {'USD': 75.0, 'EUR': 85.0, 'CNY': 11.0}
+    return pd.concat([
+        pd.DataFrame({
+            'date': dates,
+            'currency': currency,
+            'rate': (start_rate.get(currency, 50.0) * np.exp(np.cumsum(rng.normal(0, 0.006, size=len(dates))))).round(4),
+        })
+        for currency in currencies
+    ], ignore_index=True)
+
+
+def write_dataset(root: Path, n_instruments, years=3, trades_per_instrument=20, n_splits=10,
+                  seed=0) -> Tuple[CsvStorage, List[dict]]:
+    """
+    Сохраняет синтетические операции (счет SYNTHETIC_ACCOUNT) и котировки в CSV-хранилище в папке root.
+    Котировки начинаются на год раньше первой операции.
+    :return: хранилище и список дроблений в формате stock_splits из config.yaml
+    """
+    root = Path(root)
+    storage = CsvStorage(quotes_dir=root / 'investfunds', operations_dir=root / 'tinkoff')
+    operations = broker_operations(n_instruments, years, trades_per_instrument, seed=seed)
+    storage.write_operations(SYNTHETIC_ACCOUNT, operations)
+    for isin, quotes in synthetic_quotes(n_instruments, years + 1, seed):
+        storage.write_quotes(isin, quotes)
+    return storage, synthetic_splits(operations, n_splits, seed)
+
+
+def timeit(func, *args, repeat=3) -> float:
+    """
+    Лучшее время (в секундах) из repeat вызовов func(*args).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,77 @@
+"""
+Сравнение векторизованного ts_briefcase_ticker_prices с прежней реализацией (цикл по бумагам).
+
+Запуск: python -m benchmarks.ts_briefcase_ticker_prices
+"""
+
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_operations, dual_listed_operations, timeit
+from tinvest_analysis.processing import get_indexes, ts_briefcase_ticker_prices
+
+
+def ts_briefcase_ticker_prices_loop(operations) -> pd.DataFrame:
+    """
+    Прежняя реализация: отдельный merge + ffill для каждой бумаги.
+    """
+    operations = operations.copy()
+    datetime_range = get_indexes(operations)
+    operations['date'] = operations['dt'].dt.date.astype('datetime64[ns]')
+    ts_aggregate = operations\
+        .groupby(['date', 'isin', 'figi', 'ticker', 'instrument_type'], as_index=False)\
+        .agg(
+            quantity=('count', 'sum'),
+            balance_change=('total_price', 'sum')
+        )\
+        .sort_values(by='date', kind='stable')
+    grouped_data = ts_aggregate.groupby(['isin', 'figi', 'ticker', 'instrument_type'])
+    ts_aggregate['buy_price'] = (-1) * grouped_data['balance_change'].cumsum()
+    ts_aggregate['quantity'] = grouped_data['quantity'].cumsum()
+
+    unique_isin = ts_aggregate['isin'].unique()
+    ticker_prices = []
+    for isin in unique_isin:
+        base_date = pd.DataFrame(data=datetime_range, columns=['date'])
+        isin_operations = ts_aggregate[ts_aggregate['isin'] == isin]
+        ticker_price = pd.merge(base_date, isin_operations, on='date', how='left')\
+            .ffill()\
+            .dropna(subset=['isin', 'figi', 'ticker'])\
+            .drop(columns=['balance_change'])
+        ticker_price['date'] = ticker_price['date'].dt.date
+        ticker_price = ticker_price[ticker_price['quantity'] > 0]
+        ticker_price['avg_price'] = ticker_price['buy_price'] / ticker_price['quantity']
+        ticker_prices.append(ticker_price)
+    ticker_prices = pd.concat(ticker_prices, axis=0)
+    return ticker_prices
+
+
+def _normalize(df):
+    return df\
+        .assign(date=pd.to_datetime(df['date']))\
+        .sort_values(by=['isin', 'date'], kind='stable')\
+        .reset_index(drop=True)[['date', 'isin', 'figi', 'ticker', 'instrument_type',
+                                 'quantity', 'buy_price', 'avg_price']]
+
+
+def main(sizes=(10, 100, 1000)):
+    # бумаги под двумя figi/тикерами: строки и атрибуты листингов совпадают с прежней реализацией
+    operations = dual_listed_operations(50)
+    expected = _normalize(ts_briefcase_ticker_prices_loop(operations))
+    actual = _normalize(ts_briefcase_ticker_prices(operations))
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    print(f'{"instruments":>12} {"loop, s":>10} {"vectorized, s":>14} {"speedup":>8}')
+    for n_instruments in sizes:
+        operations = synthetic_operations(n_instruments)
+        expected = _normalize(ts_briefcase_ticker_prices_loop(operations))
+        actual = _normalize(ts_briefcase_ticker_prices(operations))
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+        repeat = 1 if n_instruments >= 1000 else 3
+        loop_time = timeit(ts_briefcase_ticker_prices_loop, operations, repeat=repeat)
+        vectorized_time = timeit(ts_briefcase_ticker_prices, operations, repeat=repeat)
+        print(f'{n_instruments:>12} {loop_time:>10.3f} {vectorized_time:>14.3f} {loop_time / vectorized_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
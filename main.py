@@ -1,14 +1,25 @@
+import argparse
 import datetime as dt
 from pathlib import Path
 
 import pandas as pd
 import yaml
 
-from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, correlation_type_profit, \
-    profit_by_ticker
+from tinvest_analysis.analysis import PanelIndex
+from tinvest_analysis.fx import FxRates, BASE_CURRENCY, cash_balances, convert_operations
+from tinvest_analysis.pipeline import build_panel, build_reports, print_reports, save_charts, compact_stage, run_batch
 from tinvest_analysis.processing import parse_broker_operations, parse_financial_quote, input_choosing_accounts, \
-    load_operations, load_financial_quotes, enrichment_ticker_prices
-from tinvest_analysis.charts import plot_profit_all_time
+    load_operations, load_financial_quotes, load_cash_balances
+from tinvest_analysis.snapshot import PanelSnapshot
+from tinvest_analysis.utils.cache import StageCache
+from tinvest_analysis.utils.fs import ARTIFACTS_DIR, FX_RATES_PATH
+from tinvest_analysis.utils.metadata import MetadataStore
+from tinvest_analysis.utils.profiling import profiler, code_profile
+from tinvest_analysis.utils.storage import get_storage, Storage
+
+# Тяжелые зависимости импортируются там, где нужны: загрузчики (tinvest, requests, lxml) - в sync и quotes,
+# matplotlib - при сохранении графиков. Бюджет времени запуска report: python -m benchmarks.startup
+COMMANDS = ('sync', 'quotes', 'report', 'chart')
 
 
 def read_config(path):
@@ -16,95 +27,164 @@ def read_config(path):
         return yaml.safe_load(file)
 
 
-def get_indexes(operations):
+def _metadata(config):
+    return MetadataStore(**config.get('metadata', {}))
+
+
+def _fx_rates(config):
     """
-    Возвращает список дат, между первой операцией и текущем днем недели
-    :param operations:
-    :return:
+    Курсы валют из файла fx.rates (по умолчанию data/fx/rates.csv); без файла - None.
     """
-    min_date = operations['dt'].dt.date.min()
-    # будем всегда смотреть на отчет Т-1
-    today = dt.date.today() - dt.timedelta(days=1)
-    # будет являться индексом для нового DataFrame
-    datetime_range = pd.date_range(start=min_date, end=today, freq='1D')
-    return datetime_range
-
-
-# REF
-def ts_briefcase_ticker_prices(operations) -> pd.DataFrame:
-    operations = operations.copy()
-    datetime_range = get_indexes(operations)
-    # считаем данные по каждому тикеру в разрезе дней
-    operations['date'] = operations['dt'].dt.date.astype('datetime64[ns]')
-    ts_aggregate = operations\
-        .groupby(['date', 'isin', 'figi', 'ticker', 'instrument_type'], as_index=False)\
-        .agg(
-            quantity=('count', 'sum'),
-            balance_change=('total_price', 'sum')
-        )\
-        .sort_values(by='date')
-    # умножаем на (-1) поскольку считаем текущую (по покупкам) цену
-    grouped_data = ts_aggregate.groupby(['isin', 'figi', 'ticker', 'instrument_type'])
-    ts_aggregate['buy_price'] = (-1) * grouped_data['balance_change'].cumsum()
-    ts_aggregate['quantity'] = grouped_data['quantity'].cumsum()
-
-    # для каждой ценной бумаги считаем прибыльность по каждому дню
-    # уникальный список акций
-    unique_isin = ts_aggregate['isin'].unique()
-    ticker_prices = []
-    for isin in unique_isin:
-        base_date = pd.DataFrame(data=datetime_range, columns=['date'])
-        isin_operations = ts_aggregate[ts_aggregate['isin'] == isin]
-        ticker_price = pd.merge(base_date, isin_operations, on='date', how='left')\
-            .ffill()\
-            .dropna(subset=['isin', 'figi', 'ticker'])\
-            .drop(columns=['balance_change'])
-        ticker_price['date'] = ticker_price['date'].dt.date
-        # если бумага была продана полностью, то далее ее не рассматриваем
-        ticker_price = ticker_price[ticker_price['quantity'] > 0]
-        # считаем среднюю цену акции
-        ticker_price['avg_price'] = ticker_price['buy_price'] / ticker_price['quantity']
-        ticker_prices.append(ticker_price)
-    ticker_prices = pd.concat(ticker_prices, axis=0)
-    return ticker_prices
-
-
-def main(config):
-    token = config['tinkoff']['token']
-    splits = config['stock_splits']
+    fx_config = config.get('fx') or {}
+    path = Path(fx_config.get('rates') or FX_RATES_PATH)
+    if not path.exists():
+        return None
+    return FxRates.load(path, fx_config.get('base_currency', BASE_CURRENCY))
 
-    accounts = parse_broker_operations(token)
-    selected_account = input_choosing_accounts(accounts)
-    parse_financial_quote(selected_account)
 
-    operations = load_operations(selected_account, splits)
-    # TODO: необходимо учитывать бумаги в валюте (не рублях)
-    # TODO: необходимо учитывать наличие валютных запасов (USD, EUR, etc.)
-    briefcase_ticker_price = ts_briefcase_ticker_prices(operations)
+def _http_session(config):
+    """
+    Запись или воспроизведение ответов загрузчиков (секция http); модуль с requests импортируется только здесь.
+    """
+    from tinvest_analysis.loaders.transport import http_session
 
-    quotes = load_financial_quotes()
-    briefcase_ticker_price = enrichment_ticker_prices(briefcase_ticker_price, quotes)
+    return http_session(**(config.get('http') or {}))
 
-    type_ration = investment_type_ration(briefcase_ticker_price)
-    print('Процентное соотношение по типам активов:', type_ration, sep='\n')
-    print()
-    profit_by_type_date, type_profit_agg = investment_type_profit(briefcase_ticker_price)
-    print('Прибыль по типам активов:', type_profit_agg, sep='\n')
-    print()
-    corr_type_profit = correlation_type_profit(profit_by_type_date)
-    print('Корреляция прибыли по типам активов:', corr_type_profit, sep='\n')
-    print()
-    profit_by_ticker_agg = profit_by_ticker(briefcase_ticker_price)
-    print('Прибыли текущих активов:', profit_by_ticker_agg, sep='\n')
 
-    profit_by_date_chart = plot_profit_all_time(briefcase_ticker_price, operations)
-    profit_by_date_chart.savefig('artifacts/all_profit.png')
+def sync(config, storage: Storage) -> list:
+    """
+    Загрузка новых операций по всем счетам из Тинькофф.
+    """
+    metadata = _metadata(config)
+    # остальные настройки tinkoff - параметры синхронизации и клиента API
+    tinkoff_options = {key: value for key, value in config['tinkoff'].items() if key != 'token'}
+    with _http_session(config) as session:
+        accounts = parse_broker_operations(config['tinkoff']['token'], metadata, storage=storage, session=session,
+                                           **tinkoff_options)
+    print(metadata.report())
+    return accounts
+
+
+def quotes(config, storage: Storage, accounts: list):
+    """
+    Загрузка котировок бумаг из операций accounts с investfunds.ru.
+    """
+    metadata = _metadata(config)
+    with _http_session(config) as session:
+        parse_financial_quote(accounts, metadata, storage=storage, session=session, **config.get('investfunds', {}))
+    print(metadata.report())
+
+
+def report(config, storage: Storage, accounts: list, batch=False, no_cache=False, rebuild=False,
+           reports=True, chart=True):
+    """
+    Отчеты и график доходности по сохраненным операциям и котировкам, без обращения к сети.
+    :param reports: печатать отчеты
+    :param chart: сохранять графики доходности (портфель, типы активов, бумаги при charts.by_ticker)
+        в artifacts/charts/{счет}
+    """
+    splits = config['stock_splits']
+    compact = config.get('compact_panel', False)
+    incremental = config.get('snapshot', {}).get('enabled', False)
+    reprice_days = config.get('snapshot', {}).get('reprice_days', 7)
+    cost_basis = config.get('cost_basis')
+    fx_rates = _fx_rates(config)
+    cache_config = config.get('cache', {})
+    cache = StageCache(
+        max_size_mb=cache_config.get('max_size_mb', 1024),
+        enabled=cache_config.get('enabled', True) and not no_cache,
+        rebuild=rebuild)
+
+    financial_quotes = cache.run('load_financial_quotes', load_financial_quotes, storage)
+    financial_quotes = compact_stage('load_financial_quotes', financial_quotes, compact)
+
+    if batch:
+        results = run_batch(accounts, splits, storage, financial_quotes, config.get('batch', {}).get('max_workers'),
+                            compact, incremental, reprice_days, cache, chart, cost_basis,
+                            fx_rates, config.get('charts', {}))
+        if reports:
+            for name, account_reports in results.items():
+                print(f'===== {name} =====')
+                print_reports(account_reports)
+                print()
+        return
+
+    operations = cache.run('load_operations', load_operations, accounts[0], splits, storage)
+    snapshot = PanelSnapshot(accounts[0]) if incremental else None
+    briefcase_ticker_price = build_panel(operations, financial_quotes, compact, snapshot, reprice_days, cache,
+                                         cost_basis, fx_rates)
+    print(cache.report())
+    # сортировка панели и суммы по дням и типам активов - одни для отчетов и графиков
+    panel = PanelIndex(briefcase_ticker_price)
+    if reports:
+        cash = cash_balances(load_cash_balances(accounts[:1]), fx_rates)
+        print_reports(build_reports(panel, cash))
+    if chart:
+        # суммы покупок на графиках - в валюте отчета, как и панель
+        render_times = save_charts(panel, convert_operations(operations, fx_rates),
+                                   ARTIFACTS_DIR / 'charts' / accounts[0],
+                                   **config.get('charts', {}))
+        print(f'Графики ({len(render_times)} шт., {render_times["seconds"].sum():.1f} с отрисовки):')
+        print(render_times.sort_values(by='seconds', ascending=False).head(10).to_string(index=False))
+
+
+def main(config, command=None, batch=False, account=None, no_cache=False, rebuild=False):
+    """
+    :param command: sync, quotes, report, chart или None - все шаги по очереди
+    :param account: счет для quotes, report и chart; по умолчанию выбирается в консоли (quotes - все счета)
+    """
+    storage = get_storage(config.get('storage', {}).get('backend', 'csv'))
+    if command in (None, 'sync'):
+        accounts = sync(config, storage)
+        if command == 'sync':
+            return
+    else:
+        accounts = storage.accounts()
+        if not accounts:
+            raise FileNotFoundError('Нет сохраненных операций, сначала запустите: python main.py sync')
+
+    if account is not None:
+        selected_accounts = [account]
+    elif batch or command == 'quotes':
+        selected_accounts = accounts
+    else:
+        selected_accounts = [input_choosing_accounts(accounts)]
+
+    if command in (None, 'quotes'):
+        quotes(config, storage, selected_accounts)
+        if command == 'quotes':
+            return
+    report(config, storage, selected_accounts, batch, no_cache, rebuild,
+           reports=command != 'chart', chart=command != 'report')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=COMMANDS,
+                        help='sync - операции из Тинькофф, quotes - котировки, report - отчеты, chart - график; '
+                             'без команды выполняются все шаги')
+    parser.add_argument('--account', help='счет для quotes, report и chart (без выбора в консоли)')
+    parser.add_argument('--batch', action='store_true',
+                        help='анализ всех счетов и сводного портфеля без выбора счета')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш результатов шагов расчета')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='пересчитать все шаги и перезаписать кэш')
+    parser.add_argument('--timings', type=Path,
+                        help='куда сохранить JSON с временем шагов (по умолчанию artifacts/timings)')
+    parser.add_argument('--profile', type=Path, help='сохранить профиль всего запуска в файл')
+    parser.add_argument('--profile-engine', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    args = parser.parse_args()
     path_config = Path('config.yaml')
-    pd.set_option('display.max_columns', 10)
     if not path_config.exists():
         raise FileNotFoundError('Файл config.yaml не найден!')
+    pd.set_option('display.max_columns', 10)
     config = read_config(path_config)
-    main(config)
+    profiler.reset()
+    try:
+        with code_profile(args.profile, args.profile_engine):
+            main(config, args.command, batch=args.batch, account=args.account, no_cache=args.no_cache,
+                 rebuild=args.rebuild)
+    finally:
+        profiler.save(args.timings or ARTIFACTS_DIR / 'timings' / f'{dt.datetime.now():%Y%m%d-%H%M%S}.json')
+        print(profiler.summary())
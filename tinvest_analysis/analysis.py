@@ -3,14 +3,53 @@ import datetime as dt
 import numpy as np
 import pandas as pd
 
+from tinvest_analysis.fx import BASE_CURRENCY
 
-def investment_type_ration(df: pd.DataFrame):
-    last_day = df[df['date'] == df['date'].max()]
+
+class PanelIndex:
+    """
+    Общие для всех отчетов данные по дневной панели, которые считаются один раз:
+      * панель, отсортированная по дате, и открытые позиции последнего дня (хвост отсортированной панели);
+      * суммы profit_money и buy_price по (дата, тип актива) и по дате (для графиков).
+    Отчеты принимают как панель, так и уже построенный PanelIndex.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        if not df['date'].is_monotonic_increasing:
+            df = df.sort_values(by='date', kind='stable')
+        self.df = df
+        # пустая панель (новый счет или счет без бумаг): последнего дня нет, отчеты пустые
+        self.last_date = df['date'].iloc[-1] if len(df) > 0 else pd.NaT
+        self.last_day = df.iloc[df['date'].searchsorted(self.last_date, side='left'):] if len(df) > 0 else df
+        # в панели по учету лотов (tinvest_analysis.lots) закрытые позиции остаются с нулевым количеством
+        self.last_day = self.last_day[self.last_day['quantity'] > 0]
+        # observed=True: для Categorical-колонок (compact_frame) не нужны группы без строк;
+        # при этом pandas не сортирует такие группы, поэтому сортируем явно
+        self.by_date_type = df.groupby(['date', 'investemnt_object_type'], observed=True)[['profit_money', 'buy_price']]\
+            .sum()\
+            .sort_index()
+        # суммы по дате - из сумм по типам; бумаги без котировок (тип не известен) в них не попали, их досчитываем
+        unknown_type = df[df['investemnt_object_type'].isna()]
+        self.by_date = self.by_date_type.groupby(level='date').sum()\
+            .add(unknown_type.groupby('date')[['profit_money', 'buy_price']].sum(), fill_value=0)
+
+    @classmethod
+    def of(cls, df) -> 'PanelIndex':
+        return df if isinstance(df, cls) else cls(df)
+
+
+def investment_type_ration(df):
+    panel = PanelIndex.of(df)
     # стоимость портфеля на конец последнего доспуного дня
-    price_briefcase = last_day['buy_price'].sum()
+    price_briefcase = panel.last_day['buy_price'].sum()
+    # в последний день может не быть бумаг с известным типом
+    if panel.last_date not in panel.by_date_type.index:
+        return pd.Series(dtype='float64', index=pd.Index([], name='Type'), name='percent')
+    today_by_type = panel.by_date_type.loc[panel.last_date, 'buy_price']
+    # закрытые позиции панели по учету лотов остаются с нулевыми затратами - такие типы не показываем
+    today_by_type = today_by_type[today_by_type > 0]
     # доля ценных бумаг по каждому типу
-    today_by_type = last_day.groupby('investemnt_object_type')['buy_price']\
-        .sum()\
+    today_by_type = today_by_type\
         .div(price_briefcase)\
         .mul(100)\
         .round(2)
@@ -20,21 +59,24 @@ def investment_type_ration(df: pd.DataFrame):
     return spent_by_type_percent
 
 
-def investment_type_profit(df: pd.DataFrame):
-    group_by_type_and_date = df.groupby(['date', 'investemnt_object_type'])
-    sum_profit_by_date = group_by_type_and_date['profit_money'].sum()
-    sum_spent_by_date = group_by_type_and_date['buy_price'].sum()
+def investment_type_profit(df):
+    panel = PanelIndex.of(df)
+    sum_profit_by_date = panel.by_date_type['profit_money']
+    sum_spent_by_date = panel.by_date_type['buy_price']
     mask = (sum_spent_by_date > 0) & sum_spent_by_date.notna()
     profit_by_type_date = (sum_profit_by_date[mask] / sum_spent_by_date[mask])\
         .mul(100)\
         .rename('profit')\
         .reset_index()
-    agg_types = profit_by_type_date.groupby('investemnt_object_type').agg(
+    agg_types = profit_by_type_date.groupby('investemnt_object_type', observed=True).agg(
         min_profit=('profit', 'min'),
         max_profit=('profit', 'max'),
         last_profit=('profit', 'last'),
-        days_period=('date', lambda x: x.max() - x.min())
-    ).round(2)
+        first_date=('date', 'min'),
+        last_date=('date', 'max')
+    )
+    agg_types['days_period'] = agg_types.pop('last_date') - agg_types.pop('first_date')
+    agg_types = agg_types.sort_index().round(2)
     # делаем читаемый вид
     agg_types.index = agg_types.index.rename('Type')
     return profit_by_type_date, agg_types
@@ -61,16 +103,59 @@ def correlation_type_profit(type_profit_by_date):
 
 
 def profit_by_ticker(df):
-    df = df.sort_values(by='date')
-    last_day = df['date'].max()
-    active_tickers = df.loc[df['date'] == last_day, 'ticker'].unique()
-    agg_profit_by_ticker = df[df['ticker'].isin(active_tickers)].groupby('ticker').agg(
+    panel = PanelIndex.of(df)
+    active_tickers = panel.last_day['ticker'].unique()
+    df = panel.df
+    agg_profit_by_ticker = df[df['ticker'].isin(active_tickers)].groupby('ticker', observed=True).agg(
         cnt=('quantity', 'last'),
         buy_price=('buy_price', 'last'),
         avg_price=('avg_price', 'last'),
         min_profit=('profit_percent', 'min'),
         max_profit=('profit_percent', 'max'),
         last_profit=('profit_percent', 'last'),
-        days=('date', lambda x: x.max() - x.min())
-    ).sort_values(by='buy_price', ascending=False)
-    return agg_profit_by_ticker
+        first_date=('date', 'min'),
+        last_date=('date', 'max')
+    )
+    agg_profit_by_ticker['days'] = agg_profit_by_ticker.pop('last_date') - agg_profit_by_ticker.pop('first_date')
+    return agg_profit_by_ticker.sort_index().sort_values(by='buy_price', ascending=False)
+
+
+def currency_ration(df, cash: pd.DataFrame = None):
+    """
+    Валютная структура портфеля на последний день: стоимость бумаг по валюте торгов (колонка trade_currency)
+    и остатки денежных средств (cash_balances), все суммы - в валюте отчета.
+    """
+    panel = PanelIndex.of(df)
+    last_day = panel.last_day
+    # стоимость по цене закрытия; для бумаг без котировок - по затратам
+    value = (last_day['quantity'] * last_day['close_price']).fillna(last_day['buy_price'])
+    # панель без валюты торгов (операции до загрузки валют) - только бумаги в валюте отчета
+    currency = last_day['trade_currency'].astype(object) if 'trade_currency' in last_day \
+        else pd.Series(BASE_CURRENCY, index=last_day.index)
+    report = value.groupby(currency.fillna(BASE_CURRENCY)).sum().rename('securities').to_frame()
+    if cash is not None and not cash.empty:
+        report = report.join(cash.groupby('currency')['value'].sum().rename('cash'), how='outer')
+    report = report.reindex(columns=['securities', 'cash']).fillna(0)
+    report['total'] = report['securities'] + report['cash']
+    report['percent'] = report['total'].div(report['total'].sum()).mul(100).round(2)
+    report.index = report.index.rename('currency')
+    return report.sort_values(by='total', ascending=False)
+
+
+def realized_profit_by_ticker(df):
+    """
+    Реализованная и нереализованная прибыль по бумагам на последний день панели по учету лотов
+    (build_panel с cost_basis): закрытые позиции тоже показываются - у них есть только реализованная прибыль.
+    """
+    panel = PanelIndex.of(df)
+    df = panel.df
+    last_day = df.iloc[df['date'].searchsorted(panel.last_date, side='left'):]
+    report = last_day.groupby('ticker', observed=True).agg(
+        cnt=('quantity', 'sum'),
+        open_lots=('open_lots', 'sum'),
+        buy_price=('buy_price', 'sum'),
+        realized=('realized_pnl', 'sum'),
+        unrealized=('profit_money', 'sum'),
+    )
+    report['total'] = report['realized'] + report['unrealized']
+    return report.sort_values(by='total', ascending=False)
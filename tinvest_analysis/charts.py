@@ -1,47 +1,250 @@
-import matplotlib.figure
-import matplotlib.pyplot as plt
-from matplotlib.dates import MonthLocator
-import seaborn as sns
-
-
-month_locator = MonthLocator()
-
-
-def plot_profit_all_time(df, operations, figure_size=None) -> matplotlib.figure.Figure:
-    figure_size = figure_size or (20, 10)
-    # подсчет прибыльности за все время
-    group_by_date = df.groupby('date')
-    # прибыльность акций за каждый день
-    sum_profit_money_by_date = group_by_date['profit_money'].sum()
-    # размер портфеля на каждый день
-    sum_spent_by_date = group_by_date['buy_price'].sum()
-    # процент прибыли всего портфеля
-    profit_by_date = (sum_profit_money_by_date / sum_spent_by_date)\
-        .mul(100)\
-        .rename('profit')\
-        .reset_index()
-    # маска, указывающая на события покупок по тем бумагам, которые учитываются в портфеле
-    buy_mask = operations['operation_type'].isin(['buy', 'buy_card']) & operations['isin'].isin(df['isin'].unique())
-    # считаем общую сумму на которую была совершена покупка
-    buy_date = (-1) * operations[buy_mask].groupby(operations['dt'].dt.date)['total_price'].sum()
-    # считаем, на какую сумму пополнился портфель
-    sum_spent_by_date = sum_spent_by_date.loc[buy_date.index]
-    buy_point_size = (buy_date / sum_spent_by_date).mul(100)
+"""
+Графики доходности. Рисуются через объектный API matplotlib (Figure + Agg) без глобального состояния pyplot,
+поэтому безопасно строятся в нескольких процессах. Ряды берутся из уже посчитанных сумм PanelIndex
+и перед отрисовкой прореживаются до max_points точек.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import MonthLocator, YearLocator
+from matplotlib.figure import Figure
+
+from tinvest_analysis.analysis import PanelIndex
+
+
+# сколько точек линии оставлять на графике: больше, чем пикселей по ширине, не нужно
+DEFAULT_MAX_POINTS = 2000
+DOWNSAMPLING = ('lttb', 'minmax')
+BUY_OPERATIONS = ('buy', 'buy_card')
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: индексы n_out точек, сохраняющих форму линии.
+    Первая и последняя точки остаются всегда; из каждой корзины выбирается точка, образующая наибольший
+    треугольник с уже выбранной точкой предыдущей корзины и средним следующей корзины.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+    # средние корзин считаются сразу для всех корзин через накопленные суммы
+    cumulative_x = np.concatenate([[0.0], np.cumsum(x)])
+    cumulative_y = np.concatenate([[0.0], np.cumsum(y)])
+    sizes = edges[1:] - edges[:-1]
+    mean_x = (cumulative_x[edges[1:]] - cumulative_x[edges[:-1]]) / sizes
+    mean_y = (cumulative_y[edges[1:]] - cumulative_y[edges[:-1]]) / sizes
+    mean_x, mean_y = np.append(mean_x[1:], x[-1]).tolist(), np.append(mean_y[1:], y[-1]).tolist()
+
+    # выбор в корзине зависит от выбора в предыдущей, поэтому корзины обходятся по очереди. Корзины маленькие
+    # (на графике точек не больше, чем пикселей), и на списках это быстрее, чем вызовы NumPy на каждую корзину
+    x_list, y_list, edges = x.tolist(), y.tolist(), edges.tolist()
+    selected = [0]
+    previous_x, previous_y = x_list[0], y_list[0]
+    for bucket in range(n_out - 2):
+        dx, dy = previous_x - mean_x[bucket], mean_y[bucket] - previous_y
+        best, best_area = edges[bucket], -1.0
+        for i in range(edges[bucket], edges[bucket + 1]):
+            # удвоенная площадь треугольника (предыдущая точка, точка i, среднее следующей корзины)
+            area = abs(dx * (y_list[i] - previous_y) - (previous_x - x_list[i]) * dy)
+            if area > best_area:
+                best, best_area = i, area
+        selected.append(best)
+        previous_x, previous_y = x_list[best], y_list[best]
+    selected.append(n - 1)
+    return np.array(selected, dtype='int64')
+
+
+def minmax(y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Минимум и максимум в каждой из n_out / 2 корзин (плюс первая и последняя точки): сохраняет все выбросы.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    n_buckets = n_out // 2
+    bucket = np.arange(n) * n_buckets // n
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(n_buckets))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([[0, n - 1], order[starts], order[ends]]))
+
+
+def downsample(series: pd.Series, max_points: int = DEFAULT_MAX_POINTS, method: str = 'lttb') -> pd.Series:
+    """
+    Прореживание ряда с индексом-датой до max_points точек; пропуски отбрасываются.
+    :param method: lttb - форма линии, minmax - минимумы и максимумы корзин
+    """
+    if method not in DOWNSAMPLING:
+        raise ValueError(f'Неизвестный способ прореживания: {method}')
+    series = series.dropna()
+    if not max_points or len(series) <= max_points:
+        return series
+    y = series.to_numpy(dtype='float64')
+    if method == 'lttb':
+        x = series.index.to_numpy(dtype='datetime64[ns]').astype('int64').astype('float64')
+        return series.iloc[lttb(x, y, max_points)]
+    return series.iloc[minmax(y, max_points)]
+
+
+class ChartJob:
+    """
+    Готовые к отрисовке данные одного графика: линии доходности и точки покупок.
+    Содержит только небольшие прореженные ряды, поэтому дешево передается в процесс отрисовки.
+    """
+
+    def __init__(self, path: Path, title: str, lines: Dict[str, pd.Series], buy_points: pd.DataFrame = None):
+        """
+        :param lines: подпись линии -> доходность, % по датам
+        :param buy_points: точки покупок: date, profit, size (доля покупки в стоимости портфеля, %)
+        """
+        self.path = Path(path) if path is not None else None
+        self.title = title
+        self.lines = lines
+        self.buy_points = buy_points
+
+    @property
+    def points(self) -> int:
+        return sum(len(x) for x in self.lines.values())
+
+
+def _ratio(profit_money: pd.Series, buy_price: pd.Series) -> pd.Series:
+    mask = (buy_price > 0) & buy_price.notna()
+    return (profit_money[mask] / buy_price[mask]).mul(100)
+
+
+def _buy_amounts(operations: pd.DataFrame, by=()) -> pd.Series:
+    """
+    Сумма покупок по дням (и по колонкам by).
+    """
+    buys = operations[operations['operation_type'].isin(BUY_OPERATIONS)]
+    return (-1) * buys.groupby([*(buys[x] for x in by), buys['dt'].dt.normalize()])['total_price'].sum()
+
+
+def _buy_points(buy_date: pd.Series, profit: pd.Series, spent: pd.Series) -> pd.DataFrame:
+    """
+    Покупки по дням: точка на линии доходности, размер - доля покупки в стоимости позиции на этот день.
+    """
+    buy_date = buy_date[buy_date.index.isin(profit.index)]
+    return pd.DataFrame({
+        'date': buy_date.index,
+        'profit': profit.reindex(buy_date.index).to_numpy(),
+        'size': (buy_date / spent.reindex(buy_date.index)).mul(100).to_numpy(),
+    })
+
+
+def portfolio_chart_job(df, operations: pd.DataFrame, path: Path, max_points: int = DEFAULT_MAX_POINTS,
+                        method: str = 'lttb') -> ChartJob:
+    """
+    Доходность всего портфеля и покупки бумаг, которые в нем учитываются.
+    """
+    panel = PanelIndex.of(df)
+    profit = (panel.by_date['profit_money'] / panel.by_date['buy_price']).mul(100)
+    operations = operations[operations['isin'].isin(panel.df['isin'].unique())]
+    buy_points = _buy_points(_buy_amounts(operations), profit, panel.by_date['buy_price'])
+    return ChartJob(path, 'Прибыльность портфеля инвестиций',
+                    {'Доходность': downsample(profit, max_points, method)}, buy_points)
+
+
+def type_chart_jobs(df, folder: Path, max_points: int = DEFAULT_MAX_POINTS, method: str = 'lttb') -> List[ChartJob]:
+    """
+    По графику на каждый тип активов: доходность типа по дням (как в investment_type_profit).
+    """
+    panel = PanelIndex.of(df)
+    profit = _ratio(panel.by_date_type['profit_money'], panel.by_date_type['buy_price'])
+    return [
+        ChartJob(Path(folder) / f'type_{asset_type}.png', f'Прибыльность: {asset_type}',
+                 {'Доходность': downsample(series.droplevel('investemnt_object_type'), max_points, method)})
+        for asset_type, series in profit.groupby(level='investemnt_object_type', observed=True)
+    ]
+
+
+def ticker_chart_jobs(df, operations: pd.DataFrame, folder: Path, max_points: int = DEFAULT_MAX_POINTS,
+                      method: str = 'lttb') -> List[ChartJob]:
+    """
+    По графику на каждую бумагу, которая есть в портфеле в последний день: доходность позиции и покупки.
+    """
+    panel = PanelIndex.of(df)
+    active_tickers = panel.last_day['ticker'].unique()
+    rows = panel.df[panel.df['ticker'].isin(active_tickers)]
+    # одна группировка на все бумаги; несколько FIGI одного тикера суммируются
+    by_ticker_date = rows.groupby(['ticker', 'date'], observed=True)[['profit_money', 'buy_price']].sum()
+    buy_amounts = _buy_amounts(operations[operations['ticker'].isin(active_tickers)], by=['ticker'])
+    buy_amounts = {ticker: x.droplevel(0) for ticker, x in buy_amounts.groupby(level=0)}
+    jobs = []
+    for ticker, sums in by_ticker_date.groupby(level='ticker', observed=True):
+        sums = sums.droplevel('ticker')
+        profit = _ratio(sums['profit_money'], sums['buy_price'])
+        buy_date = buy_amounts.get(ticker, pd.Series(dtype='float64', index=pd.DatetimeIndex([])))
+        jobs.append(ChartJob(Path(folder) / f'ticker_{ticker}.png', f'Прибыльность: {ticker}',
+                             {'Доходность': downsample(profit, max_points, method)},
+                             _buy_points(buy_date, profit, sums['buy_price'])))
+    return jobs
+
+
+def draw_chart(job: ChartJob, figure_size=None) -> Figure:
+    """
+    Figure с холстом Agg: не регистрируется в pyplot и освобождается сборщиком мусора.
+    """
+    fig = Figure(figsize=figure_size or (20, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
     # прорисовка "линии" доходности
-    fig = plt.figure(figsize=figure_size)
-    ax = fig.gca()
-    sns.lineplot(data=profit_by_date, x='date', y='profit', label='Доходность')
+    for label, series in job.lines.items():
+        ax.plot(series.index, series.to_numpy(), label=label)
     # прорисовка точек покупки ценных бумаг
-    x_y_buy_point = profit_by_date[profit_by_date['date'].isin(buy_point_size.index)]
-    plt.scatter(x_y_buy_point['date'], x_y_buy_point['profit'], s=buy_point_size, c='r', label='Покупки')
+    if job.buy_points is not None and not job.buy_points.empty:
+        ax.scatter(job.buy_points['date'], job.buy_points['profit'], s=job.buy_points['size'], c='r', label='Покупки')
     # прорисовка дополнительных элементов и настройка осей
-    plt.axhline(y=0, color='black', linestyle='--', alpha=0.7)
-    plt.grid(linestyle='--', alpha=0.3)
-    plt.title('Прибыльность портфеля инвестиций')
-    plt.xlabel('Дата')
-    plt.ylabel('Прибыльность, %')
-    plt.legend()
-    plt.tight_layout()
+    ax.axhline(y=0, color='black', linestyle='--', alpha=0.7)
+    ax.grid(linestyle='--', alpha=0.3)
+    ax.set_title(job.title)
+    ax.set_xlabel('Дата')
+    ax.set_ylabel('Прибыльность, %')
+    ax.legend()
     fig.autofmt_xdate()
-    ax.xaxis.set_major_locator(month_locator)
+    fig.tight_layout()
+    dates = [series.index for series in job.lines.values() if len(series)]
+    years = (max(x[-1] for x in dates) - min(x[0] for x in dates)).days / 365 if dates else 0
+    # подпись каждого месяца на длинной истории сливается - тогда подписываются годы
+    ax.xaxis.set_major_locator(MonthLocator() if years <= 3 else YearLocator())
     return fig
+
+
+def render_chart(job: ChartJob, figure_size=None) -> float:
+    """
+    Рисует и сохраняет график; возвращает время отрисовки в секундах.
+    """
+    start = time.perf_counter()
+    job.path.parent.mkdir(parents=True, exist_ok=True)
+    draw_chart(job, figure_size).savefig(job.path)
+    return time.perf_counter() - start
+
+
+def render_charts(jobs: List[ChartJob], max_workers: int = None, figure_size=None) -> pd.DataFrame:
+    """
+    Отрисовка пачки графиков в пуле процессов (по умолчанию - по числу ядер; при одном - в текущем процессе).
+    :return: время отрисовки и число точек каждого графика
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(jobs) <= 1:
+        seconds = [render_chart(job, figure_size) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            seconds = list(executor.map(render_chart, jobs, [figure_size] * len(jobs)))
+    return pd.DataFrame({
+        'chart': [str(job.path) for job in jobs],
+        'points': [job.points for job in jobs],
+        'seconds': seconds,
+    })
+
+
+def plot_profit_all_time(df, operations, figure_size=None, max_points: int = DEFAULT_MAX_POINTS,
+                         method: str = 'lttb') -> Figure:
+    return draw_chart(portfolio_chart_job(df, operations, None, max_points, method), figure_size)
@@ -0,0 +1,206 @@
+"""
+Пересчет сумм в валюту отчета (по умолчанию рубли) по дневным курсам валют.
+Курсы хранятся локально в CSV или Parquet (колонки date, currency, rate - сколько единиц валюты отчета стоит
+одна единица валюты) и сортируются один раз по ключу (валюта, день). Курс каждой строки операций, котировок
+или остатков находится через searchsorted: последний известный курс не позже даты строки (asof).
+"""
+import hashlib
+from pathlib import Path
+from typing import Dict, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.processing import ISIN_KEY_SHIFT
+from tinvest_analysis.utils.fs import FX_RATES_PATH
+from tinvest_analysis.utils.profiling import profiler
+
+
+BASE_CURRENCY = 'RUB'
+# денежные колонки операций load_operations
+OPERATION_MONEY_COLUMNS = ('total_price', 'unit_price', 'commission')
+
+
+def normalize_currency(currency: pd.Series) -> pd.Series:
+    """
+    Код валюты в верхнем регистре: в старых файлах остатков валюта записана именем перечисления tinvest (rub, try_).
+    """
+    return currency.astype(object).str.upper().str.rstrip('_')
+
+
+class FxRates:
+    """
+    Дневные курсы валют к валюте отчета.
+    """
+
+    def __init__(self, rates: pd.DataFrame, base_currency: str = BASE_CURRENCY):
+        """
+        :param rates: колонки date, currency, rate (единиц base_currency за одну единицу currency)
+        """
+        self.base_currency = base_currency.upper()
+        rates = rates.dropna(subset=['rate']).assign(currency=lambda x: normalize_currency(x['currency']))
+        rates = rates[rates['currency'] != self.base_currency]
+        self.currencies = pd.Index(pd.unique(rates['currency']))
+        key = self._key(self.currencies.get_indexer(rates['currency']), rates['date'])
+        order = np.argsort(key, kind='stable')
+        self._key_sorted = key[order]
+        self._rate_sorted = rates['rate'].to_numpy(dtype='float64')[order]
+
+    @classmethod
+    def load(cls, path: Path = FX_RATES_PATH, base_currency: str = BASE_CURRENCY) -> 'FxRates':
+        """
+        Курсы из CSV или Parquet (по расширению файла).
+        """
+        path = Path(path)
+        if path.suffix == '.parquet':
+            rates = pd.read_parquet(path, columns=['date', 'currency', 'rate'])
+        else:
+            rates = pd.read_csv(path, usecols=['date', 'currency', 'rate'], parse_dates=['date'])
+        return cls(rates, base_currency)
+
+    def save(self, path: Path = FX_RATES_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rates = self.frame()
+        if path.suffix == '.parquet':
+            rates.to_parquet(path, index=False)
+        else:
+            rates.to_csv(path, index=False)
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'date': (self._key_sorted & ((1 << ISIN_KEY_SHIFT) - 1)).astype('datetime64[D]').astype('datetime64[ns]'),
+            'currency': self.currencies.take(self._key_sorted >> ISIN_KEY_SHIFT),
+            'rate': self._rate_sorted,
+        })
+
+    def fingerprint(self) -> str:
+        """
+        Хэш курсов: панель, посчитанная по другим курсам (снимок update_panel), строится заново.
+        """
+        digest = hashlib.sha256(f'{self.base_currency} {",".join(self.currencies)}'.encode())
+        digest.update(self._key_sorted.tobytes())
+        digest.update(self._rate_sorted.tobytes())
+        return digest.hexdigest()[:32]
+
+    @staticmethod
+    def _key(codes: np.ndarray, dates) -> np.ndarray:
+        """
+        Ключ (валюта, день) в одном int64, как ключ (ISIN, день) в processing.
+        """
+        days = pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[D]').astype(np.int64)
+        return (np.asarray(codes, dtype=np.int64) << ISIN_KEY_SHIFT) + days
+
+    def rate(self, currency: Union[pd.Series, pd.Categorical, Sequence[str]], dates) -> np.ndarray:
+        """
+        Курс на каждую дату: последний известный не позже нее. Валюта отчета и пропуск валюты - 1,
+        неизвестная валюта или дата раньше первого курса - NaN.
+        """
+        # строки сравниваются только для уникальных валют; пропуск валюты (-1) - последний элемент
+        currency = currency.array if isinstance(currency, pd.Series) else currency
+        if not isinstance(currency, pd.api.extensions.ExtensionArray):
+            currency = np.asarray(currency, dtype=object)
+        group, names = pd.factorize(currency)
+        names = normalize_currency(pd.Series(np.asarray(names, dtype=object)))
+        codes = np.append(self.currencies.get_indexer(names), -1).take(group)
+        base = np.append((names == self.base_currency).to_numpy(), True).take(group)
+        key = self._key(np.maximum(codes, 0), dates)
+        position = np.searchsorted(self._key_sorted, key, side='right') - 1
+        found = (codes >= 0) & (position >= 0)
+        found[found] = (self._key_sorted[position[found]] >> ISIN_KEY_SHIFT) == codes[found]
+        rate = np.full(len(codes), np.nan)
+        rate[found] = self._rate_sorted[position[found]]
+        rate[base] = 1.0
+        return rate
+
+    def convert(self, df: pd.DataFrame, columns: Sequence[str], currency: Union[pd.Series, str] = 'currency',
+                date_column: str = 'dt') -> pd.DataFrame:
+        """
+        Копия df, в которой колонки columns пересчитаны в валюту отчета.
+        :param currency: колонка df с валютой строки или валюты строк (Series, Categorical) в порядке строк df
+        """
+        currency = df[currency] if isinstance(currency, str) else currency
+        rate = self.rate(currency, df[date_column])
+        df = df.copy()
+        for column in columns:
+            if column in df.columns:
+                df[column] = df[column].to_numpy(dtype='float64') * rate
+        return df
+
+
+def instrument_currencies(operations: pd.DataFrame) -> Dict[str, str]:
+    """
+    Валюта торгов каждой бумаги - валюта ее последней операции.
+    """
+    if 'currency' not in operations.columns:
+        return {}
+    last = operations.dropna(subset=['isin']).sort_values(by='dt', kind='stable').drop_duplicates('isin', keep='last')
+    return dict(zip(last['isin'], normalize_currency(last['currency'])))
+
+
+@profiler.track()
+def convert_operations(operations: pd.DataFrame, fx_rates: FxRates = None,
+                       base_currency: str = BASE_CURRENCY) -> pd.DataFrame:
+    """
+    Суммы операций в валюте отчета по курсу дня операции. Без курсов (fx_rates=None) операции в других валютах
+    отбрасываются - как раньше при загрузке только рублевых операций.
+    :raise ValueError: нет курса валюты на дату операции
+    """
+    if 'currency' not in operations.columns:
+        return operations
+    currency = normalize_currency(operations['currency'])
+    if fx_rates is None:
+        foreign = currency.notna() & (currency != base_currency.upper())
+        if foreign.any():
+            print(f'Без курсов валют не учитываются операции в валюте: {", ".join(sorted(currency[foreign].unique()))}')
+        return operations[~foreign.to_numpy()]
+    operations = fx_rates.convert(operations, OPERATION_MONEY_COLUMNS, currency)
+    missing = np.isnan(fx_rates.rate(currency, operations['dt']))
+    if missing.any():
+        raise ValueError(f'Нет курса валют на дату операции: '
+                         f'{", ".join(sorted(currency[missing].unique()))} с {operations["dt"][missing].min():%Y-%m-%d}')
+    return operations
+
+
+@profiler.track()
+def convert_quotes(quotes: pd.DataFrame, fx_rates: FxRates, currencies: Dict[str, str]) -> pd.DataFrame:
+    """
+    Цены закрытия в валюте отчета по курсу дня котировки. Валюта цены - валюта торгов бумаги (currencies),
+    а не колонка currency котировок: у фондов там валюта активов фонда.
+    """
+    if fx_rates is None or not currencies:
+        return quotes
+    # валюта каждой котировки - через коды ISIN, без сопоставления строк в каждой строке
+    group, isins = pd.factorize(quotes['isin'])
+    codes, names = pd.factorize(pd.Series(np.asarray(isins, dtype=object)).map(currencies))
+    currency = pd.Categorical.from_codes(np.append(codes, -1).take(group), categories=names)
+    return fx_rates.convert(quotes, ['close_price'], currency, date_column='date')
+
+
+def cash_balances(balances: pd.DataFrame, fx_rates: FxRates = None, date=None,
+                  base_currency: str = BASE_CURRENCY) -> pd.DataFrame:
+    """
+    Остатки денежных средств (currency, balance) в валюте отчета по курсу на дату date (по умолчанию - T-1).
+    Остатки без курса на эту дату (без fx_rates - все остатки в других валютах) не учитываются,
+    как и операции в convert_operations.
+    :return: currency, balance, rate, value
+    """
+    date = pd.Timestamp.today().normalize() - pd.Timedelta(days=1) if date is None else pd.Timestamp(date)
+    balances = balances.groupby(normalize_currency(balances['currency']).rename('currency'))['balance'].sum()
+    currency = balances.index.to_series()
+    if fx_rates is None:
+        rate = np.where(currency == base_currency.upper(), 1.0, np.nan)
+    else:
+        rate = fx_rates.rate(currency, np.repeat(date, len(currency)))
+    missing = np.isnan(rate)
+    # нулевые остатки (Тинькофф отдает все валюты счета) не стоят предупреждения
+    if (missing & (balances.to_numpy() != 0)).any():
+        reason = 'Без курсов валют' if fx_rates is None else f'Без курса на {date:%Y-%m-%d}'
+        skipped = currency[missing & (balances.to_numpy() != 0)]
+        print(f'{reason} не учитываются остатки в валюте: {", ".join(sorted(skipped))}')
+    return pd.DataFrame({
+        'currency': currency.to_numpy()[~missing],
+        'balance': balances.to_numpy()[~missing],
+        'rate': rate[~missing],
+        'value': balances.to_numpy()[~missing] * rate[~missing],
+    })
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import requests
+
+from tinvest_analysis.utils.profiling import profiler
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+    Token bucket: не более rate запросов в секунду с допустимым всплеском burst.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :raise ValueError: rate <= 0 или burst < 1 - запрос никогда не получит токен, и acquire ждет бесконечно
+        """
+        if rate <= 0:
+            raise ValueError(f'Частота запросов должна быть больше 0: rate_limit={rate}')
+        if burst < 1:
+            raise ValueError(f'Всплеск запросов должен быть не меньше 1: burst={burst}')
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HttpClient:
+    """
+    Общая HTTP-сессия для загрузчиков: ограничение частоты запросов и повторы с backoff.
+    """
+
+    def __init__(self, base_url: str, rate_limit: float = 5, burst: int = 1, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30, name: str = 'http', session: requests.Session = None):
+        """
+        :param name: имя источника в замерах времени (http.{name})
+        :param session: сессия requests, например, с записью или воспроизведением ответов (loaders.transport)
+        """
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.rate_limiter = RateLimiter(rate_limit, burst) if rate_limit else None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.strip('/')}"
+
+    def get(self, path: str, params=None) -> requests.Response:
+        with profiler.stage(f'http.{self.name}'):
+            return self._get(self.url(path), params)
+
+    def _get(self, url: str, params=None) -> requests.Response:
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def close(self):
+        self.session.close()
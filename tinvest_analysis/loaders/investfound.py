@@ -1,22 +1,42 @@
 import datetime as dt
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict
 
 from tqdm import tqdm
-import requests
 from lxml import etree
 import pandas as pd
+import requests
 
-
-INVESTMENT_OBJECT_TYPE_XPATH = "//ul[contains(@class, 'param_list')]" \
-                               "/li[span[text() = 'Объект инвестирования']]" \
-                               "/div[contains(@class, 'value')]/text()"
-GEOGRAPHY_XPATH = "//ul[contains(@class, 'param_list')]" \
-                  "/li[span[text() = 'География инвестирования']]" \
-                  "/div[contains(@class, 'value')]/text()"
-CURRENCY_XPATH = "//ul[contains(@class, 'param_list')]" \
-                 "/li[span[text() = 'Валюта фонда']]" \
-                 "/div[contains(@class, 'value')]/text()"
+from tinvest_analysis.loaders.http import HttpClient
+from tinvest_analysis.utils.metadata import MetadataStore
+from tinvest_analysis.utils.profiling import profiler
+
+
+PAGE_PARAM_XPATH = "//ul[contains(@class, 'param_list')]" \
+                   "/li[span[text() = '{}']]" \
+                   "/div[contains(@class, 'value')]/text()"
+# атрибуты страницы бумаги: название атрибута -> подпись параметра на странице
+PAGE_ATTRIBUTES = {
+    'investemnt_object_type': 'Объект инвестирования',
+    'geography': 'География инвестирования',
+    'currency': 'Валюта фонда',
+    'nominal': 'Номинал',
+}
+# начало истории котировок при полной загрузке
+HISTORY_START_DATE = dt.date(2015, 1, 1)
+
+
+def parse_page_attributes(content: bytes) -> dict:
+    """
+    Все атрибуты PAGE_ATTRIBUTES за один разбор HTML-страницы бумаги; отсутствующие или пустые - None.
+    """
+    doc = etree.HTML(content)
+    attributes = {}
+    for name, label in PAGE_ATTRIBUTES.items():
+        values = doc.xpath(PAGE_PARAM_XPATH.format(label)) if doc is not None else []
+        value = values[0] if len(values) > 0 else ''
+        attributes[name] = value if len(value) > 0 else None
+    return attributes
 
 
 class InvestTypeBase:
@@ -28,17 +48,24 @@ class InvestTypeBase:
         raise NotImplementedError
 
     @classmethod
-    def parse(cls, isin: str):
+    def parse(cls, isin: str, http: HttpClient, date_from: dt.date = None):
         params = {'searchString': isin}
-        response = requests.get(cls.url, params).json()
+        response = http.get(cls.url, params).json()
         # Защита от неточного поиска
         if response['total'] == 1:
             body = response['currentResults'][0]
-            return cls(isin, body)
+            return cls(isin, body, http, date_from=date_from)
         return
 
-    def __init__(self, isin, response_body):
+    def __init__(self, isin, response_body, http: HttpClient, page_attributes: dict = None,
+                 date_from: dt.date = None):
         self.isin = isin
+        self.http = http
+        # котировки запрашиваются начиная с этой даты
+        self.date_from = date_from or HISTORY_START_DATE
+        self.response_body = response_body
+        # атрибуты со страницы бумаги (тип объекта, география, валюта), известные из справочника
+        self.page_attributes = dict(page_attributes or {})
         self.attributes = self._parse_attributes(response_body)
         self.chartData = self._get_chart_data()
 
@@ -48,28 +75,20 @@ class InvestTypeBase:
     def _get_chart_data(self):
         raise NotImplementedError
 
-    def _parse_geography(self, url):
-        page_content = requests.get(url)
-        doc = etree.HTML(page_content.content)
-        geography = doc.xpath(GEOGRAPHY_XPATH)[0]
-        return geography if len(geography) > 0 else None
-
-    def _parse_currency(self, url):
-        page_content = requests.get(url)
-        doc = etree.HTML(page_content.content)
-        currency = doc.xpath(CURRENCY_XPATH)[0]
-        return currency if len(currency) > 0 else None
-
-    def investment_type(self, url):
-        page_content = requests.get(url)
-        doc = etree.HTML(page_content.content)
-        invest_type = doc.xpath(INVESTMENT_OBJECT_TYPE_XPATH)[0]
-        return invest_type if len(invest_type) > 0 else None
+    def _page_attribute(self, name, url):
+        """
+        Атрибут со страницы бумаги. Страница загружается один раз и разбирается сразу на все атрибуты,
+        результат сохраняется в page_attributes (и далее в справочник бумаг).
+        """
+        if name not in self.page_attributes:
+            page_content = self.http.get(url)
+            self.page_attributes.update(parse_page_attributes(page_content.content))
+        return self.page_attributes[name]
 
 
 class Stock(InvestTypeBase):
 
-    url = "https://investfunds.ru/stocks"
+    url = "stocks"
     default_chart_payload = {}
 
     def _parse_attributes(self, response_body) -> dict:
@@ -95,13 +114,12 @@ class Stock(InvestTypeBase):
         payload = {
             'action': 'chartData',
             'stocks[]': f'{stock_id}/{ground_id}',
-            'dateFrom': dt.date(2015, 1, 1).strftime('%d.%m.%Y'),
+            'dateFrom': self.date_from.strftime('%d.%m.%Y'),
             'needVolume': False,
             'newAlgorithm': True
         }
-        url = f"{self.url[:-7]}/{self.attributes['url']}"
-        response = requests.get(f'{url}/1', payload)
-        response.raise_for_status()
+        url = self.attributes['url']
+        response = self.http.get(f'{url}/1', payload)
         content = response.json()[0]
         chart_data = content['data']
         # make dataframe
@@ -111,20 +129,14 @@ class Stock(InvestTypeBase):
         return df
 
     def _parse_currency(self, url):
-        xpath = "//ul[contains(@class, 'param_list')]" \
-                "/li[span[text() = 'Номинал']]" \
-                "/div[contains(@class, 'value')]/text()"
-        page_content = requests.get(url)
-        doc = etree.HTML(page_content.content)
-        currency = doc.xpath(xpath)
-        if len(currency) > 0:
-            currency = currency.split(' ', 1)[-1]
-        return currency
+        # номинал на странице акции указан вместе с валютой: "1 RUB"
+        nominal = self._page_attribute('nominal', url)
+        return nominal.rsplit(' ', 1)[-1] if nominal else None
 
 
 class Bond(InvestTypeBase):
 
-    url = "https://investfunds.ru/bonds"
+    url = "bonds"
     default_chart_payload = {}
 
     def _parse_attributes(self, response_body) -> dict:
@@ -146,7 +158,7 @@ class Bond(InvestTypeBase):
 
 class Fund(InvestTypeBase):
 
-    url = "https://investfunds.ru/funds"
+    url = "funds"
     default_chart_payload = {}
 
     def _parse_attributes(self, response_body) -> dict:
@@ -164,25 +176,24 @@ class Fund(InvestTypeBase):
             'action': 'chartData',
             'data_key': 'pay',
             'currencyId': 1,
-            'date_from': dt.date(2015, 1, 1).strftime('%d.%m.%Y'),
+            'date_from': self.date_from.strftime('%d.%m.%Y'),
             'ids[]': self.attributes['fund_id_numeric']
         }
-        url = f"{self.url[:-6]}/{self.attributes['url']}"
-        response = requests.get(url, payload)
-        response.raise_for_status()
+        url = self.attributes['url']
+        response = self.http.get(url, payload)
         content = response.json()[0]
         date_format = content['tooltip']['xDateFormat']
         chart_data = content['data']
         # make dataframe
         df = pd.DataFrame(chart_data, columns=['dt', 'close_price'])
         df['dt'] = df['dt'].apply(lambda x: dt.datetime.fromtimestamp(x // 1000))
-        df = df.assign(investemnt_object_type=None, geography=None, currency=self._parse_currency(url))
+        df = df.assign(investemnt_object_type=None, geography=None, currency=self._page_attribute('currency', url))
         return df
 
 
 class Etf(InvestTypeBase):
 
-    url = "https://investfunds.ru/etf"
+    url = "etf"
     default_chart_payload = {}
 
     def _parse_attributes(self, response_body) -> dict:
@@ -208,12 +219,11 @@ class Etf(InvestTypeBase):
         payload = {
             'action': 'chartData',
             'data_key': 'close',
-            'date_from': dt.date(2015, 1, 1).strftime('%d.%m.%Y'),
+            'date_from': self.date_from.strftime('%d.%m.%Y'),
             'needVolume': 1
         }
-        url = f"{self.url[:-4]}/{self.attributes['url']}"
-        response = requests.get(f'{url}/1', payload)
-        response.raise_for_status()
+        url = self.attributes['url']
+        response = self.http.get(f'{url}/1', payload)
         content = response.json()[0]
         date_format = content['tooltip']['xDateFormat']
         chart_data = content['data']
@@ -221,9 +231,9 @@ class Etf(InvestTypeBase):
         df = pd.DataFrame(chart_data, columns=['dt', 'close_price'])
         df['dt'] = df['dt'].apply(lambda x: dt.datetime.fromtimestamp(x // 1000))
         df = df.assign(
-            investemnt_object_type=self.investment_type(url),
-            geography=self._parse_geography(url),
-            currency=self._parse_currency(url))
+            investemnt_object_type=self._page_attribute('investemnt_object_type', url),
+            geography=self._page_attribute('geography', url),
+            currency=self._page_attribute('currency', url))
         return df
 
 
@@ -231,21 +241,56 @@ class InvestFounds:
     URL = 'https://investfunds.ru'
     InvestTypes = (Etf, Stock, Bond, Fund)
 
-    def __init__(self, isin_list):
+    def __init__(self, isin_list, base_url: str = None, max_workers: int = 8, rate_limit: float = 5,
+                 burst: int = 1, retries: int = 3, backoff: float = 0.5, metadata: MetadataStore = None,
+                 date_from: Dict[str, dt.date] = None, session: requests.Session = None):
+        """
+        :param max_workers: сколько ISIN обрабатывается одновременно
+        :param rate_limit: ограничение на число запросов в секунду ко всему сайту
+        :param metadata: справочник, из которого берется уже известный тип актива и его атрибуты
+        :param date_from: дата, с которой нужны котировки, по каждому ISIN (по умолчанию - вся история)
+        :param session: сессия requests (запись и воспроизведение ответов, см. loaders.transport)
+        """
+        self.max_workers = max_workers
+        self.metadata = metadata
+        self.date_from = date_from or {}
+        self.http = HttpClient(base_url or self.URL, rate_limit=rate_limit, burst=burst,
+                               retries=retries, backoff=backoff, name='investfunds', session=session)
         self.assets: Dict[str, InvestTypeBase] = self._parse_assets(isin_list)
 
+    @profiler.track('investfunds.parse_asset')
+    def _parse_asset(self, isin):
+        cached = self.metadata.get('investfunds', isin) if self.metadata else None
+        if cached:
+            invest_type_parser = next(x for x in self.InvestTypes if x.__name__ == cached['type'])
+            return invest_type_parser(isin, cached['response_body'], self.http, cached['page_attributes'],
+                                      date_from=self.date_from.get(isin))
+        for invest_type_parser in self.InvestTypes:
+            invest_unit = invest_type_parser.parse(isin, self.http, self.date_from.get(isin))
+            if invest_unit:
+                if self.metadata:
+                    self.metadata.set('investfunds', isin, dict(
+                        type=invest_type_parser.__name__,
+                        response_body=invest_unit.response_body,
+                        attributes=invest_unit.attributes,
+                        page_attributes=invest_unit.page_attributes
+                    ))
+                return invest_unit
+        return
+
     def _parse_assets(self, isin_list) -> dict:
         ids = {}
-        for isin in tqdm(isin_list):
-            for invest_type_parser in self.InvestTypes:
-                invest_unit = invest_type_parser.parse(isin)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._parse_asset, isin): isin for isin in isin_list}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                isin = futures[future]
+                invest_unit = future.result()
                 if invest_unit:
                     ids[isin] = invest_unit
-                    break
-                time.sleep(1)
-            if isin not in ids:
-                print(f'Skip {isin} :(')
-        return ids
+                else:
+                    print(f'Skip {isin} :(')
+        # сохраняем исходный порядок бумаг
+        return {isin: ids[isin] for isin in isin_list if isin in ids}
 
 
 if __name__ == '__main__':
@@ -1,17 +1,75 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Dict, Iterable, Iterator
 
+import requests
 import tinvest
 import pandas as pd
-from tinvest import OperationStatus, Currency, OperationTypeWithCommission
+from tinvest import OperationStatus, Currency, OperationTypeWithCommission, InstrumentType, \
+    TooManyRequestsError, UnexpectedError
+
+from tinvest_analysis.loaders.http import RateLimiter
+from tinvest_analysis.utils.metadata import MetadataStore
+from tinvest_analysis.utils.profiling import profiler
+
+
+# начало истории операций при полной загрузке
+HISTORY_START = datetime(2015, 1, 1, 0, 0, 0)
+INSTRUMENT_TYPE_NAMES = {x: x.name for x in InstrumentType}
+OPERATION_TYPE_NAMES = {x: x.name for x in OperationTypeWithCommission}
+# код валюты (RUB, USD, ...), как в файле курсов tinvest_analysis.fx
+CURRENCY_NAMES = {x: x.value for x in Currency}
+# справочники инструментов, из которых FIGI определяется без отдельного запроса на каждый
+CATALOG_METHODS = ('get_market_stocks', 'get_market_bonds', 'get_market_etfs', 'get_market_currencies')
+
+
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, UnexpectedError):
+        return error.status >= 500
+    return isinstance(error, (TooManyRequestsError, requests.ConnectionError, requests.Timeout))
 
 
 class Tinkoff:
 
-    def __init__(self, token: str):
-        self.client = tinvest.SyncClient(token)
+    def __init__(self, token: str, metadata: MetadataStore = None, max_workers: int = 8, rate_limit: float = 2,
+                 burst: int = 1, retries: int = 3, backoff: float = 0.5, use_catalog: bool = True,
+                 session: requests.Session = None):
+        """
+        :param max_workers: сколько FIGI, которых нет в справочниках, запрашивается одновременно
+        :param rate_limit: ограничение на число запросов в секунду к API
+        :param retries: число повторов запроса при 429, 5xx или сетевой ошибке
+        :param use_catalog: определять FIGI по справочникам акций, облигаций, фондов и валют (4 запроса)
+        :param session: сессия requests для tinvest.SyncClient (запись и воспроизведение ответов, см. loaders.transport)
+        """
+        self.client = tinvest.SyncClient(token, session=session)
+        self.metadata = metadata
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(rate_limit, burst) if rate_limit else None
+        self.retries = retries
+        self.backoff = backoff
+        self.use_catalog = use_catalog
+        # справочник по FIGI в рамках запуска: нужен при загрузке окнами и без MetadataStore
+        self._figi_information = {}
+        self._catalog = None
+
+    def _call(self, method: str, *args, **kwargs):
+        """
+        Запрос к API с ограничением частоты и повторами с backoff при временных ошибках.
+        """
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                return getattr(self.client, method)(*args, **kwargs)
+            except Exception as error:
+                if not _is_transient(error) or attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
 
     def get_broker_accounts(self):
-        accounts = self.client.get_accounts()
+        with profiler.stage('tinkoff.get_accounts'):
+            accounts = self._call('get_accounts')
         payload = accounts.payload
         return {
             account.broker_account_type.value: str(account.broker_account_id)
@@ -19,12 +77,13 @@ class Tinkoff:
         }
 
     def get_portfolio_currencies(self, broker_account_id: str):
-        currencies = self.client.get_portfolio_currencies(broker_account_id)\
-            .payload\
-            .currencies
+        with profiler.stage('tinkoff.get_portfolio_currencies'):
+            currencies = self._call('get_portfolio_currencies', broker_account_id)\
+                .payload\
+                .currencies
         df = pd.DataFrame((
             {
-                'currency': currency.currency.name,
+                'currency': CURRENCY_NAMES[currency.currency],
                 'balance': float(currency.balance)
             }
             for currency in currencies
@@ -32,28 +91,63 @@ class Tinkoff:
         return df
 
     def get_operations(self, broker_account_id: str, date_from: datetime = None):
-        date_from = date_from or datetime(2015, 1, 1, 0, 0, 0)
-        date_to = datetime.now()
-        operations = self.client.get_operations(
-            from_=date_from,
-            to=date_to,
-            broker_account_id=broker_account_id
-        ).payload.operations
-
-        df = pd.DataFrame((operation.dict() for operation in operations))\
-            .set_index('id')
-        df = self._operations_processing(df)
-        df = self._operations_map_ticker(df)
-        return df
+        chunks = list(self.iter_operations(broker_account_id, date_from))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks, axis=0)
+
+    def iter_operations(self, broker_account_id: str, date_from: datetime = None, date_to: datetime = None,
+                        window_months: int = 1) -> Iterator[pd.DataFrame]:
+        """
+        Операции по счету окнами по window_months месяцев, по возрастанию даты.
+        Каждое окно запрашивается и обрабатывается отдельно, поэтому в памяти одновременно только одно окно.
+        Операция на границе окон может прийти дважды - повторы по id отбрасываются.
+        """
+        date_from = date_from or HISTORY_START
+        date_to = date_to or datetime.now()
+        bounds = pd.date_range(date_from, date_to, freq=f'{window_months}MS').to_pydatetime().tolist()
+        bounds = sorted({date_from, *bounds, date_to})
+        seen_ids = set()
+        for window_from, window_to in zip(bounds[:-1], bounds[1:]):
+            with profiler.stage('tinkoff.get_operations') as record:
+                operations = self._call(
+                    'get_operations',
+                    from_=window_from,
+                    to=window_to,
+                    broker_account_id=broker_account_id
+                ).payload.operations
+                record.rows_out = len(operations)
+            operations = [x for x in operations if x.id not in seen_ids]
+            seen_ids.update(x.id for x in operations)
+            if not operations:
+                continue
+            df = self._operations_processing(self._operations_frame(operations))
+            if df.empty:
+                continue
+            yield self._operations_map_ticker(df)
+
+    @staticmethod
+    def _operations_frame(operations) -> pd.DataFrame:
+        """
+        Таблица из ответа API без operation.dict(): колонки собираются напрямую из атрибутов,
+        вложенные trades не разворачиваются.
+        """
+        commission = [x.commission for x in operations]
+        return pd.DataFrame({
+            'id': [x.id for x in operations],
+            'commission': [x.value if x is not None else None for x in commission],
+            'currency': [x.currency for x in operations],
+            'date': [x.date for x in operations],
+            'figi': [x.figi for x in operations],
+            'instrument_type': [x.instrument_type for x in operations],
+            'operation_type': [x.operation_type for x in operations],
+            'payment': [x.payment for x in operations],
+            'price': [x.price for x in operations],
+            'quantity_executed': [x.quantity_executed for x in operations],
+            'status': [x.status for x in operations],
+        }).set_index('id')
 
     def _operations_processing(self, df):
-        to_drop = [
-            'status',
-            'trades',
-            'quantity',
-            'currency',
-            'is_margin_call'
-        ]
         rename_dict = {
             'date': 'dt',
             'price': 'unit_price',
@@ -63,29 +157,70 @@ class Tinkoff:
         }
         operations_filter = (
                 (df['status'] == OperationStatus.done)
-                & (df['currency'] == Currency.rub)
                 & (df['instrument_type'].notna())
                 & (df['operation_type'] != OperationTypeWithCommission.broker_commission)
         )
-        df = df.copy()
-        df = df[operations_filter]
-        df.rename(columns=rename_dict, inplace=True)
-        df.sort_values(by='dt', inplace=True)
-        df['dt'] = pd.to_datetime(df['dt']).dt.strftime('%Y-%m-%d %H:%M:%S')
-        df['commission'] = df['commission'].apply(lambda x: float(x['value']) if x else None)
-        df['instrument_type'] = df['instrument_type'].apply(lambda x: x.name)
-        df['operation_type'] = df['operation_type'].apply(lambda x: x.name)
-        df.drop(columns=to_drop, inplace=True)
-        return df
+        # операции во всех валютах: в валюту отчета они пересчитываются при анализе (tinvest_analysis.fx)
+        df = df[operations_filter].drop(columns=['status'])
+        df = df.rename(columns=rename_dict).sort_values(by='dt')
+        # время операции по Москве, без часового пояса
+        df['dt'] = pd.to_datetime(df['dt'], utc=True).dt.tz_convert('Europe/Moscow').dt.tz_localize(None)
+        # Decimal из API -> float, имена перечислений - через словарь по всем значениям сразу
+        for column in ('commission', 'total_price', 'unit_price'):
+            df[column] = df[column].astype(float)
+        df['count'] = pd.to_numeric(df['count'])
+        df['instrument_type'] = df['instrument_type'].map(INSTRUMENT_TYPE_NAMES)
+        df['operation_type'] = df['operation_type'].map(OPERATION_TYPE_NAMES)
+        df['currency'] = df['currency'].map(CURRENCY_NAMES)
+        return df[['commission', 'dt', 'figi', 'instrument_type', 'operation_type', 'total_price', 'unit_price',
+                   'count', 'currency']]
+
+    def _load_catalog(self) -> Dict[str, dict]:
+        if self._catalog is None:
+            self._catalog = {}
+            for method in CATALOG_METHODS:
+                with profiler.stage(f'tinkoff.{method}'):
+                    instruments = self._call(method).payload.instruments
+                for instrument in instruments:
+                    self._catalog[instrument.figi] = {
+                        'ticker': instrument.ticker, 'isin': instrument.isin, 'name': instrument.name}
+        return self._catalog
+
+    def _search_by_figi(self, figi):
+        with profiler.stage('tinkoff.search_by_figi'):
+            payload = self._call('get_market_search_by_figi', figi).payload
+        return {'ticker': payload.ticker, 'isin': payload.isin, 'name': payload.name}
+
+    def _resolve_figi(self, figi_list: Iterable[str]) -> Dict[str, dict]:
+        """
+        Тикер, ISIN и название по FIGI: из памяти, справочника бумаг (MetadataStore), справочников
+        инструментов API и, для оставшихся (например, погашенных) бумаг, параллельными запросами по одному FIGI.
+        """
+        unknown = [figi for figi in figi_list if figi not in self._figi_information]
+        resolved = {}
+        if self.metadata:
+            for figi in unknown:
+                cached = self.metadata.get('figi', figi)
+                if cached:
+                    self._figi_information[figi] = cached
+            unknown = [figi for figi in unknown if figi not in self._figi_information]
+        if unknown and self.use_catalog:
+            catalog = self._load_catalog()
+            resolved.update({figi: catalog[figi] for figi in unknown if figi in catalog})
+            unknown = [figi for figi in unknown if figi not in catalog]
+        if unknown:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                resolved.update(zip(unknown, executor.map(self._search_by_figi, unknown)))
+        for figi, information in resolved.items():
+            if self.metadata:
+                self.metadata.set('figi', figi, information)
+            self._figi_information[figi] = information
+        return {figi: self._figi_information[figi] for figi in figi_list}
 
     def _operations_map_ticker(self, df):
-        unique_figi = df['figi'].unique()
-        figi_information = {
-            figi: self.client.get_market_search_by_figi(figi).payload
-            for figi in unique_figi
-        }
-        figi_to_ticker = {figi: value.ticker for figi, value in figi_information.items()}
-        figi_to_isin = {figi: value.isin for figi, value in figi_information.items()}
+        figi_information = self._resolve_figi(df['figi'].unique())
+        figi_to_ticker = {figi: value['ticker'] for figi, value in figi_information.items()}
+        figi_to_isin = {figi: value['isin'] for figi, value in figi_information.items()}
         df['ticker'] = df['figi'].map(figi_to_ticker)
         df['isin'] = df['figi'].map(figi_to_isin)
         return df
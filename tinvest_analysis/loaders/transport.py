@@ -0,0 +1,278 @@
+"""
+Запись и воспроизведение HTTP-ответов загрузчиков. Оба загрузчика ходят в сеть через requests.Session
+(Tinkoff - через tinvest.SyncClient(session=...), InvestFounds - через HttpClient), поэтому транспорт -
+это подмена сессии:
+  * RecordingSession - обычные запросы, ответы сохраняются в архив (zip: index.json и тела ответов);
+  * ReplaySession - запросы уходят на локальный StubServer, который отвечает из архива
+    с заданной задержкой и долей ошибок.
+Так загрузку можно замерять и настраивать (число потоков, лимиты, повторы, кэш) без сети.
+Заголовки запросов (в том числе токен Тинькофф) в архив не пишутся.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+
+from tinvest_analysis.utils.fs import HTTP_ARCHIVE_PATH
+
+
+MODES = ('record', 'replay')
+# параметры, которые меняются от запуска к запуску: конец последнего окна операций Тинькофф - текущее время.
+# Если точной записи нет, берется ответ на тот же запрос без этих параметров
+VOLATILE_PARAMS = ('to',)
+# ответ заглушки: статус, Content-Type, тело
+StubResponse = Tuple[int, str, bytes]
+
+
+def _strip_scheme(url: str) -> str:
+    return url.split('://', 1)[-1]
+
+
+def request_key(method: str, url: str, body: Optional[bytes] = None) -> str:
+    """
+    Ключ запроса в архиве: метод, адрес без схемы (хост, путь, параметры в порядке запроса) и тело.
+    """
+    digest = hashlib.sha1(f'{method.upper()} {_strip_scheme(url)}'.encode())
+    if body:
+        digest.update(body if isinstance(body, bytes) else str(body).encode())
+    return digest.hexdigest()
+
+
+def _without_params(url: str, params: Sequence[str]) -> str:
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name not in params]
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+class HttpArchive:
+    """
+    Сжатый архив ответов: index.json (ключ -> метод, адрес, статус, Content-Type) и тело каждого ответа
+    в отдельной записи bodies/{ключ}.
+    """
+
+    def __init__(self, path: Path = HTTP_ARCHIVE_PATH, volatile_params: Sequence[str] = VOLATILE_PARAMS):
+        self.path = Path(path)
+        self.volatile_params = tuple(volatile_params)
+        self.index = {}
+        self.bodies = {}
+        # ключ запроса без volatile_params -> ключ последней записи
+        self._loose = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with zipfile.ZipFile(self.path) as archive:
+                self.index = json.loads(archive.read('index.json'))
+                self.bodies = {key: archive.read(f'bodies/{key}') for key in self.index}
+            for key, record in self.index.items():
+                self._loose[self._loose_key(record['method'], record['url'], self.bodies.get(key))] = key
+
+    def _loose_key(self, method, url, body=None) -> str:
+        return request_key(method, _without_params(_strip_scheme(url), self.volatile_params), body)
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, method: str, url: str, status: int, content_type: str, content: bytes,
+            body: Optional[bytes] = None):
+        key = request_key(method, url, body)
+        with self._lock:
+            self.index[key] = {'method': method.upper(), 'url': _strip_scheme(url), 'status': status,
+                               'content_type': content_type}
+            self.bodies[key] = content
+            self._loose[self._loose_key(method, url, body)] = key
+
+    def get(self, method: str, url: str, body: Optional[bytes] = None) -> Optional[StubResponse]:
+        key = request_key(method, url, body)
+        if key not in self.index:
+            key = self._loose.get(self._loose_key(method, url, body))
+        if key is None:
+            return None
+        record = self.index[key]
+        return record['status'], record['content_type'], self.bodies[key]
+
+    def save(self):
+        """
+        Запись во временный файл и замена: прерванная запись не портит прежний архив.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with self._lock, zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('index.json', json.dumps(self.index, ensure_ascii=False, indent=1))
+            for key, content in self.bodies.items():
+                archive.writestr(f'bodies/{key}', content)
+        tmp_path.replace(self.path)
+
+
+class RecordingSession(requests.Session):
+    """
+    Сессия, которая сохраняет каждый полученный ответ в архив.
+    """
+
+    def __init__(self, archive: HttpArchive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+        self.archive.add(request.method, request.url, response.status_code,
+                         response.headers.get('Content-Type', ''), response.content, request.body)
+        return response
+
+
+class ReplaySession(requests.Session):
+    """
+    Сессия, которая отправляет запросы на локальный сервер: https://{хост}/{путь} -> {server_url}/{хост}/{путь}.
+    """
+
+    def __init__(self, server_url: str):
+        super().__init__()
+        self.server_url = server_url.rstrip('/')
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        request = request.copy()
+        request.url = f'{self.server_url}/{_strip_scheme(request.url)}'
+        return super().send(request, **kwargs)
+
+
+class StubServer:
+    """
+    Локальный HTTP-сервер (отдельный поток, каждый запрос - в своем потоке), который отвечает из архива
+    или функции responder(method, url, body). Неизвестный запрос - 404.
+    """
+
+    def __init__(self, responder, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, seed: int = 0):
+        """
+        :param responder: HttpArchive или функция (method, url, body) -> (статус, Content-Type, тело);
+            url - адрес запроса без ведущего /: {хост}/{путь} от ReplaySession, {путь} при прямом обращении
+        :param latency: задержка каждого ответа, секунды
+        :param jitter: дополнительная случайная задержка от 0 до jitter секунд
+        :param error_rate: доля запросов, на которые вместо ответа возвращается error_status
+        """
+        self.responder: Callable[..., Optional[StubResponse]] = \
+            responder.get if isinstance(responder, HttpArchive) else responder
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _respond(self, method: str, url: str, body: Optional[bytes]) -> StubResponse:
+        with self._lock:
+            self.stats['requests'] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            error = self._random.random() < self.error_rate
+            if error:
+                self.stats['errors'] += 1
+        time.sleep(delay)
+        if error:
+            return self.error_status, 'text/plain', b'injected error'
+        response = self.responder(method, url, body)
+        if response is None:
+            with self._lock:
+                self.stats['misses'] += 1
+            return 404, 'text/plain', f'not recorded: {method} {url}'.encode()
+        return response
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive: сессия requests переиспользует соединения, как с настоящим сервером
+            protocol_version = 'HTTP/1.1'
+            # заголовки и тело уходят разными пакетами: без этого каждый ответ ждет подтверждения ~40 мс
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                status, content_type, content = stub._respond(self.command, self.path.lstrip('/'), body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'StubServer':
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self) -> str:
+        return (f"Заглушка HTTP: {self.stats['requests']} запросов, {self.stats['errors']} ошибок, "
+                f"{self.stats['misses']} без записи в архиве")
+
+
+@contextmanager
+def http_session(mode: str = None, archive: Path = None, latency_ms: float = 0, jitter_ms: float = 0,
+                 error_rate: float = 0, seed: int = 0) -> Iterator[Optional[requests.Session]]:
+    """
+    Сессия для загрузчиков по режиму:
+      * None - None (загрузчики создают обычную сессию);
+      * record - RecordingSession, архив сохраняется при выходе;
+      * replay - ReplaySession и StubServer, отвечающий из архива, на время блока.
+    """
+    if mode is None:
+        yield None
+        return
+    if mode not in MODES:
+        raise ValueError(f'Неизвестный режим HTTP: {mode}')
+    archive = HttpArchive(archive or HTTP_ARCHIVE_PATH)
+    if mode == 'record':
+        session = RecordingSession(archive)
+        try:
+            yield session
+        finally:
+            session.close()
+            archive.save()
+            print(f'Архив HTTP: {len(archive)} ответов в {archive.path}')
+        return
+    if not archive.path.exists():
+        raise FileNotFoundError(f'Нет архива HTTP {archive.path}, сначала запустите загрузку в режиме record')
+    with StubServer(archive, latency_ms / 1000, jitter_ms / 1000, error_rate, seed=seed) as server:
+        session = ReplaySession(server.url)
+        try:
+            yield session
+        finally:
+            session.close()
+            print(server.report())
@@ -0,0 +1,196 @@
+"""
+Учет лотов: себестоимость позиции по FIFO или по средней цене, реализованная прибыль продаж и открытые лоты.
+Все сделки обрабатываются одним проходом NumPy по массивам, отсортированным по (бумага, время), без цикла
+по сделкам и бумагам.
+
+В ts_briefcase_ticker_prices buy_price - накопленная сумма денежных потоков: после частичной продажи с прибылью
+она меньше себестоимости оставшихся бумаг. Здесь buy_price - себестоимость оставшихся бумаг, поэтому
+profit_money после enrichment_ticker_prices - нереализованная прибыль, а реализованная хранится в realized_pnl.
+
+Если продано больше, чем есть в позиции (бумаги заведены переводом из другого брокера, покупка вне загруженной
+истории), лишние бумаги считаются купленными по цене продажи: прибыли по ним нет, позиция не уходит в минус.
+"""
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.processing import ISIN_KEY_SHIFT, get_indexes
+from tinvest_analysis.utils.profiling import profiler
+
+
+METHODS = ('fifo', 'average')
+# остаток позиции меньше EPS считается закрытием (количества после дроблений дробные)
+EPS = 1e-9
+
+
+def _segment_cumsum(values: np.ndarray, segment: np.ndarray) -> np.ndarray:
+    """
+    Накопленная сумма внутри сегментов; segment - неубывающие номера сегментов.
+    Сумма начинается заново в каждом сегменте: разность с общей накопленной суммой теряет точность,
+    когда в сегментах значения разного порядка (amount / scale в _average_cost).
+    """
+    return pd.Series(values).groupby(segment, sort=False).cumsum().to_numpy()
+
+
+def _floored_cumsum(count: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """
+    Позиция после каждой сделки, которая не опускается ниже нуля: q[t] = max(q[t - 1] + count[t], 0).
+    Это накопленная сумма минус ее накопленный минимум, если он отрицательный.
+    """
+    total = _segment_cumsum(count, group)
+    running_min = pd.Series(total).groupby(group).cummin().to_numpy()
+    return total - np.minimum(running_min, 0.0)
+
+
+def _previous(values: np.ndarray, group_start: np.ndarray) -> np.ndarray:
+    """
+    Значение предыдущей сделки той же бумаги (0 для первой сделки).
+    """
+    previous = np.r_[0.0, values[:-1]]
+    previous[group_start] = 0.0
+    return previous
+
+
+def _average_cost(buy, count, amount, quantity, previous_quantity, group, group_start):
+    """
+    Себестоимость по средней цене: покупка добавляет свою стоимость, продажа уменьшает себестоимость
+    пропорционально проданной доле. Рекуррентность C[t] = a[t] * C[t - 1] + b[t] решается через накопленное
+    произведение a (в логарифмах) внутри эпизода - до полного закрытия позиции.
+    """
+    closed = quantity <= EPS
+    episode = np.cumsum(group_start | np.r_[False, closed[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(buy | closed | (previous_quantity <= EPS), 1.0, quantity / previous_quantity)
+    scale = np.exp(_segment_cumsum(np.log(ratio), episode))
+    cost = scale * _segment_cumsum(amount / scale, episode)
+    cost[closed] = 0.0
+    open_lots = (~closed).astype('int64')
+    return cost, open_lots
+
+
+def _fifo_cost(buy, count, amount, group, group_start):
+    """
+    Себестоимость по FIFO. Купленные бумаги каждой бумаги выстраиваются на общей оси накопленного количества
+    (бумаги идут друг за другом), F(u) - стоимость первых u единиц на этой оси. Продажи занимают отрезок оси
+    после всех прежних продаж, поэтому себестоимость оставшихся бумаг - стоимость всех покупок минус F(проданное).
+    count продаж не больше позиции (_floored_cumsum), поэтому проданное не выходит за лоты своей бумаги,
+    купленные к этой сделке; поиск лота дополнительно ограничен ими.
+    """
+    bought = np.where(buy, count, 0.0)
+    sold = np.where(buy, 0.0, -count)
+    total_bought = np.cumsum(bought)
+    total_cost = np.cumsum(amount)
+    # начало оси бумаги - все, что куплено по предыдущим бумагам
+    offset = np.repeat((total_bought - bought)[group_start], np.bincount(group))
+    total_sold = offset + _segment_cumsum(sold, group)
+
+    lot_end, lot_cost_end = total_bought[buy], total_cost[buy]
+    lot_price = amount[buy] / count[buy]
+    if len(lot_end) == 0:
+        return np.zeros(len(count)), np.zeros(len(count), dtype='int64')
+    # лот, в котором находится точка оси (первый лот с концом не раньше точки)
+    bought_lots = np.cumsum(buy)
+    lot = np.clip(np.searchsorted(lot_end, total_sold - EPS, side='left'), 0, np.maximum(bought_lots - 1, 0))
+    sold_cost = lot_cost_end[lot] - (lot_end[lot] - total_sold) * lot_price[lot]
+    cost = total_cost - sold_cost
+    # открытые лоты: куплено к этой сделке минус полностью проданные (у предыдущих бумаг все лоты до offset)
+    open_lots = bought_lots - np.searchsorted(lot_end, total_sold + EPS, side='right')
+    return cost, open_lots
+
+
+@profiler.track()
+def match_lots(operations: pd.DataFrame, method: str = 'fifo') -> pd.DataFrame:
+    """
+    Результат каждой сделки по методу учета лотов.
+    :param operations: операции load_operations (count со знаком, total_price - денежный поток)
+    :param method: fifo или average (по средней цене)
+    :return: сделки, отсортированные по (isin, dt), с колонками quantity (позиция после сделки),
+        cost_basis (себестоимость позиции), realized_pnl (прибыль продажи), open_lots (число открытых лотов;
+        при учете по средней цене все бумаги - один лот). Продажа сверх позиции учитывается по цене продажи,
+        такие бумаги печатаются
+    """
+    if method not in METHODS:
+        raise ValueError(f'Неизвестный метод учета лотов: {method}')
+    trades = operations.sort_values(by=['isin', 'dt'], kind='stable').reset_index(drop=True)
+    group, _ = pd.factorize(trades['isin'])
+    group_start = np.r_[True, group[1:] != group[:-1]]
+    group = np.cumsum(group_start) - 1
+    trade_count = trades['count'].to_numpy(dtype='float64')
+    total_price = trades['total_price'].to_numpy(dtype='float64')
+    buy = trade_count > 0
+    # стоимость покупки - деньги, которые за нее заплачены
+    amount = np.where(buy, -total_price, 0.0)
+
+    quantity = _floored_cumsum(trade_count, group)
+    quantity[np.abs(quantity) <= EPS] = 0.0
+    # продажи - только бумаги из позиции, остальное - бумаги без покупок в истории
+    count = np.where(buy, trade_count, quantity - _previous(quantity, group_start))
+    oversold = ~buy & (count - trade_count > EPS)
+    if oversold.any():
+        print(f'Продано больше, чем куплено, лишние бумаги учтены по цене продажи: '
+              f'{", ".join(map(str, pd.unique(trades["isin"].to_numpy()[oversold])))}')
+    if method == 'fifo':
+        cost, open_lots = _fifo_cost(buy, count, amount, group, group_start)
+    else:
+        cost, open_lots = _average_cost(buy, count, amount, quantity, quantity - count, group, group_start)
+    cost[quantity <= EPS] = 0.0
+    previous_cost = _previous(cost, group_start)
+    trades['quantity'] = quantity
+    trades['cost_basis'] = cost
+    # прибыль продажи: выручка за бумаги из позиции минус их себестоимость
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matched_share = np.where(buy | (trade_count == 0), 1.0, count / trade_count)
+    trades['realized_pnl'] = np.where(buy, 0.0, total_price * matched_share - (previous_cost - cost))
+    trades['open_lots'] = open_lots
+    return trades
+
+
+@profiler.track()
+def lot_positions(operations: pd.DataFrame, method: str = 'fifo',
+                  datetime_range: Optional[pd.DatetimeIndex] = None) -> pd.DataFrame:
+    """
+    Дневная панель позиций по методу учета лотов в формате ts_briefcase_ticker_prices: buy_price -
+    себестоимость оставшихся бумаг, avg_price - их средняя цена, realized_pnl - реализованная прибыль
+    с начала истории, open_lots - число открытых лотов. Закрытые позиции остаются в панели
+    с нулевым количеством, чтобы не терять их реализованную прибыль.
+    :param datetime_range: дни панели (по умолчанию от первой операции до T-1)
+    """
+    datetime_range = get_indexes(operations) if datetime_range is None else datetime_range
+    columns = ['date', 'isin', 'figi', 'ticker', 'instrument_type', 'quantity', 'buy_price', 'avg_price',
+               'realized_pnl', 'open_lots']
+    if operations.empty or len(datetime_range) == 0:
+        return pd.DataFrame(columns=columns)
+    trades = match_lots(operations, method)
+    group, isins = pd.factorize(trades['isin'])
+    trades['realized_pnl'] = _segment_cumsum(trades['realized_pnl'].to_numpy(), group)
+    day = trades['dt'].to_numpy(dtype='datetime64[D]').astype('int64')
+
+    # дни каждой бумаги: от первой сделки (или начала диапазона) до конца диапазона
+    first_day = np.datetime64(datetime_range[0], 'D').astype('int64')
+    last_day = np.datetime64(datetime_range[-1], 'D').astype('int64')
+    start_day = np.maximum(np.minimum.reduceat(day, np.flatnonzero(np.r_[True, np.diff(group) != 0])), first_day)
+    n_days = np.maximum(last_day - start_day + 1, 0)
+    panel_isin = np.repeat(np.arange(len(isins)), n_days)
+    panel_day = np.repeat(start_day - np.r_[0, np.cumsum(n_days)[:-1]], n_days) + np.arange(n_days.sum())
+    # состояние на конец дня - последняя сделка бумаги не позже этого дня
+    base_day = min(day.min(), first_day)
+    state = np.searchsorted((group << ISIN_KEY_SHIFT) + (day - base_day),
+                            (panel_isin << ISIN_KEY_SHIFT) + (panel_day - base_day), side='right') - 1
+
+    instruments = trades.drop_duplicates(subset='isin', keep='last').set_index('isin')
+    panel = pd.DataFrame({
+        'date': (panel_day.astype('datetime64[D]')).astype('datetime64[ns]'),
+        'isin': isins.take(panel_isin),
+    })
+    for column in ('figi', 'ticker', 'instrument_type'):
+        panel[column] = instruments[column].reindex(isins).to_numpy().take(panel_isin)
+    for column, source in (('quantity', 'quantity'), ('buy_price', 'cost_basis'), ('realized_pnl', 'realized_pnl'),
+                           ('open_lots', 'open_lots')):
+        panel[column] = trades[source].to_numpy().take(state)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        panel['avg_price'] = np.where(panel['quantity'] > 0, panel['buy_price'] / panel['quantity'], np.nan)
+    # порядок бумаг - по первой операции, как в ts_briefcase_ticker_prices
+    first_operation = trades.groupby(group)['dt'].min().rank(method='first').to_numpy()
+    order = np.lexsort((panel_day, first_operation.take(panel_isin)))
+    return panel[columns].take(order).reset_index(drop=True)
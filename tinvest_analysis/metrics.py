@@ -0,0 +1,219 @@
+"""
+Риск-метрики по дневной панели портфеля (результат enrichment_ticker_prices): дневная доходность портфеля,
+типов активов и бумаг, скользящие волатильность, коэффициенты Шарпа и Сортино, просадка и скользящие
+попарные корреляции. Все расчеты - операции над матрицами (день x группа) NumPy, без циклов по группам и парам.
+
+Панель содержит все календарные дни, поэтому по умолчанию окна задаются в днях календаря,
+а годовые значения считаются по 365 периодам в году.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.analysis import PanelIndex
+
+
+PERIODS_PER_YEAR = 365
+PORTFOLIO = 'portfolio'
+
+
+def _position_pnl(df: pd.DataFrame) -> Tuple[pd.DatetimeIndex, np.ndarray, np.ndarray, pd.Series]:
+    """
+    Дневной результат (изменение profit_money) и вложенная за день сумма по каждой бумаге: матрицы (день x бумага).
+    Покупки и продажи меняют стоимость и затраты одинаково, поэтому изменение profit_money - это результат
+    без учета движения денег. Вложенная сумма - стоимость на конец предыдущего дня (quantity * close_price)
+    плюс покупки за день (рост buy_price): покупки считаются сделанными в начале дня.
+    Дни, когда у бумаги нет цены сегодня или вчера, не учитываются (0 в обеих матрицах).
+    Для панели по учету лотов (колонка realized_pnl) результат включает реализованную прибыль.
+    :return: дни, результат, вложенная сумма, индекс первой строки каждой бумаги в панели
+    """
+    df = df.df if isinstance(df, PanelIndex) else df
+    dates = df['date'].to_numpy(dtype='datetime64[D]')
+    first_day = dates.min()
+    day = (dates - first_day).astype('int64')
+    n_days = int(day.max()) + 1
+    position, positions = pd.factorize(df['isin'])
+    n_positions = len(positions)
+
+    profit = df['profit_money'].to_numpy(dtype='float64')
+    if 'realized_pnl' in df:
+        # в панели по учету лотов profit_money - только нереализованная прибыль, продажи переносят ее в realized_pnl
+        profit = profit + df['realized_pnl'].to_numpy(dtype='float64')
+    value = df['quantity'].to_numpy(dtype='float64') * df['close_price'].to_numpy(dtype='float64')
+    cost = df['buy_price'].to_numpy(dtype='float64')
+    cell = day * n_positions + position
+    size = n_days * n_positions
+    # несколько строк одной бумаги за день (разные FIGI) суммируются; NaN в любой из них помечает весь день
+    missing = np.bincount(cell, weights=np.isnan(profit) | np.isnan(value), minlength=size) > 0
+    present = np.bincount(cell, minlength=size) > 0
+    profit = np.bincount(cell, weights=np.nan_to_num(profit), minlength=size).reshape(n_days, n_positions)
+    value = np.bincount(cell, weights=np.nan_to_num(value), minlength=size).reshape(n_days, n_positions)
+    cost = np.bincount(cell, weights=np.nan_to_num(cost), minlength=size).reshape(n_days, n_positions)
+    known = (present & ~missing).reshape(n_days, n_positions)
+
+    valid = known[1:] & known[:-1]
+    pnl = np.where(valid, profit[1:] - profit[:-1], 0.0)
+    base = np.where(valid, value[:-1] + np.maximum(cost[1:] - cost[:-1], 0.0), 0.0)
+    days = pd.date_range(first_day, periods=n_days, freq='1D')[1:]
+    first_rows = pd.Series(np.arange(len(df))).groupby(position).first()
+    return days, pnl, base, first_rows
+
+
+def daily_returns(df, by: Optional[str] = None) -> pd.DataFrame:
+    """
+    Дневная доходность (доля) портфеля или его частей: результат дня, деленный на вложенную за день сумму
+    (стоимость на начало дня и покупки за день).
+    :param df: дневная панель портфеля или PanelIndex
+    :param by: None - портфель целиком (колонка portfolio), 'investemnt_object_type' - по типам активов,
+        'ticker' - по бумагам
+    :return: DataFrame (день x группа); NaN, если в группе за день ничего не было вложено
+    """
+    if len(df.df if isinstance(df, PanelIndex) else df) == 0:
+        # пустая панель (новый счет): дней нет
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='date'),
+                            columns=pd.Index([] if by else [PORTFOLIO], name=by or 'group'), dtype='float64')
+    days, pnl, base, first_rows = _position_pnl(df)
+    df = df.df if isinstance(df, PanelIndex) else df
+    if by is None:
+        group, groups = np.zeros(pnl.shape[1], dtype='int64'), pd.Index([PORTFOLIO])
+    else:
+        # атрибут бумаги не меняется - берем его из первой строки
+        group, groups = pd.factorize(df[by].take(first_rows.values), sort=True)
+    # суммы по группам: бумаги одной группы стоят рядом после сортировки столбцов; бумаги без группы (-1) не нужны
+    order = np.argsort(group, kind='stable')
+    order = order[group[order] >= 0]
+    if len(order) == 0:
+        # ни у одной бумаги группа не известна (например, только фонды или бумаги без котировок)
+        return pd.DataFrame(index=pd.Index(days, name='date'), columns=pd.Index([], name=by), dtype='float64')
+    starts = np.flatnonzero(np.r_[True, np.diff(group[order]) != 0])
+    group_pnl = np.add.reduceat(pnl[:, order], starts, axis=1)
+    group_base = np.add.reduceat(base[:, order], starts, axis=1)
+    returns = np.divide(group_pnl, group_base, out=np.full_like(group_pnl, np.nan), where=group_base > 0)
+    columns = pd.Index(np.asarray(groups)[group[order][starts]], name=by or 'group')
+    return pd.DataFrame(returns, index=pd.Index(days, name='date'), columns=columns)
+
+
+def _rolling_sum(x: np.ndarray, window: int) -> np.ndarray:
+    """
+    Скользящая сумма по строкам через накопленную сумму; первые window - 1 строк - сумма с начала.
+    """
+    total = np.cumsum(x, axis=0)
+    total[window:] = total[window:] - total[:-window]
+    return total
+
+
+def _rolling_moments(returns: np.ndarray, window: int, min_periods: int):
+    """
+    Число наблюдений, среднее и выборочная дисперсия в скользящем окне; пропуски не учитываются.
+    """
+    valid = ~np.isnan(returns)
+    values = np.where(valid, returns, 0.0)
+    count = _rolling_sum(valid.astype('float64'), window)
+    total = _rolling_sum(values, window)
+    total_sq = _rolling_sum(values ** 2, window)
+    enough = count >= max(min_periods, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(enough, total / count, np.nan)
+        variance = np.where(enough & (count > 1), (total_sq - total * mean) / (count - 1), np.nan)
+    return count, mean, np.maximum(variance, 0.0)
+
+
+def _daily_risk_free(risk_free: float, periods_per_year: int) -> float:
+    return (1 + risk_free) ** (1 / periods_per_year) - 1
+
+
+def rolling_metrics(returns: pd.DataFrame, window: int = 30, min_periods: int = None, risk_free: float = 0.0,
+                    periods_per_year: int = PERIODS_PER_YEAR) -> pd.DataFrame:
+    """
+    Скользящие годовые волатильность, коэффициенты Шарпа и Сортино по каждой колонке daily_returns.
+    :param window: размер окна в днях
+    :param min_periods: минимум дней с доходностью в окне (по умолчанию window)
+    :param risk_free: годовая безрисковая ставка (доля)
+    :return: DataFrame с колонками (метрика, группа)
+    """
+    min_periods = window if min_periods is None else min_periods
+    excess = returns.to_numpy(dtype='float64') - _daily_risk_free(risk_free, periods_per_year)
+    count, mean, variance = _rolling_moments(excess, window, min_periods)
+    downside = _rolling_sum(np.where(excess < 0, excess, 0.0) ** 2, window)
+    annual = np.sqrt(periods_per_year)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        volatility = np.sqrt(variance)
+        downside_deviation = np.where(np.isnan(mean), np.nan, np.sqrt(downside / count))
+        metrics = {
+            'volatility': volatility * annual,
+            'sharpe': np.where(volatility > 0, mean / volatility * annual, np.nan),
+            'sortino': np.where(downside_deviation > 0, mean / downside_deviation * annual, np.nan),
+        }
+    return pd.concat({name: pd.DataFrame(value, index=returns.index, columns=returns.columns)
+                      for name, value in metrics.items()}, axis=1, names=['metric'])
+
+
+def drawdown(returns: pd.DataFrame) -> pd.DataFrame:
+    """
+    Просадка (доля, <= 0) относительно предыдущего максимума накопленной доходности; пропуски - нулевая доходность.
+    """
+    wealth = np.cumprod(1 + np.nan_to_num(returns.to_numpy(dtype='float64')), axis=0)
+    peak = np.maximum.accumulate(np.maximum(wealth, 1.0), axis=0)
+    return pd.DataFrame(wealth / peak - 1, index=returns.index, columns=returns.columns)
+
+
+def risk_summary(returns: pd.DataFrame, risk_free: float = 0.0,
+                 periods_per_year: int = PERIODS_PER_YEAR) -> pd.DataFrame:
+    """
+    Метрики за весь период по каждой колонке daily_returns: годовая доходность и волатильность (%),
+    коэффициенты Шарпа и Сортино, максимальная просадка (%) и число дней с доходностью.
+    """
+    values = returns.to_numpy(dtype='float64')
+    excess = values - _daily_risk_free(risk_free, periods_per_year)
+    count = (~np.isnan(values)).sum(axis=0)
+    annual = np.sqrt(periods_per_year)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=0) / count
+        mean_excess = np.nansum(excess, axis=0) / count
+        volatility = np.sqrt(np.nansum((excess - mean_excess) ** 2, axis=0) / (count - 1))
+        downside_deviation = np.sqrt(np.nansum(np.minimum(excess, 0) ** 2, axis=0) / count)
+        summary = pd.DataFrame({
+            'return': mean * periods_per_year * 100,
+            'volatility': np.where(count > 1, volatility * annual * 100, np.nan),
+            'sharpe': np.where((count > 1) & (volatility > 0), mean_excess / volatility * annual, np.nan),
+            'sortino': np.where(downside_deviation > 0, mean_excess / downside_deviation * annual, np.nan),
+            'max_drawdown': drawdown(returns).min().to_numpy() * 100,
+            'days': count,
+        }, index=returns.columns)
+    return summary.round(2)
+
+
+def rolling_correlations(returns: pd.DataFrame, window: int = 90, min_periods: int = None,
+                         chunk_size: int = 512) -> pd.DataFrame:
+    """
+    Скользящие корреляции Пирсона всех пар колонок daily_returns. В каждой паре учитываются только дни,
+    когда известны обе доходности. Суммы окна считаются накопленными суммами сразу для блока из chunk_size
+    пар, поэтому объем промежуточной памяти ограничен блоком, а не числом пар.
+    Для корреляций только за последнее окно достаточно передать returns.iloc[-window:].
+    :return: DataFrame (день x пара) с колонками (группа 1, группа 2)
+    """
+    min_periods = window if min_periods is None else min_periods
+    values = returns.to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+    valid = valid.astype('float64')
+    first, second = np.triu_indices(values.shape[1], k=1)
+    result = np.empty((len(values), len(first)))
+    for start in range(0, len(first), chunk_size):
+        i, j = first[start:start + chunk_size], second[start:start + chunk_size]
+        x, y = values[:, i], values[:, j]
+        x_valid, y_valid = valid[:, i], valid[:, j]
+        count = _rolling_sum(x_valid * y_valid, window)
+        sum_x = _rolling_sum(x * y_valid, window)
+        sum_y = _rolling_sum(y * x_valid, window)
+        covariance = _rolling_sum(x * y, window) - sum_x * sum_y / np.maximum(count, 1)
+        variance_x = _rolling_sum(x ** 2 * y_valid, window) - sum_x ** 2 / np.maximum(count, 1)
+        variance_y = _rolling_sum(y ** 2 * x_valid, window) - sum_y ** 2 / np.maximum(count, 1)
+        denominator = np.sqrt(np.maximum(variance_x, 0) * np.maximum(variance_y, 0))
+        enough = (count >= max(min_periods, 2)) & (denominator > 1e-12 * np.maximum(count, 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[:, start:start + chunk_size] = np.where(enough, np.clip(covariance / denominator, -1, 1), np.nan)
+    columns = pd.MultiIndex.from_arrays([returns.columns[first], returns.columns[second]],
+                                        names=[f'{returns.columns.name} 1', f'{returns.columns.name} 2'])
+    return pd.DataFrame(result, index=returns.index, columns=columns)
@@ -0,0 +1,187 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+
+from tinvest_analysis.analysis import investment_type_ration, investment_type_profit, correlation_type_profit, \
+    profit_by_ticker, realized_profit_by_ticker, currency_ration, PanelIndex
+from tinvest_analysis.fx import FxRates, convert_operations, convert_quotes, instrument_currencies, cash_balances
+from tinvest_analysis.lots import lot_positions
+from tinvest_analysis.metrics import daily_returns, risk_summary
+from tinvest_analysis.processing import load_operations, ts_briefcase_ticker_prices, enrichment_ticker_prices, \
+    compact_frame, memory_usage_mb, load_cash_balances
+from tinvest_analysis.snapshot import PanelSnapshot, update_panel
+from tinvest_analysis.utils.cache import StageCache
+from tinvest_analysis.utils.fs import ARTIFACTS_DIR
+from tinvest_analysis.utils.profiling import profiler
+from tinvest_analysis.utils.storage import Storage
+
+
+# имя сводного портфеля по всем счетам в пакетном режиме
+ALL_ACCOUNTS = 'all_accounts'
+
+# котировки, общие для всех процессов пакетного режима (см. _init_worker)
+_shared_quotes: pd.DataFrame = None
+
+
+def compact_stage(stage, df, compact):
+    """
+    В компактном режиме переводит результат шага в Categorical/меньшие типы и печатает занимаемую память.
+    """
+    if not compact:
+        return df
+    memory_before = memory_usage_mb(df)
+    df = compact_frame(df)
+    print(f'{stage}: {memory_before:.1f} MB -> {memory_usage_mb(df):.1f} MB')
+    return df
+
+
+def build_panel(operations: pd.DataFrame, quotes: pd.DataFrame, compact: bool = False,
+                snapshot: PanelSnapshot = None, reprice_days: int = 7, cache: StageCache = None,
+                cost_basis: str = None, fx_rates: FxRates = None) -> pd.DataFrame:
+    """
+    Дневная панель портфеля с ценами и доходностью.
+    :param snapshot: снимок предыдущего расчета; если задан, пересчитываются только новые дни (см. update_panel)
+    :param cache: кэш результатов шагов; со снимком в нем хранится панель последней версии снимка
+    :param cost_basis: None - buy_price как сумма денежных потоков (ts_briefcase_ticker_prices), fifo или
+        average - себестоимость по учету лотов (lot_positions): profit_money - нереализованная прибыль,
+        realized_pnl - реализованная
+    :param fx_rates: курсы валют; операции и котировки бумаг в валюте пересчитываются в валюту отчета,
+        без курсов такие операции не учитываются. Валюта торгов бумаги - колонка trade_currency панели
+    """
+    currencies = instrument_currencies(operations)
+    operations = convert_operations(operations, fx_rates)
+    quotes = convert_quotes(quotes, fx_rates, currencies)
+    briefcase_ticker_price = _build_panel(operations, quotes, compact, snapshot, reprice_days, cache, cost_basis,
+                                          fx_rates)
+    if currencies:
+        briefcase_ticker_price = briefcase_ticker_price.assign(
+            trade_currency=briefcase_ticker_price['isin'].astype(object).map(currencies))
+    return briefcase_ticker_price
+
+
+def _build_panel(operations, quotes, compact, snapshot, reprice_days, cache, cost_basis, fx_rates):
+    cache = cache or StageCache(enabled=False)
+    if snapshot is not None:
+        if cost_basis is not None:
+            raise ValueError('Снимок панели не поддерживает учет лотов (cost_basis)')
+        briefcase_ticker_price = update_panel(operations, quotes, snapshot, reprice_days, cache, fx_rates)
+        return compact_stage('update_panel', briefcase_ticker_price, compact)
+    if cost_basis is None:
+        briefcase_ticker_price = cache.run('ts_briefcase_ticker_prices', ts_briefcase_ticker_prices, operations)
+        briefcase_ticker_price = compact_stage('ts_briefcase_ticker_prices', briefcase_ticker_price, compact)
+    else:
+        briefcase_ticker_price = cache.run('lot_positions', lot_positions, operations, cost_basis)
+        briefcase_ticker_price = compact_stage('lot_positions', briefcase_ticker_price, compact)
+    briefcase_ticker_price = cache.run('enrichment_ticker_prices', enrichment_ticker_prices,
+                                       briefcase_ticker_price, quotes)
+    briefcase_ticker_price = compact_stage('enrichment_ticker_prices', briefcase_ticker_price, compact)
+    return briefcase_ticker_price
+
+
+@profiler.track()
+def build_reports(briefcase_ticker_price, cash: pd.DataFrame = None) -> Dict[str, pd.DataFrame]:
+    """
+    :param briefcase_ticker_price: панель или уже построенный по ней PanelIndex (его же принимает save_charts)
+    :param cash: остатки денежных средств в валюте отчета (cash_balances) для валютной структуры портфеля
+    """
+    # сортировка, последний день и суммы по (дата, тип актива) считаются один раз для всех отчетов
+    panel = PanelIndex.of(briefcase_ticker_price)
+    profit_by_type_date, type_profit_agg = investment_type_profit(panel)
+    reports = {
+        'Процентное соотношение по типам активов:': investment_type_ration(panel),
+        'Прибыль по типам активов:': type_profit_agg,
+        'Корреляция прибыли по типам активов:': correlation_type_profit(profit_by_type_date),
+        'Прибыли текущих активов:': profit_by_ticker(panel),
+        'Риски портфеля и типов активов:': risk_summary(pd.concat(
+            [daily_returns(panel), daily_returns(panel, 'investemnt_object_type')], axis=1)),
+    }
+    if 'trade_currency' in panel.df or cash is not None:
+        reports['Валютная структура портфеля:'] = currency_ration(panel, cash)
+    if 'realized_pnl' in panel.df:
+        reports['Реализованная и нереализованная прибыль:'] = realized_profit_by_ticker(panel)
+    return reports
+
+
+def print_reports(reports: Dict[str, pd.DataFrame]):
+    for i, (title, report) in enumerate(reports.items()):
+        if i > 0:
+            print()
+        print(title, report, sep='\n')
+
+
+@profiler.track()
+def save_charts(briefcase_ticker_price, operations, folder: Path, by_type: bool = True, by_ticker: bool = False,
+                max_points: int = 2000, downsample: str = 'lttb', max_workers: int = None) -> pd.DataFrame:
+    """
+    Графики доходности портфеля, каждого типа активов и (by_ticker) каждой текущей бумаги в папке folder.
+    Ряды считаются один раз в текущем процессе и прореживаются до max_points точек,
+    отрисовка идет в max_workers процессах.
+    :param briefcase_ticker_price: панель или уже построенный по ней PanelIndex (например, для build_reports)
+    :return: время отрисовки и число точек каждого графика
+    """
+    # matplotlib импортируется только для графиков: без него отчеты запускаются заметно быстрее
+    from tinvest_analysis.charts import portfolio_chart_job, type_chart_jobs, ticker_chart_jobs, render_charts
+
+    panel = PanelIndex.of(briefcase_ticker_price)
+    jobs = [portfolio_chart_job(panel, operations, Path(folder) / 'portfolio.png', max_points, downsample)]
+    if by_type:
+        jobs += type_chart_jobs(panel, folder, max_points, downsample)
+    if by_ticker:
+        jobs += ticker_chart_jobs(panel, operations, folder, max_points, downsample)
+    return render_charts(jobs, max_workers)
+
+
+def _init_worker(quotes):
+    global _shared_quotes
+    _shared_quotes = quotes
+
+
+def _run_accounts(name, account_types, splits, storage, compact, incremental, reprice_days, cache, chart,
+                  cost_basis=None, fx_rates=None, chart_options=None):
+    """
+    Полный расчет по одному счету (или по нескольким счетам как по одному портфелю) в отдельном процессе.
+    """
+    operations = pd.concat(
+        [cache.run('load_operations', load_operations, account_type, splits, storage)
+         for account_type in account_types],
+        axis=0, ignore_index=True)
+    snapshot = PanelSnapshot(name) if incremental else None
+    briefcase_ticker_price = build_panel(operations, _shared_quotes, compact, snapshot, reprice_days, cache,
+                                         cost_basis, fx_rates)
+    panel = PanelIndex(briefcase_ticker_price)
+    reports = build_reports(panel, cash_balances(load_cash_balances(account_types), fx_rates))
+    if chart:
+        chart_options = dict(chart_options or {})
+        # счета и так считаются в отдельных процессах: по умолчанию графики счета рисуются в его процессе
+        chart_options['max_workers'] = chart_options.get('max_workers') or 1
+        save_charts(panel, convert_operations(operations, fx_rates), ARTIFACTS_DIR / 'charts' / name,
+                    **chart_options)
+    return reports
+
+
+def run_batch(accounts: List[str], splits, storage: Storage, quotes: pd.DataFrame, max_workers: int = None,
+              compact: bool = False, incremental: bool = False,
+              reprice_days: int = 7, cache: StageCache = None,
+              chart: bool = True, cost_basis: str = None,
+              fx_rates: FxRates = None, chart_options: dict = None) -> Dict[str, Dict[str, pd.DataFrame]]:
+    """
+    Анализ всех счетов и сводного портфеля по всем счетам в пуле процессов.
+    Котировки загружаются один раз и передаются каждому процессу при запуске.
+    :param incremental: пересчитывать панель каждого счета от его сохраненного снимка
+    :param chart: сохранять графики доходности каждого счета в artifacts/charts/{счет}
+    :param chart_options: параметры save_charts (секция charts)
+    :param cost_basis: учет лотов (fifo или average), см. build_panel
+    :param fx_rates: курсы валют, см. build_panel
+    """
+    cache = cache or StageCache(enabled=False)
+    jobs = {account_type: [account_type] for account_type in accounts}
+    jobs[ALL_ACCOUNTS] = list(accounts)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(quotes,)) as executor:
+        futures = {
+            name: executor.submit(_run_accounts, name, account_types, splits, storage, compact,
+                                  incremental, reprice_days, cache, chart, cost_basis, fx_rates, chart_options)
+            for name, account_types in jobs.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
@@ -1,39 +1,134 @@
 import datetime as dt
+import json
+from typing import Sequence, TYPE_CHECKING
 
+import numpy as np
 import pandas as pd
 
-from tinvest_analysis.loaders.investfound import InvestFounds
-from tinvest_analysis.loaders.tinkoff import Tinkoff
-from tinvest_analysis.utils.fs import TINKOFF_DIR, HISTORY_QUOTE_DIR
+from tinvest_analysis.utils.fs import TINKOFF_DIR
+from tinvest_analysis.utils.metadata import MetadataStore
+from tinvest_analysis.utils.profiling import profiler
+from tinvest_analysis.utils.storage import Storage, CsvStorage
 
+if TYPE_CHECKING:
+    from tinvest_analysis.loaders.tinkoff import Tinkoff
 
-def parse_broker_operations(token: str):
+
+# сколько младших бит ключа (ISIN, день) отведено под номер дня
+ISIN_KEY_SHIFT = 20
+# атрибуты бумаги, повторяющиеся в каждой строке панели
+CATEGORICAL_COLUMNS = ('isin', 'figi', 'ticker', 'instrument_type', 'investemnt_object_type', 'geography',
+                       'currency')
+
+
+@profiler.track()
+def parse_broker_operations(token: str, metadata: MetadataStore = None, full_refresh: bool = False,
+                            overlap_days: int = 3, storage: Storage = None, window_months: int = 1,
+                            **client_options):
     """
     Получение списка операций в портфеле от Тинькофф.
+    :param full_refresh: загрузить всю историю операций заново, а не только новые операции
+    :param overlap_days: на сколько дней раньше последней синхронизации запрашиваются операции
+    :param window_months: размер окна (в месяцах), которым операции запрашиваются и пишутся в хранилище
+    :param client_options: настройки клиента Tinkoff (max_workers, rate_limit, retries, use_catalog)
     """
-    client = Tinkoff(token=token)
+    # загрузчики (tinvest, requests) импортируются только при загрузке: отчету по локальным данным они не нужны
+    from tinvest_analysis.loaders.tinkoff import Tinkoff
+
+    storage = storage or CsvStorage()
+    client = Tinkoff(token=token, metadata=metadata, **client_options)
     accounts = client.get_broker_accounts()
     for account_type, account_id in accounts.items():
         folder = TINKOFF_DIR / account_type
         folder.mkdir(exist_ok=True)
         currencies = client.get_portfolio_currencies(account_id)
-        operations = client.get_operations(account_id)
         currencies.to_csv(folder / 'currencies.csv', index=False, header=True)
-        operations.to_csv(folder / 'operations.csv', index=True, header=True)
+        sync_operations(client, account_type, account_id, storage, full_refresh, overlap_days, window_months)
+    if metadata:
+        metadata.save()
     return list(accounts.keys())
 
 
-def parse_financial_quote(account_type):
+def sync_operations(client: 'Tinkoff', account_type: str, account_id: str, storage: Storage,
+                    full_refresh: bool = False, overlap_days: int = 3, window_months: int = 1):
+    """
+    Инкрементальная загрузка операций по счету.
+    Запрашиваются только операции после последней синхронизации (с запасом overlap_days),
+    новые по id операции дописываются в хранилище.
+    Операции загружаются окнами по window_months месяцев, каждое окно сразу пишется в хранилище;
+    в конце накопленные части операций счета сливаются (Storage.compact_operations).
+    """
+    state_path = TINKOFF_DIR / account_type / 'sync.json'
+    date_from = None
+    if not full_refresh and storage.has_operations(account_type) and state_path.exists():
+        state = json.loads(state_path.read_text())
+        date_from = dt.datetime.fromisoformat(state['high_water_mark']) - dt.timedelta(days=overlap_days)
+    high_water_mark = dt.datetime.now()
+
+    # при полной загрузке первое окно перезаписывает операции счета, следующие - дописываются
+    stored_ids = storage.operation_ids(account_type) if date_from is not None else None
+    for operations in client.iter_operations(account_id, date_from, high_water_mark, window_months):
+        if stored_ids is None:
+            storage.write_operations(account_type, operations)
+            stored_ids = pd.Index([])
+            continue
+        # завершенные операции не меняются, поэтому достаточно дописать отсутствующие id
+        operations = operations[~operations.index.astype(str).isin(stored_ids)]
+        if not operations.empty:
+            storage.append_operations(account_type, operations)
+    if stored_ids is None:
+        return
+    storage.compact_operations(account_type)
+    state_path.write_text(json.dumps({'high_water_mark': high_water_mark.isoformat()}))
+
+
+@profiler.track()
+def parse_financial_quote(account_type, metadata: MetadataStore = None, full_refresh: bool = False,
+                          storage: Storage = None, **client_options):
     """
     Парсинг котировок ценных бумаг с сайта InvestFounds.
+    По умолчанию для каждой бумаги запрашиваются только котировки после последней сохраненной даты.
+    :param account_type: счет или список счетов, по бумагам которых загружаются котировки
+    :param full_refresh: загрузить всю историю котировок заново
+    :param client_options: настройки загрузчика InvestFounds (max_workers, rate_limit, ...)
     """
-    operations_path = TINKOFF_DIR / account_type / 'operations.csv'
-    operations = pd.read_csv(operations_path)
+    from tinvest_analysis.loaders.investfound import InvestFounds
+
+    storage = storage or CsvStorage()
+    account_types = [account_type] if isinstance(account_type, str) else account_type
+    operations = pd.concat([storage.read_operations(x, columns=['isin']) for x in account_types])
     isin_list = operations['isin'].dropna().unique()
 
-    client = InvestFounds(isin_list)
+    last_quotes = {}
+    if not full_refresh:
+        for isin in isin_list:
+            last_quote = storage.last_quote(isin)
+            if last_quote is not None:
+                last_quotes[isin] = last_quote
+    date_from = {isin: last_quote['dt'].date() for isin, last_quote in last_quotes.items()}
+
+    client = InvestFounds(isin_list, metadata=metadata, date_from=date_from, **client_options)
     for isin, asset in client.assets.items():
-        asset.chartData.to_csv(HISTORY_QUOTE_DIR / f'{isin}.csv', header=True, index=False)
+        if isin in last_quotes:
+            _append_quotes(storage, isin, asset.chartData, last_quotes[isin])
+        else:
+            storage.write_quotes(isin, asset.chartData)
+    if metadata:
+        metadata.save()
+
+
+def _append_quotes(storage: Storage, isin: str, chart_data: pd.DataFrame, last_quote: pd.Series):
+    """
+    Дописывает в хранилище котировки после последней сохраненной.
+    Котировка за последнюю сохраненную дату приходит повторно и сверяется с сохраненной.
+    """
+    chart_data = chart_data.assign(dt=pd.to_datetime(chart_data['dt']))
+    overlap = chart_data.loc[chart_data['dt'] == last_quote['dt'], 'close_price']
+    if len(overlap) > 0 and abs(overlap.iloc[-1] - last_quote['close_price']) > 1e-9:
+        print(f"{isin}: котировка за {last_quote['dt']:%Y-%m-%d} изменилась "
+              f"({last_quote['close_price']} -> {overlap.iloc[-1]}), рекомендуется полная перезагрузка")
+    storage.append_quotes(isin, chart_data[chart_data['dt'] > last_quote['dt']])
+    storage.compact_quotes(isin)
 
 
 def input_choosing_accounts(accounts):
@@ -47,11 +142,12 @@ def input_choosing_accounts(accounts):
     return accounts[input_index - 1]
 
 
-def load_operations(account_type, splits):
-    operations_path = TINKOFF_DIR / account_type / 'operations.csv'
-    operations = pd.read_csv(operations_path, parse_dates=['dt'])
+@profiler.track()
+def load_operations(account_type, splits, storage: Storage = None):
+    storage = storage or CsvStorage()
+    operations = storage.read_operations(account_type)
     # откидываем все операции, что происходили сегодня
-    operations = operations[operations['dt'].dt.date < dt.date.today()]
+    operations = operations[operations['dt'] < pd.Timestamp.today().normalize()]
     # оставляем только операции покупок и продаж
     operations = operations[operations['operation_type'].isin(['buy', 'sell', 'buy_card'])]
     # преобразуем buy_card в buy
@@ -64,50 +160,265 @@ def load_operations(account_type, splits):
     operations.loc[sell_mask, 'count'] *= -1
 
     # обработка сплита акций
-    for split_event in splits:
-        # маска для операций, проведенных ДО сплита
-        mask = \
-            (operations['isin'] == split_event['isin']) \
-            & (operations['dt'].dt.date <= split_event['date'])
-        operations.loc[mask, 'count'] = operations.loc[mask, 'count'].mul(split_event['ratio'])
-        operations.loc[mask, 'unit_price'] = operations.loc[mask, 'unit_price'].div(split_event['ratio'])
+    operations = apply_split_factors(operations, split_factors(splits), 'dt', multiply=['count'], divide=['unit_price'])
     return operations
 
 
-def load_financial_quotes():
-    quotes = []
-    for path in HISTORY_QUOTE_DIR.iterdir():
-        if not path.suffix == '.csv':
-            continue
-        df = (pd.read_csv(path, parse_dates=['dt'])
-              .rename(columns={'dt': 'date'})
-              .sort_values(by='date')
-              .reset_index(drop=True)
-              .assign(isin=path.stem))
-        df['date'] = df['date'].dt.date
-        # откидываем все котировки, что известны на текущий день
-        df = df[df['date'] < dt.date.today()]
-        quotes.append(df)
-    quotes = pd.concat(quotes, axis=0)
+def load_cash_balances(account_types: Sequence[str]) -> pd.DataFrame:
+    """
+    Остатки денежных средств по счетам (currencies.csv, сохраняется при загрузке операций), суммы по валютам.
+    """
+    balances = [
+        pd.read_csv(TINKOFF_DIR / account_type / 'currencies.csv')
+        for account_type in account_types
+        if (TINKOFF_DIR / account_type / 'currencies.csv').exists()
+    ]
+    if not balances:
+        return pd.DataFrame(columns=['currency', 'balance'])
+    return pd.concat(balances, axis=0, ignore_index=True)
+
+
+def split_factors(splits) -> pd.DataFrame:
+    """
+    Таблица накопленных коэффициентов дробления (isin, date, factor), отсортированная по (isin, date).
+    Для записи бумаги не позже date (и позже предыдущего дробления этой бумаги) количество умножается
+    на factor, а цена делится на него: factor - произведение ratio этого и всех последующих дроблений.
+    """
+    factors = pd.DataFrame(list(splits), columns=['isin', 'date', 'ratio']).astype({'ratio': float})
+    factors['date'] = pd.to_datetime(factors['date']).dt.normalize()
+    factors = factors.sort_values(by=['isin', 'date'], kind='stable').reset_index(drop=True)
+    reversed_factors = factors.iloc[::-1]
+    factors['factor'] = reversed_factors['ratio'].groupby(reversed_factors['isin']).cumprod().iloc[::-1]
+    return factors[['isin', 'date', 'factor']]
+
+
+def apply_split_factors(df: pd.DataFrame, factors: pd.DataFrame, date_column: str,
+                        multiply: Sequence[str] = (), divide: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Пересчет количеств и цен с учетом дроблений за один проход searchsorted по ключу (ISIN, день).
+    Подходит как для операций (count, unit_price), так и для истории котировок (close_price).
+    :param factors: результат split_factors
+    :param multiply: колонки, которые умножаются на коэффициент (количество бумаг)
+    :param divide: колонки, которые делятся на коэффициент (цена одной бумаги)
+    """
+    if factors.empty or df.empty:
+        return df
+    isin_categories = factors['isin'].unique()
+    isin_codes = pd.Categorical(df['isin'], categories=isin_categories).codes
+    factors_key = _isin_day_key(pd.Categorical(factors['isin'], categories=isin_categories).codes, factors['date'])
+    key = _isin_day_key(isin_codes, df[date_column])
+    # первое дробление бумаги в тот же день или позже записи
+    position = np.minimum(np.searchsorted(factors_key, key, side='left'), len(factors_key) - 1)
+    mask = (isin_codes >= 0) & ((factors_key[position] >> ISIN_KEY_SHIFT) == isin_codes) & (factors_key[position] >= key)
+    if not mask.any():
+        return df
+    factor = factors['factor'].to_numpy()[position[mask]]
+    df = df.copy()
+    for column in multiply:
+        df.loc[mask, column] = df.loc[mask, column].mul(factor)
+    for column in divide:
+        df.loc[mask, column] = df.loc[mask, column].div(factor)
+    return df
+
+
+def get_indexes(operations):
+    """
+    Возвращает список дат, между первой операцией и текущем днем недели
+    :param operations:
+    :return:
+    """
+    min_date = operations['dt'].min().normalize()
+    # будем всегда смотреть на отчет Т-1
+    today = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    # будет являться индексом для нового DataFrame
+    datetime_range = pd.date_range(start=min_date, end=today, freq='1D')
+    return datetime_range
+
+
+@profiler.track()
+def ts_briefcase_ticker_prices(operations) -> pd.DataFrame:
+    """
+    Состояние портфеля по каждой бумаге в разрезе дней.
+    Панель (дата x бумага) строится за один проход, без цикла по бумагам.
+    """
+    datetime_range = get_indexes(operations)
+    ts_aggregate = aggregate_operations(operations)
+    return expand_positions(ts_aggregate, datetime_range)
+
+
+def aggregate_operations(operations) -> pd.DataFrame:
+    """
+    Операции, сгруппированные по дням и бумагам, с накопленными количеством (quantity)
+    и стоимостью покупок (buy_price) на конец каждого дня.
+    """
+    operations = operations.copy()
+    # считаем данные по каждому тикеру в разрезе дней
+    operations['date'] = operations['dt'].dt.normalize()
+    ts_aggregate = operations\
+        .groupby(['date', 'isin', 'figi', 'ticker', 'instrument_type'], as_index=False)\
+        .agg(
+            quantity=('count', 'sum'),
+            balance_change=('total_price', 'sum')
+        )\
+        .sort_values(by='date', kind='stable')
+    # умножаем на (-1) поскольку считаем текущую (по покупкам) цену
+    grouped_data = ts_aggregate.groupby(['isin', 'figi', 'ticker', 'instrument_type'])
+    ts_aggregate['buy_price'] = (-1) * grouped_data['balance_change'].cumsum()
+    ts_aggregate['quantity'] = grouped_data['quantity'].cumsum()
+    return ts_aggregate
+
+
+def expand_positions(ts_aggregate: pd.DataFrame, datetime_range: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    Разворачивает накопленные значения aggregate_operations на каждый день datetime_range.
+    В день операций по бумаге берутся сами строки aggregate_operations (по строке на каждую пару figi/тикер,
+    если бумага торгуется под несколькими листингами), в остальные дни - последняя строка бумаги до этого дня,
+    в том числе из дней до начала диапазона.
+    """
+    instrument_keys = ['figi', 'ticker', 'instrument_type']
+    columns = ['date', 'isin', *instrument_keys, 'quantity', 'buy_price', 'avg_price']
+    rows = ts_aggregate.reset_index(drop=True)
+    if rows.empty or len(datetime_range) == 0:
+        return rows.iloc[:0].assign(avg_price=pd.Series(dtype='float64'))[columns]
+
+    # номер последней строки бумаги за день: (дата операции x бумага); пересчет в одну ячейку на день
+    # не зависит от числа листингов бумаги
+    row_number = pd.Series(np.arange(len(rows)), index=pd.MultiIndex.from_arrays([rows['date'], rows['isin']]))
+    last_row = row_number.groupby(level=[0, 1]).last().unstack()
+    # в дни без операций протягивается последняя строка бумаги, в том числе из дней до начала диапазона
+    carried = last_row\
+        .reindex(last_row.index.union(datetime_range))\
+        .ffill()\
+        .reindex(datetime_range)\
+        .mask(last_row.reindex(datetime_range).notna())\
+        .rename_axis(index='date', columns='isin')\
+        .stack()
+    in_range = rows['date'].isin(datetime_range)
+    # до первой операции по бумаге строк нет
+    days = pd.concat([
+        pd.DataFrame({'date': rows.loc[in_range, 'date'].values, 'row': rows.index[in_range]}),
+        pd.DataFrame({'date': carried.index.get_level_values('date'), 'row': carried.values.astype(np.int64)}),
+    ], axis=0, ignore_index=True)
+    # сохраняем порядок бумаг по первой операции, внутри дня - порядок строк aggregate_operations
+    unique_isin = rows['isin'].unique()
+    isin_order = pd.Series(range(len(unique_isin)), index=unique_isin)
+    days = days\
+        .assign(_order=rows['isin'].map(isin_order).values[days['row'].values])\
+        .sort_values(by=['_order', 'date', 'row'], kind='stable')
+    ticker_prices = rows\
+        .iloc[days['row'].values][['isin', *instrument_keys, 'quantity', 'buy_price']]\
+        .assign(date=days['date'].values)\
+        .astype({'quantity': 'float64', 'buy_price': 'float64'})
+    # если бумага была продана полностью, то далее ее не рассматриваем
+    ticker_prices = ticker_prices[ticker_prices['quantity'] > 0]
+    # считаем среднюю цену акции
+    ticker_prices['avg_price'] = ticker_prices['buy_price'] / ticker_prices['quantity']
+    return ticker_prices[columns].reset_index(drop=True)
+
+
+@profiler.track()
+def load_financial_quotes(storage: Storage = None, columns=None, date_from=None, splits=None):
+    """
+    Котировки всех бумаг из хранилища.
+    :param columns: какие колонки читать (по умолчанию - все)
+    :param date_from: котировки начиная с этой даты
+    :param splits: если заданы, цены до дробления пересчитываются в цены после него
+    """
+    storage = storage or CsvStorage()
+    # откидываем все котировки, что известны на текущий день
+    quotes = storage.read_quotes(columns=columns, date_from=date_from, date_to=pd.Timestamp.today().normalize())
+    quotes = quotes\
+        .rename(columns={'dt': 'date'})\
+        .sort_values(by=['isin', 'date'])\
+        .reset_index(drop=True)
+    quotes['date'] = quotes['date'].dt.normalize()
+    if splits:
+        quotes = apply_split_factors(quotes, split_factors(splits), 'date', divide=['close_price'])
     return quotes
 
 
+@profiler.track()
 def enrichment_ticker_prices(briefcase_ticker_price: pd.DataFrame, quotes: pd.DataFrame):
-    # добавляем котировки акций к портфелю ценных бумаг
-    briefcase_ticker_price = pd.merge(
-        briefcase_ticker_price, quotes,
-        left_on=['date', 'isin'],
-        right_on=['date', 'isin'],
-        how='left'
-    ).sort_values(by='date')
-    # заполняем пропуски в зависимости от ценной бумаги
-    ffill_columns = ['close_price', 'investemnt_object_type', 'geography', 'currency']
-    briefcase_ticker_price[ffill_columns] = briefcase_ticker_price.groupby('isin').ffill()[ffill_columns]
+    """
+    Добавляет к портфелю последнюю известную на каждую дату цену закрытия и неизменные атрибуты бумаги.
+    Котировки сортируются один раз по ключу (ISIN, день), цены находятся через searchsorted.
+    """
+    briefcase_ticker_price = briefcase_ticker_price.sort_values(by='date', kind='stable').reset_index(drop=True)
+    # общий словарь ISIN: Categorical-колонки (compact_frame) с разными категориями не мешают соединению
+    isin_categories = pd.unique(np.concatenate([
+        np.asarray(briefcase_ticker_price['isin'].unique()),
+        np.asarray(quotes['isin'].unique())
+    ]))
+    briefcase_isin = pd.Categorical(briefcase_ticker_price['isin'], categories=isin_categories).codes
+    quotes_isin = pd.Categorical(quotes['isin'], categories=isin_categories).codes
+    briefcase_key = _isin_day_key(briefcase_isin, briefcase_ticker_price['date'])
+    quotes_key = _isin_day_key(quotes_isin, quotes['date'])
+
+    # цена закрытия: последняя котировка бумаги не позже даты в портфеле
+    close_price = quotes['close_price'].to_numpy(dtype='float64')
+    known = ~np.isnan(close_price)
+    order = np.argsort(quotes_key[known], kind='stable')
+    sorted_key = quotes_key[known][order]
+    sorted_price = close_price[known][order]
+    position = np.searchsorted(sorted_key, briefcase_key, side='right') - 1
+    found = position >= 0
+    found[found] = (sorted_key[position[found]] >> ISIN_KEY_SHIFT) == briefcase_isin[found]
+    # индексируются только найденные позиции: котировок может не быть совсем (новый счет)
+    price = np.full(len(briefcase_key), np.nan)
+    price[found] = sorted_price[position[found]]
+    briefcase_ticker_price['close_price'] = price
+
+    # тип объекта, география и валюта не меняются - берем их из справочника по ISIN (последняя котировка)
+    static_columns = ['investemnt_object_type', 'geography', 'currency']
+    last_rows = pd.Series(np.arange(len(quotes)))\
+        .groupby(quotes_isin)\
+        .last()\
+        .drop(index=-1, errors='ignore')
+    attributes = quotes[static_columns]\
+        .iloc[last_rows.values]\
+        .set_axis(last_rows.index, axis=0)\
+        .reindex(range(len(isin_categories)))
+    for column in static_columns:
+        briefcase_ticker_price[column] = attributes[column].take(briefcase_isin).values
     # считаем характеристики доходности
     briefcase_ticker_price = calculate_profit(briefcase_ticker_price)
     return briefcase_ticker_price
 
 
+def _isin_day_key(isin_codes: np.ndarray, dates: pd.Series) -> np.ndarray:
+    """
+    Ключ (ISIN, день) в одном int64: код ISIN в старших битах, номер дня - в младших.
+    """
+    days = dates.to_numpy(dtype='datetime64[D]').astype(np.int64)
+    return (isin_codes.astype(np.int64) << ISIN_KEY_SHIFT) + days
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Компактное представление панели: повторяющиеся строковые атрибуты бумаг хранятся как Categorical,
+    целочисленные количества - в наименьшем целом типе, float - во float32, если это без потерь.
+    """
+    df = df.copy()
+    for column in df.columns:
+        series = df[column]
+        if column in CATEGORICAL_COLUMNS and series.dtype == object:
+            df[column] = series.astype('category')
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            # groupby по Categorical сортирует в порядке категорий - он должен совпадать с порядком строк
+            df[column] = series.cat.reorder_categories(series.cat.categories.sort_values())
+        elif pd.api.types.is_float_dtype(series) and series.notna().all() and (series % 1 == 0).all():
+            df[column] = pd.to_numeric(series, downcast='integer')
+        elif series.dtype == 'float64':
+            downcasted = series.astype('float32')
+            if ((downcasted.astype('float64') == series) | series.isna()).all():
+                df[column] = downcasted
+    return df
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
 def calculate_profit(df: pd.DataFrame):
     df['profit_money'] = df['quantity'] * df['close_price'] - df['buy_price']
     df['profit_percent'] = 100 * df['profit_money'] / df['buy_price']
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import shutil
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tinvest_analysis.fx import FxRates
+from tinvest_analysis.processing import aggregate_operations, expand_positions, enrichment_ticker_prices, \
+    get_indexes, CATEGORICAL_COLUMNS
+from tinvest_analysis.utils.cache import StageCache
+from tinvest_analysis.utils.fs import SNAPSHOT_DIR
+from tinvest_analysis.utils.profiling import profiler
+
+
+# версия формата снимка: снимок в другом формате строится заново
+SNAPSHOT_FORMAT = 2
+
+
+class PanelSnapshot:
+    """
+    Сохраненный результат расчета портфеля:
+      * panel/{YYYY}.parquet - дневная панель после enrichment_ticker_prices по годам,
+        строковые атрибуты бумаг - Categorical
+      * aggregate.parquet - накопленное состояние бумаг (aggregate_operations) на момент расчета
+      * meta.json - последний день панели, отпечаток курсов валют и версия снимка
+    Панель и состояние последней версии хранятся и в кэше шагов (StageCache): следующий запуск берет их
+    оттуда, а файлы по годам читает, только если записи в кэше нет.
+    """
+
+    def __init__(self, name: str, root: Path = SNAPSHOT_DIR):
+        self.folder = Path(root) / name
+        self.panel_folder = self.folder / 'panel'
+
+    def exists(self) -> bool:
+        return (self.folder / 'meta.json').exists()
+
+    def meta(self) -> dict:
+        return json.loads((self.folder / 'meta.json').read_text())
+
+    def _cache_key(self, meta: dict) -> str:
+        return hashlib.sha256(f'{self.folder.resolve()} {meta["version"]}'.encode()).hexdigest()[:32]
+
+    def load(self, cache: StageCache = None) -> Tuple[pd.DataFrame, pd.DataFrame, dict]:
+        cache = cache or StageCache(enabled=False)
+        meta = self.meta()
+        cached = cache.get('panel_snapshot', self._cache_key(meta))
+        if cached is not None:
+            return (*cached, meta)
+        panel = pd.concat(
+            [pd.read_parquet(path) for path in sorted(self.panel_folder.glob('*.parquet'))],
+            axis=0, ignore_index=True)
+        ts_aggregate = pd.read_parquet(self.folder / 'aggregate.parquet')
+        cache.put('panel_snapshot', self._cache_key(meta), (panel, ts_aggregate))
+        return panel, ts_aggregate, meta
+
+    def save(self, panel: pd.DataFrame, ts_aggregate: pd.DataFrame, end_date: pd.Timestamp,
+             fx_fingerprint: str = None, since: pd.Timestamp = None, cache: StageCache = None):
+        """
+        :param panel: панель, отсортированная по дате, со строковыми атрибутами в Categorical
+        :param since: перезаписать только годы панели, начиная с года этой даты
+        """
+        if since is None:
+            self.clear()
+        elif self.exists():
+            # без meta.json снимок считается отсутствующим, пока не записан целиком
+            (self.folder / 'meta.json').unlink()
+        self.panel_folder.mkdir(parents=True, exist_ok=True)
+        since_year = None if since is None else since.year
+        for path in self.panel_folder.glob('*.parquet'):
+            if since_year is None or int(path.stem) >= since_year:
+                path.unlink()
+        # панель отсортирована по дате: переписываемые годы - ее хвост
+        start = 0 if since is None else panel['date'].searchsorted(pd.Timestamp(since.year, 1, 1))
+        tail = panel.iloc[start:]
+        years = tail['date'].dt.year.to_numpy()
+        for year in np.unique(years):
+            tail[years == year].to_parquet(self.panel_folder / f'{year}.parquet', index=False)
+        ts_aggregate.to_parquet(self.folder / 'aggregate.parquet', index=False)
+        meta = {'format': SNAPSHOT_FORMAT, 'end_date': end_date.isoformat(), 'fx_rates': fx_fingerprint,
+                'version': uuid.uuid4().hex}
+        (self.folder / 'meta.json').write_text(json.dumps(meta))
+        if cache is not None:
+            cache.put('panel_snapshot', self._cache_key(meta), (panel, ts_aggregate))
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _changed_from(ts_aggregate: pd.DataFrame, old_aggregate: pd.DataFrame, end_date: pd.Timestamp) -> pd.Series:
+    """
+    Для бумаг, у которых изменились операции до end_date включительно (операция задним числом,
+    новый сплит и т.п.), возвращает первый день, с которого панель нужно пересчитать.
+    """
+    columns = ['date', 'isin', 'figi', 'ticker', 'instrument_type', 'quantity', 'balance_change']
+    new = ts_aggregate.loc[ts_aggregate['date'] <= end_date, columns]
+    old = old_aggregate[columns].astype(new.dtypes.to_dict())
+    diff = pd.concat([new, old], axis=0).drop_duplicates(keep=False)
+    return diff.groupby('isin')['date'].min()
+
+
+def _categorical(df: pd.DataFrame) -> pd.DataFrame:
+    return df.astype({x: 'category' for x in CATEGORICAL_COLUMNS if x in df.columns and df[x].dtype == object})
+
+
+def _uncategorical(df: pd.DataFrame) -> pd.DataFrame:
+    return df.astype({x: object for x in df.select_dtypes('category')})
+
+
+def _append(head: pd.DataFrame, tail: pd.DataFrame) -> pd.DataFrame:
+    """
+    head со строковыми атрибутами в Categorical и tail с теми же колонками: новые значения хвоста добавляются
+    в категории, и строки head не переводятся в object.
+    """
+    head, tail = head.copy(), tail.copy()
+    for column in head.select_dtypes('category'):
+        categories = head[column].cat.categories
+        values = pd.Index(tail[column].dropna().unique())
+        head[column] = head[column].cat.add_categories(values.difference(categories))
+        tail[column] = pd.Categorical(tail[column], categories=head[column].cat.categories)
+    return pd.concat([head, tail], axis=0, ignore_index=True)
+
+
+@profiler.track()
+def update_panel(operations: pd.DataFrame, quotes: pd.DataFrame, snapshot: PanelSnapshot,
+                 reprice_days: int = 7, cache: StageCache = None, fx_rates: FxRates = None) -> pd.DataFrame:
+    """
+    Дневная панель портфеля с ценами и доходностью с пересчетом только новых дней.
+    По сохраненному снимку считаются:
+      * для всех бумаг - дни после снимка и последние reprice_days дней снимка (котировки
+        за них могли прийти позже расчета);
+      * для бумаг с изменившимися операциями - все дни начиная с первого изменения.
+    Панель отсортирована по дате, поэтому дни до первого пересчитываемого дня - ее неизменное начало:
+    пересчитывается, склеивается и записывается только хвост.
+    :param reprice_days: сколько последних дней снимка пересчитывать заново
+    :param cache: кэш шагов, в котором хранится панель последней версии снимка
+    :param fx_rates: курсы, по которым пересчитаны operations и quotes; снимок по другим курсам строится заново
+    """
+    datetime_range = get_indexes(operations)
+    ts_aggregate = aggregate_operations(operations)
+    end_date = datetime_range[-1]
+    fx_fingerprint = None if fx_rates is None else fx_rates.fingerprint()
+    loaded = _load(snapshot, fx_fingerprint, cache)
+    if loaded is None:
+        panel = enrichment_ticker_prices(expand_positions(ts_aggregate, datetime_range), quotes)
+        snapshot.save(_categorical(panel), ts_aggregate, end_date, fx_fingerprint, cache=cache)
+        return panel
+
+    old_panel, old_aggregate, meta = loaded
+    old_end_date = pd.Timestamp(meta['end_date'])
+    changed_from = _changed_from(ts_aggregate, old_aggregate, old_end_date)
+    # с какого дня пересчитывается каждая бумага
+    recompute_from = pd.Series(old_end_date - pd.Timedelta(days=reprice_days - 1), index=ts_aggregate['isin'].unique())
+    recompute_from.update(changed_from)
+    recompute_from = recompute_from.clip(lower=datetime_range[0])
+    # изменения бумаг, по которым больше нет операций, тоже попадают в хвост
+    since = min(recompute_from.min(), changed_from.min()) if not changed_from.empty else recompute_from.min()
+
+    new_rows = []
+    for start in recompute_from.unique():
+        isins = recompute_from.index[recompute_from == start]
+        isin_aggregate = ts_aggregate[ts_aggregate['isin'].isin(isins)]
+        isin_range = datetime_range[datetime_range >= start]
+        if len(isin_range) > 0:
+            new_rows.append(expand_positions(isin_aggregate, isin_range))
+    new_rows = pd.concat(new_rows, axis=0, ignore_index=True) if new_rows else None
+
+    # из хвоста снимка убираем пересчитанные дни, а также бумаги, по которым больше нет операций
+    cut = old_panel['date'].searchsorted(since)
+    head, old_tail = old_panel.iloc[:cut], _uncategorical(old_panel.iloc[cut:])
+    keep_until = old_tail['isin'].map(recompute_from)
+    old_tail = old_tail[keep_until.notna() & (old_tail['date'] < keep_until)]
+    if new_rows is not None and not new_rows.empty:
+        tail = pd.concat([old_tail, enrichment_ticker_prices(new_rows, quotes)], axis=0, ignore_index=True)
+        if recompute_from.nunique() > 1:
+            # при одной дате пересчета новые строки и так идут после строк снимка
+            tail = tail.sort_values(by='date', kind='stable')
+    else:
+        tail = old_tail
+    panel = _append(head, tail)
+    snapshot.save(panel, ts_aggregate, end_date, fx_fingerprint, since=since, cache=cache)
+    return _uncategorical(panel)
+
+
+def _load(snapshot: PanelSnapshot, fx_fingerprint: Optional[str],
+          cache: StageCache = None) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, dict]]:
+    if not snapshot.exists():
+        return None
+    meta = snapshot.meta()
+    if meta.get('format') != SNAPSHOT_FORMAT:
+        return None
+    if meta.get('fx_rates') != fx_fingerprint:
+        print(f'Курсы валют изменились, снимок {snapshot.folder} строится заново')
+        return None
+    return snapshot.load(cache)
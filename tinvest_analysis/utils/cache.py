@@ -0,0 +1,175 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+import weakref
+from collections import Counter
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from tinvest_analysis.utils.fs import CACHE_DIR
+from tinvest_analysis.utils.storage import Storage
+
+
+# отсутствие записи в кэше (None - допустимый результат шага)
+_MISSING = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _source_hash(path: str) -> str:
+    """
+    Хэш исходного кода файла или всех .py файлов пакета; считается один раз за запуск.
+    """
+    path = Path(path)
+    files = sorted(path.rglob('*.py')) if path.is_dir() else [path]
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(str(file.relative_to(path.parent)).encode())
+        digest.update(file.read_bytes())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Кэш результатов шагов расчета (data/cache/{stage}-{key}.pkl).
+    Ключ - хэш от имени шага, исходного кода пакета шага (шаги вызывают функции других модулей пакета:
+    processing, fx, lots, snapshot), текущей даты (панель строится до T-1) и входных данных:
+      * хранилище - по размерам и времени изменения файлов (Storage.fingerprint);
+      * DataFrame, полученный из кэша, - по ключу шага, который его вернул, остальные - по содержимому;
+      * прочие аргументы (например, stock_splits) - по JSON-представлению.
+    При превышении max_size_mb удаляются давно не использованные записи (LRU по времени последнего использования файла).
+    """
+
+    def __init__(self, root: Path = CACHE_DIR, max_size_mb: float = 1024, enabled: bool = True,
+                 rebuild: bool = False):
+        """
+        :param rebuild: не читать кэш, а пересчитать и перезаписать все шаги
+        """
+        self.root = Path(root)
+        self.max_size = max_size_mb * 2 ** 20
+        self.enabled = enabled
+        self.rebuild = rebuild
+        self.hits = Counter()
+        self.misses = Counter()
+        # ключи DataFrame, которые вернул кэш: id -> (weakref, key)
+        self._frame_keys = {}
+
+    def __getstate__(self):
+        # для передачи в другие процессы: слабые ссылки не сериализуются
+        state = self.__dict__.copy()
+        state['_frame_keys'] = {}
+        return state
+
+    def run(self, stage: str, func: Callable, *args, **kwargs):
+        """
+        Результат func(*args, **kwargs) из кэша, либо вычисленный и сохраненный в кэш.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        key = self.key(stage, func, *args, **kwargs)
+        result = self._read(stage, key)
+        if result is _MISSING:
+            result = func(*args, **kwargs)
+            self.put(stage, key, result)
+        if isinstance(result, pd.DataFrame):
+            self._frame_keys[id(result)] = (weakref.ref(result), key)
+        return result
+
+    def get(self, stage: str, key: str):
+        """
+        Значение, сохраненное put под ключом key; None, если записи нет (или кэш выключен, или rebuild).
+        """
+        if not self.enabled:
+            return None
+        result = self._read(stage, key)
+        return None if result is _MISSING else result
+
+    def put(self, stage: str, key: str, value):
+        """
+        Сохраняет значение под готовым ключом - для результатов, которые не выражаются одним вызовом функции
+        (например, панель снимка после инкрементального пересчета).
+        """
+        if not self.enabled:
+            return
+        self._write(self.root / f'{stage}-{key}.pkl', value)
+        self._evict()
+
+    def _read(self, stage: str, key: str):
+        path = self.root / f'{stage}-{key}.pkl'
+        if self.rebuild or not path.exists():
+            self.misses[stage] += 1
+            return _MISSING
+        with path.open('rb') as file:
+            result = pickle.load(file)
+        # время доступа обновляется явно: atime часто отключен в файловой системе
+        os.utime(path)
+        self.hits[stage] += 1
+        return result
+
+    def key(self, stage: str, func: Callable, *args, **kwargs) -> str:
+        payload = [
+            stage,
+            self._source_digest(func),
+            pd.Timestamp.today().normalize().isoformat(),
+            [self._digest(x) for x in args],
+            {name: self._digest(value) for name, value in sorted(kwargs.items())},
+        ]
+        return hashlib.sha256(json.dumps(payload, default=str).encode()).hexdigest()[:32]
+
+    @staticmethod
+    def _source_digest(func: Callable):
+        module = sys.modules.get(func.__module__)
+        path = getattr(module, '__file__', None)
+        if path is None:
+            return func.__qualname__
+        package = sys.modules.get(func.__module__.split('.')[0])
+        # модуль вне пакета (например, main.py) - только его файл
+        folder = Path(package.__file__).parent if getattr(package, '__path__', None) else None
+        return [func.__qualname__, _source_hash(str(folder or path))]
+
+    def _digest(self, value):
+        if isinstance(value, Storage):
+            return value.fingerprint()
+        if isinstance(value, pd.DataFrame):
+            ref, key = self._frame_keys.get(id(value), (None, None))
+            if ref is not None and ref() is value:
+                return key
+            return hashlib.sha256(pd.util.hash_pandas_object(value).values.tobytes()
+                                  + str(list(value.dtypes.items())).encode()).hexdigest()
+        return value
+
+    def _write(self, path: Path, result):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with tmp_path.open('wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(path)
+
+    def _evict(self):
+        entries = []
+        for path in self.root.glob('*.pkl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for path in self.root.glob('*.pkl'):
+            path.unlink(missing_ok=True)
+
+    def report(self) -> str:
+        lines = ['Кэш шагов расчета (попадания / промахи):']
+        for stage in sorted(set(self.hits) | set(self.misses)):
+            lines.append(f'  {stage}: {self.hits[stage]} / {self.misses[stage]}')
+        return '\n'.join(lines)
@@ -5,3 +5,10 @@ ROOT_DIR = Path(__file__).parent.parent.parent
 DATA_DIR = ROOT_DIR / 'data'
 TINKOFF_DIR = DATA_DIR / 'tinkoff'
 HISTORY_QUOTE_DIR = DATA_DIR / 'investfunds'
+METADATA_PATH = DATA_DIR / 'metadata.json'
+PARQUET_DIR = DATA_DIR / 'parquet'
+ARTIFACTS_DIR = ROOT_DIR / 'artifacts'
+SNAPSHOT_DIR = DATA_DIR / 'snapshots'
+CACHE_DIR = DATA_DIR / 'cache'
+FX_RATES_PATH = DATA_DIR / 'fx' / 'rates.csv'
+HTTP_ARCHIVE_PATH = DATA_DIR / 'http' / 'archive.zip'
@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from tinvest_analysis.utils.fs import METADATA_PATH
+
+
+class MetadataStore:
+    """
+    Локальный справочник редко меняющихся данных по бумагам (JSON-файл в data/).
+    Пространства имен:
+      * figi - тикер, ISIN и название бумаги по FIGI (Тинькофф)
+      * investfunds - тип актива, атрибуты поиска и атрибуты страницы бумаги по ISIN
+    Записи старше ttl считаются устаревшими и загружаются заново.
+    """
+
+    def __init__(self, path: Path = METADATA_PATH, ttl_days: float = 30):
+        self.path = Path(path)
+        self.ttl = ttl_days * 24 * 3600
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        if not self.path.exists():
+            return {}
+        with self.path.open('r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def get(self, namespace: str, key: str):
+        with self._lock:
+            record = self._data.get(namespace, {}).get(key)
+            if record is None or time.time() - record['updated'] > self.ttl:
+                self.misses[namespace] += 1
+                return None
+            self.hits[namespace] += 1
+            return record['value']
+
+    def set(self, namespace: str, key: str, value):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = {'updated': time.time(), 'value': value}
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path.with_suffix('.tmp')
+            with tmp_path.open('w', encoding='utf-8') as file:
+                json.dump(self._data, file, ensure_ascii=False)
+            tmp_path.replace(self.path)
+
+    def report(self) -> str:
+        lines = ['Справочник бумаг (попадания / промахи):']
+        for namespace in sorted(set(self.hits) | set(self.misses)):
+            lines.append(f'  {namespace}: {self.hits[namespace]} / {self.misses[namespace]}')
+        return '\n'.join(lines)
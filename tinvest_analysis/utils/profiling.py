@@ -0,0 +1,164 @@
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Пиковый объем памяти процесса (RSS) с момента запуска или None, если платформа его не отдает.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS отдает байты, Linux и BSD - килобайты
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _rows(value) -> Optional[int]:
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+
+class StageRecord:
+    """
+    Результат одного вызова шага; rows_out можно задать внутри блока with.
+    """
+
+    def __init__(self, rows_in: int = None):
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+class Profiler:
+    """
+    Время выполнения шагов расчета и сетевых запросов:
+      * stage - контекстный менеджер вокруг шага;
+      * track - декоратор шага: строки на входе и выходе считаются по DataFrame в аргументах и результате.
+    Для каждого имени накапливаются число вызовов, суммарное время и строки, а также пиковый RSS процесса
+    на момент завершения шага. Потокобезопасен: сетевые запросы выполняются в пуле потоков.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        record = StageRecord(rows_in)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self._add(name, time.perf_counter() - start, record)
+
+    def track(self, name: str = None):
+        def decorator(func):
+            stage_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                rows = [_rows(x) for x in (*args, *kwargs.values())]
+                rows = [x for x in rows if x is not None]
+                with self.stage(stage_name, sum(rows) if rows else None) as record:
+                    result = func(*args, **kwargs)
+                    record.rows_out = _rows(result)
+                return result
+            return wrapper
+        return decorator
+
+    def _add(self, name: str, seconds: float, record: StageRecord):
+        with self._lock:
+            total = self.records.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows_in': None, 'rows_out': None})
+            total['calls'] += 1
+            total['seconds'] += seconds
+            for key in ('rows_in', 'rows_out'):
+                value = getattr(record, key)
+                if value is not None:
+                    total[key] = (total[key] or 0) + value
+            total['peak_rss_mb'] = peak_rss_mb()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.records = {}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'started': pd.Timestamp(self.started, unit='s').isoformat(),
+                'wall_seconds': time.time() - self.started,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': {name: dict(record) for name, record in self.records.items()},
+            }
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), ensure_ascii=False, indent=2))
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        if not data['stages']:
+            return 'Нет замеров'
+        table = pd.DataFrame.from_dict(data['stages'], orient='index')\
+            .astype({'calls': 'Int64', 'rows_in': 'Int64', 'rows_out': 'Int64', 'seconds': float})
+        table['share, %'] = 100 * table['seconds'] / data['wall_seconds']
+        lines = [
+            f'Время по шагам (всего {data["wall_seconds"]:.1f} с, пиковый RSS {data["peak_rss_mb"] or 0:.0f} MB):',
+            table.to_string(float_format=lambda x: f'{x:.2f}', na_rep='-'),
+        ]
+        return '\n'.join(lines)
+
+
+# общий профилировщик процесса: шаги расчета и загрузчики пишут в него
+profiler = Profiler()
+
+
+@contextmanager
+def code_profile(path: Path = None, engine: str = 'cprofile'):
+    """
+    Профиль всего блока: cProfile (.prof, смотреть через snakeviz / pstats) или pyinstrument (.html).
+    Без path профилирование выключено.
+    """
+    if path is None:
+        yield
+        return
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if engine == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler as InstrumentProfiler
+        except ImportError:
+            raise ImportError('Для --profile-engine pyinstrument установите пакет: pip install pyinstrument')
+        instrument = InstrumentProfiler()
+        instrument.start()
+        try:
+            yield
+        finally:
+            instrument.stop()
+            path.write_text(instrument.output_html())
+    else:
+        import cProfile
+        code_profiler = cProfile.Profile()
+        code_profiler.enable()
+        try:
+            yield
+        finally:
+            code_profiler.disable()
+            code_profiler.dump_stats(path)
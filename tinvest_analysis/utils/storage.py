@@ -0,0 +1,396 @@
+import argparse
+import shutil
+import uuid
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import pandas as pd
+
+from tinvest_analysis.utils.fs import TINKOFF_DIR, HISTORY_QUOTE_DIR, PARQUET_DIR
+
+
+# текстовые колонки с небольшим числом уникальных значений
+QUOTE_CATEGORICAL_COLUMNS = ('isin', 'investemnt_object_type', 'geography', 'currency')
+OPERATION_CATEGORICAL_COLUMNS = ('figi', 'ticker', 'isin', 'instrument_type', 'operation_type', 'currency')
+
+
+def _to_object(df: pd.DataFrame) -> pd.DataFrame:
+    categorical = df.select_dtypes('category').columns
+    if len(categorical) > 0:
+        df = df.astype({column: object for column in categorical})
+    return df
+
+
+def _filter_dates(df: pd.DataFrame, column: str, date_from=None, date_to=None) -> pd.DataFrame:
+    if date_from is not None:
+        df = df[df[column] >= pd.Timestamp(date_from)]
+    if date_to is not None:
+        df = df[df[column] < pd.Timestamp(date_to)]
+    return df
+
+
+class Storage:
+    """
+    Хранилище операций по счетам и истории котировок.
+    Котировки хранятся с колонкой dt, операции - с колонкой id.
+    """
+
+    def quote_isins(self) -> list:
+        raise NotImplementedError
+
+    def read_quotes(self, columns: Sequence[str] = None, isins: Sequence[str] = None,
+                    date_from=None, date_to=None, categorical: bool = False) -> pd.DataFrame:
+        """
+        Котировки всех (или только isins) бумаг в одной таблице с колонкой isin.
+        :param columns: какие колонки читать (isin добавляется всегда)
+        :param date_from: котировки начиная с этой даты (включительно)
+        :param date_to: котировки до этой даты (не включительно)
+        :param categorical: вернуть текстовые колонки как pandas.Categorical
+        """
+        raise NotImplementedError
+
+    def last_quote(self, isin: str) -> Optional[pd.Series]:
+        """
+        Последняя сохраненная котировка бумаги (dt, close_price) или None.
+        """
+        raise NotImplementedError
+
+    def write_quotes(self, isin: str, quotes: pd.DataFrame):
+        raise NotImplementedError
+
+    def append_quotes(self, isin: str, quotes: pd.DataFrame):
+        raise NotImplementedError
+
+    def has_operations(self, account_type: str) -> bool:
+        raise NotImplementedError
+
+    def read_operations(self, account_type: str, columns: Sequence[str] = None,
+                        categorical: bool = False) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def accounts(self) -> List[str]:
+        """
+        Счета, по которым в хранилище есть операции (список счетов без запроса к API).
+        """
+        raise NotImplementedError
+
+    def operation_ids(self, account_type: str) -> pd.Index:
+        return pd.Index(self.read_operations(account_type, columns=['id'])['id'].astype(str))
+
+    def write_operations(self, account_type: str, operations: pd.DataFrame):
+        """
+        :param operations: операции с индексом id
+        """
+        raise NotImplementedError
+
+    def append_operations(self, account_type: str, operations: pd.DataFrame):
+        raise NotImplementedError
+
+    def compact_operations(self, account_type: str):
+        """
+        Сливает дозаписанные части операций счета (ParquetStorage); в CSV операции счета и так в одном файле.
+        """
+
+    def compact_quotes(self, isin: str):
+        """
+        Сливает дозаписанные части котировок бумаги (ParquetStorage).
+        """
+
+    def _rewrite_operations(self, account_type: str, operations: pd.DataFrame):
+        """
+        Дозапись операций с колонками, которых еще нет в хранилище (например, currency): операции счета
+        переписываются целиком, у старых операций новые колонки пустые.
+        """
+        stored = self.read_operations(account_type).set_index('id')
+        self.write_operations(account_type, pd.concat([stored, operations], axis=0))
+
+    def files(self) -> List[Path]:
+        raise NotImplementedError
+
+    def fingerprint(self) -> list:
+        """
+        Путь, размер и время изменения каждого файла хранилища: меняется при любой записи.
+        """
+        fingerprint = []
+        for path in sorted(self.files()):
+            stat = path.stat()
+            fingerprint.append([str(path), stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+
+class CsvStorage(Storage):
+    """
+    Исходный формат: data/investfunds/{isin}.csv и data/tinkoff/{account_type}/operations.csv.
+    """
+
+    def __init__(self, quotes_dir: Path = HISTORY_QUOTE_DIR, operations_dir: Path = TINKOFF_DIR):
+        self.quotes_dir = Path(quotes_dir)
+        self.operations_dir = Path(operations_dir)
+
+    def _quote_path(self, isin):
+        return self.quotes_dir / f'{isin}.csv'
+
+    def _operations_path(self, account_type):
+        return self.operations_dir / account_type / 'operations.csv'
+
+    def quote_isins(self) -> list:
+        if not self.quotes_dir.exists():
+            return []
+        return sorted(path.stem for path in self.quotes_dir.iterdir() if path.suffix == '.csv')
+
+    def read_quotes(self, columns=None, isins=None, date_from=None, date_to=None, categorical=False):
+        quotes = []
+        for isin in isins if isins is not None else self.quote_isins():
+            usecols = None if columns is None else [x for x in columns if x != 'isin']
+            parse_dates = ['dt'] if usecols is None or 'dt' in usecols else None
+            df = pd.read_csv(self._quote_path(isin), usecols=usecols, parse_dates=parse_dates)
+            df = _filter_dates(df, 'dt', date_from, date_to).assign(isin=isin)
+            quotes.append(df)
+        if not quotes:
+            return pd.DataFrame(columns=columns or ['dt', 'close_price', 'isin'])
+        quotes = pd.concat(quotes, axis=0, ignore_index=True)
+        if categorical:
+            quotes = quotes.astype({x: 'category' for x in QUOTE_CATEGORICAL_COLUMNS if x in quotes.columns})
+        return quotes
+
+    def last_quote(self, isin):
+        path = self._quote_path(isin)
+        if not path.exists():
+            return None
+        quotes = pd.read_csv(path, usecols=['dt', 'close_price'], parse_dates=['dt'])
+        if quotes.empty:
+            return None
+        return quotes.loc[quotes['dt'].idxmax()]
+
+    def write_quotes(self, isin, quotes):
+        self.quotes_dir.mkdir(parents=True, exist_ok=True)
+        quotes.to_csv(self._quote_path(isin), header=True, index=False)
+
+    def append_quotes(self, isin, quotes):
+        path = self._quote_path(isin)
+        columns = pd.read_csv(path, nrows=0).columns
+        quotes[columns].to_csv(path, mode='a', header=False, index=False)
+
+    def has_operations(self, account_type):
+        return self._operations_path(account_type).exists()
+
+    def accounts(self):
+        if not self.operations_dir.exists():
+            return []
+        return sorted(path.parent.name for path in self.operations_dir.glob('*/operations.csv'))
+
+    def read_operations(self, account_type, columns=None, categorical=False):
+        path = self._operations_path(account_type)
+        header = pd.read_csv(path, nrows=0).columns
+        parse_dates = ['dt'] if columns is None or 'dt' in columns else None
+        operations = pd.read_csv(path, usecols=columns, parse_dates=parse_dates,
+                                 dtype={'id': str} if 'id' in header else None)
+        if categorical:
+            operations = operations.astype({
+                x: 'category' for x in OPERATION_CATEGORICAL_COLUMNS if x in operations.columns})
+        return operations
+
+    def write_operations(self, account_type, operations):
+        path = self._operations_path(account_type)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        operations.to_csv(path, index=True, header=True)
+
+    def append_operations(self, account_type, operations):
+        path = self._operations_path(account_type)
+        columns = pd.read_csv(path, index_col='id', nrows=0).columns
+        if not operations.columns.isin(columns).all():
+            self._rewrite_operations(account_type, operations)
+            return
+        operations[columns].to_csv(path, mode='a', index=True, header=False)
+
+    def files(self):
+        files = list(self.quotes_dir.glob('*.csv')) if self.quotes_dir.exists() else []
+        if self.operations_dir.exists():
+            files.extend(self.operations_dir.glob('*/operations.csv'))
+        return files
+
+
+class ParquetStorage(Storage):
+    """
+    Колоночное хранилище с разбиением на партиции:
+      * котировки - quotes/isin={isin}/part-*.parquet
+      * операции - operations/account={account_type}/part-*.parquet
+    Дозапись добавляет в партицию новый файл, не переписывая старые; когда файлов больше MAX_PARTS,
+    партиция сливается в один файл (compact_operations, compact_quotes).
+    Текстовые колонки хранятся словарем (dictionary encoding), даты - как datetime64.
+    """
+    # сколько файлов дозаписи держать в партиции до слияния: каждый файл - отдельное открытие при чтении
+    MAX_PARTS = 8
+
+    def __init__(self, root: Path = PARQUET_DIR):
+        self.root = Path(root)
+        self.quotes_dir = self.root / 'quotes'
+        self.operations_dir = self.root / 'operations'
+
+    @staticmethod
+    def _schema(df: pd.DataFrame, categorical_columns) -> 'pa.Schema':
+        import pyarrow as pa
+
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if field.name in categorical_columns:
+                schema = schema.set(i, pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+            elif field.name == 'dt':
+                schema = schema.set(i, pa.field(field.name, pa.timestamp('ns')))
+            elif pa.types.is_null(field.type):
+                # пустые колонки (например, commission) - числовые
+                schema = schema.set(i, pa.field(field.name, pa.float64()))
+        return schema
+
+    def _write_part(self, folder: Path, df: pd.DataFrame, categorical_columns):
+        folder.mkdir(parents=True, exist_ok=True)
+        if 'dt' in df.columns:
+            df = df.assign(dt=pd.to_datetime(df['dt']))
+        df = df.astype({x: 'string' for x in categorical_columns if x in df.columns})\
+            .astype({x: 'category' for x in categorical_columns if x in df.columns})
+        df.to_parquet(folder / f'part-{uuid.uuid4().hex}.parquet', index=False, engine='pyarrow',
+                      schema=self._schema(df, categorical_columns))
+
+    @staticmethod
+    def _read(path: Path, columns=None, filters=None, categorical=False) -> Optional[pd.DataFrame]:
+        if not path.exists() or not any(path.rglob('*.parquet')):
+            return None
+        df = pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters)
+        return df if categorical else _to_object(df)
+
+    def _compact(self, folder: Path, categorical_columns):
+        """
+        Переписывает партицию одним файлом. Файл пишется во временную папку (_compact: pyarrow не читает папки
+        с префиксом _), которая затем подменяет партицию.
+        """
+        if len(list(folder.glob('*.parquet'))) <= self.MAX_PARTS:
+            return
+        df = self._read(folder, categorical=True)
+        if 'dt' in df.columns:
+            # порядок файлов партиции случайный - строки упорядочиваются по времени
+            df = df.sort_values(by='dt', kind='stable')
+        tmp_folder = self.root / '_compact' / uuid.uuid4().hex
+        self._write_part(tmp_folder, df, categorical_columns)
+        old_folder = tmp_folder.with_name(f'{tmp_folder.name}.old')
+        folder.rename(old_folder)
+        tmp_folder.rename(folder)
+        shutil.rmtree(old_folder)
+
+    def quote_isins(self) -> list:
+        if not self.quotes_dir.exists():
+            return []
+        return sorted(path.name.split('=', 1)[1] for path in self.quotes_dir.iterdir() if path.is_dir())
+
+    def read_quotes(self, columns=None, isins=None, date_from=None, date_to=None, categorical=False):
+        filters = []
+        if isins is not None:
+            filters.append(('isin', 'in', list(isins)))
+        if date_from is not None:
+            filters.append(('dt', '>=', pd.Timestamp(date_from)))
+        if date_to is not None:
+            filters.append(('dt', '<', pd.Timestamp(date_to)))
+        if columns is not None and 'isin' not in columns:
+            columns = [*columns, 'isin']
+        quotes = self._read(self.quotes_dir, columns, filters or None, categorical)
+        if quotes is None:
+            return pd.DataFrame(columns=columns or ['dt', 'close_price', 'isin'])
+        return quotes
+
+    def _quote_partition(self, isin):
+        return self.quotes_dir / f'isin={isin}'
+
+    def last_quote(self, isin):
+        quotes = self._read(self._quote_partition(isin), columns=['dt', 'close_price'])
+        if quotes is None or quotes.empty:
+            return None
+        return quotes.loc[quotes['dt'].idxmax()]
+
+    def write_quotes(self, isin, quotes):
+        shutil.rmtree(self._quote_partition(isin), ignore_errors=True)
+        self.append_quotes(isin, quotes)
+
+    def append_quotes(self, isin, quotes):
+        if quotes.empty:
+            return
+        quotes = quotes.drop(columns=['isin'], errors='ignore')
+        self._write_part(self._quote_partition(isin), quotes, QUOTE_CATEGORICAL_COLUMNS)
+
+    def compact_quotes(self, isin):
+        self._compact(self._quote_partition(isin), QUOTE_CATEGORICAL_COLUMNS)
+
+    def _operations_partition(self, account_type):
+        return self.operations_dir / f'account={account_type}'
+
+    def has_operations(self, account_type):
+        return self._operations_partition(account_type).exists()
+
+    def accounts(self):
+        if not self.operations_dir.exists():
+            return []
+        return sorted(path.name.split('=', 1)[1] for path in self.operations_dir.iterdir()
+                      if path.is_dir() and path.name.startswith('account='))
+
+    def read_operations(self, account_type, columns=None, categorical=False):
+        operations = self._read(self._operations_partition(account_type), columns, categorical=categorical)
+        if operations is None:
+            return pd.DataFrame(columns=columns or ['id'])
+        return operations
+
+    def write_operations(self, account_type, operations):
+        shutil.rmtree(self._operations_partition(account_type), ignore_errors=True)
+        self.append_operations(account_type, operations)
+
+    def append_operations(self, account_type, operations):
+        if operations.empty:
+            return
+        parts = sorted(self._operations_partition(account_type).glob('*.parquet'))
+        if parts:
+            import pyarrow.parquet as pq
+
+            # схема партиции берется из первого файла: новые колонки в следующих файлах не прочитаются
+            if not operations.columns.isin(pq.read_schema(parts[0]).names).all():
+                self._rewrite_operations(account_type, operations)
+                return
+        operations = operations.reset_index().astype({'id': str})
+        self._write_part(self._operations_partition(account_type), operations, OPERATION_CATEGORICAL_COLUMNS)
+
+    def compact_operations(self, account_type):
+        self._compact(self._operations_partition(account_type), OPERATION_CATEGORICAL_COLUMNS)
+
+    def files(self):
+        if not self.root.exists():
+            return []
+        return [path for path in self.root.rglob('*.parquet') if '_compact' not in path.parts]
+
+
+STORAGE_BACKENDS = {
+    'csv': CsvStorage,
+    'parquet': ParquetStorage,
+}
+
+
+def get_storage(backend: str = 'csv') -> Storage:
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f'Неизвестный тип хранилища: {backend}')
+    return STORAGE_BACKENDS[backend]()
+
+
+def migrate(source: Storage, target: Storage, accounts: Sequence[str] = None):
+    """
+    Перенос котировок и операций из одного хранилища в другое.
+    """
+    for isin in source.quote_isins():
+        quotes = source.read_quotes(isins=[isin]).drop(columns=['isin'])
+        target.write_quotes(isin, quotes)
+    for account_type in source.accounts() if accounts is None else accounts:
+        if source.has_operations(account_type):
+            operations = source.read_operations(account_type).set_index('id')
+            target.write_operations(account_type, operations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос данных между форматами хранения')
+    parser.add_argument('--source', choices=STORAGE_BACKENDS, default='csv')
+    parser.add_argument('--target', choices=STORAGE_BACKENDS, default='parquet')
+    args = parser.parse_args()
+    migrate(get_storage(args.source), get_storage(args.target))